@@ -0,0 +1,280 @@
+import hashlib
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from typing import Optional
+
+from cache import cache_dir
+
+try:
+    import numpy
+except ImportError:
+    # without numpy the tempo changes are done by sox
+    numpy = None
+
+# sample width in bytes -> numpy type of the wav frames
+SAMPLE_TYPES = {1: 'u1', 2: '<i2', 4: '<i4'}
+
+
+class AudioError(Exception):
+    pass
+
+
+class TranscodeError(AudioError):
+    pass
+
+
+def transcode(ogg, wav):
+    # ogg to wav with ffmpeg, the paths are passed as arguments, no shell involved
+    result = subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', ogg, wav],
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise TranscodeError(f'Error converting {ogg}: {result.stderr.strip()}')
+
+
+class AudioCache:
+    # Derived audio, i.e. converted, concatenated and rushed sounds, outside of
+    # the plugin directories. A file is keyed by the content of its sources, the
+    # operation and its parameters, so a changed source is never served stale.
+    # The cache is bounded by max_size bytes, prune removes the least recently
+    # used files first, a hit refreshes the mtime.
+
+    def __init__(self, directory='', max_size=1024 * 1024 * 1024):
+        self.directory = directory or cache_dir('audio')
+        self.max_size = max_size
+        self.digests = {}  # (path, size, mtime_ns): content digest
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def digest(self, filename):
+        # a file of this cache is named by its key already
+        if os.path.dirname(os.path.dirname(filename)) == self.directory:
+            return os.path.splitext(os.path.basename(filename))[0]
+        stat = os.stat(filename)
+        memo = (filename, stat.st_size, stat.st_mtime_ns)
+        if memo not in self.digests:
+            with open(filename, 'rb') as f:
+                self.digests[memo] = hashlib.sha1(f.read()).hexdigest()
+        return self.digests[memo]
+
+    def key(self, operation, sources, *params):
+        key = hashlib.sha1(repr((operation, params)).encode('utf-8'))
+        for source in sources:
+            key.update(self.digest(source).encode('ascii'))
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.wav')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.hits += 1
+        return path
+
+    def create(self, key, write):
+        # write(filename) renders into a temporary file, which becomes the cached
+        # file only when it is complete
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, temporary) = tempfile.mkstemp(suffix='.wav', prefix='.tmp-', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            write(temporary)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        with self.lock:
+            self.misses += 1
+        return path
+
+    def render(self, sources, tempo=1.0):
+        # see render below
+        key = self.key('render', sources, tempo)
+        return self.get(key) or self.create(key, lambda filename: render(sources, filename, tempo))
+
+    def random(self, filename):
+        # a random generator seeded by the content of filename, so the same
+        # sound is always rushed by the same factor
+        return random.Random(self.digest(filename))
+
+    def files(self):
+        # [(mtime, size, path)] of the cached files, oldest first
+        files = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                if name.startswith('.tmp-'):
+                    # left over by a crash, see create
+                    if stat.st_mtime < time.time() - 3600:
+                        os.remove(path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+    def stats(self):
+        files = self.files()
+        return {
+            'directory': self.directory,
+            'files': len(files),
+            'size': sum(size for mtime, size, path in files),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        files = self.files()
+        total = sum(size for mtime, size, path in files)
+        removed = 0
+        for mtime, size, path in files:
+            if total <= max_size:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        logging.info(f'Audio cache: removed {removed} files, {total / 1024 / 1024:.1f} MiB left in {self.directory}')
+        return removed
+
+
+class Transcoder:
+    # The ogg to wav conversions of a build.
+    # They are collected with add, deduplicated by the ogg file and converted
+    # one by one with convert into the AudioCache, e.g. by the tasks of a
+    # TaskGraph, which runs jobs of them at once. wav converts on demand.
+
+    def __init__(self, jobs=0, cache: Optional[AudioCache] = None):
+        # jobs = 0 uses all cores
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache = cache or AudioCache()
+        self.conversions = {}  # ogg: key
+
+    def add(self, ogg):
+        if ogg not in self.conversions:
+            self.conversions[ogg] = self.cache.key('ffmpeg', [ogg])
+
+    def convert(self, ogg):
+        key = self.conversions[ogg]
+        return self.cache.get(key) or self.cache.create(key, lambda filename: transcode(ogg, filename))
+
+    def wav(self, ogg):
+        # the converted file in the cache
+        self.add(ogg)
+        return self.convert(ogg)
+
+
+def is_wav(filename):
+    # a wav source, e.g. a static sound of the game, is used as it is
+    return os.path.splitext(filename)[1].lower() == '.wav'
+
+
+def sox(*args):
+    result = subprocess.run(['sox', *args], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AudioError(f'Error running sox {" ".join(args)}: {result.stderr.strip()}')
+
+
+def read_wav(filename):
+    with wave.open(filename, 'rb') as f:
+        return (f.getparams(), f.readframes(f.getnframes()))
+
+
+def write_wav(filename, params, frames):
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(params.nchannels)
+        f.setsampwidth(params.sampwidth)
+        f.setframerate(params.framerate)
+        f.writeframes(frames)
+
+
+def render(sources, destination, tempo=1.0):
+    # The wav files in sources back to back, sped up by tempo without changing
+    # the pitch, written to destination. Like sox a.wav b.wav out.wav tempo 1.3,
+    # but in process. sox is still used for what wave and numpy cannot do here:
+    # e.g. float or 24 bit samples, extensible headers, different formats.
+    try:
+        clips = [read_wav(x) for x in sources]
+    except (wave.Error, EOFError) as e:
+        logging.debug(f'Using sox for {destination}: {e}')
+        clips = []
+    formats = {(params.nchannels, params.sampwidth, params.framerate) for params, frames in clips}
+    if (len(formats) != 1
+            or (tempo != 1.0 and (numpy is None or clips[0][0].sampwidth not in SAMPLE_TYPES))):
+        sox(*sources, destination, *(['tempo', str(tempo)] if tempo != 1.0 else []))
+        return
+
+    params = clips[0][0]
+    frames = b''.join(frames for params, frames in clips)
+    if tempo != 1.0:
+        frames = stretch(frames, params, tempo)
+    write_wav(destination, params, frames)
+
+
+def stretch(frames, params, tempo):
+    # WSOLA time stretch of raw wav frames, tempo > 1 is faster.
+    # The input is cut into overlapping hann windowed frames that are added up
+    # at a different hop size. Each next frame is shifted by up to tolerance
+    # samples to the position that continues the previous frame best, which
+    # keeps the pitch and avoids the phasing of a plain overlap-add.
+    sample_type = numpy.dtype(SAMPLE_TYPES[params.sampwidth])
+    x = numpy.frombuffer(frames, dtype=sample_type).reshape(-1, params.nchannels).astype(numpy.float64)
+    if params.sampwidth == 1:
+        x -= 128
+
+    length = len(x)
+    output_length = int(round(length / tempo))
+    window_length = max(64, int(params.framerate * 0.025)) // 2 * 2
+    synthesis_hop = window_length // 2
+    tolerance = synthesis_hop // 2
+    if length < window_length:
+        # too short to stretch anything
+        return frames
+
+    window = numpy.hanning(window_length)
+    num_frames = output_length // synthesis_hop + 2
+    analysis_positions = numpy.round(numpy.arange(num_frames + 1) * synthesis_hop * tempo).astype(int)
+
+    # the frames are centered on the positions, with room for the shifts
+    offset = window_length // 2 + tolerance
+    end = analysis_positions[-1] + window_length + synthesis_hop + 2 * tolerance
+    padded = numpy.zeros((offset + max(length, end), params.nchannels))
+    padded[offset:offset + length] = x
+    mono = padded.mean(axis=1)
+
+    y = numpy.zeros((num_frames * synthesis_hop + window_length, params.nchannels))
+    weights = numpy.zeros(len(y))
+    shift = 0
+    for i in range(num_frames):
+        start = analysis_positions[i] + offset - window_length // 2 + shift
+        synthesis_start = i * synthesis_hop
+        y[synthesis_start:synthesis_start + window_length] += padded[start:start + window_length] * window[:, None]
+        weights[synthesis_start:synthesis_start + window_length] += window
+
+        # what would naturally follow the frame that was just added
+        natural = mono[start + synthesis_hop:start + synthesis_hop + window_length]
+        next_start = analysis_positions[i + 1] + offset - window_length // 2
+        candidates = mono[next_start - tolerance:next_start + tolerance + window_length]
+        shift = int(numpy.argmax(numpy.correlate(candidates, natural, mode='valid'))) - tolerance
+
+    weights[weights < 1e-3] = 1
+    y /= weights[:, None]
+    y = y[window_length // 2:window_length // 2 + output_length]
+
+    if params.sampwidth == 1:
+        y += 128
+    info = numpy.iinfo(sample_type)
+    return numpy.clip(numpy.round(y), info.min, info.max).astype(sample_type).tobytes()
@@ -0,0 +1,13 @@
+import os
+
+
+def cache_dir(*parts):
+    # all caches live outside of the source and asset trees
+    # CC_CODRIVER_CACHE overrides the default XDG location
+    base = os.environ.get('CC_CODRIVER_CACHE')
+    if not base:
+        xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        base = os.path.join(xdg_cache_home, 'cc_codriver')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
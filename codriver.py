@@ -2,14 +2,21 @@
 
 import argparse
 import csv
+import functools
 import json
 import os
 import logging
 import shutil
 import sys
-from typing import Iterator, List, Mapping, Optional, Union
-from rbr_pacenote_plugin import RbrPacenotePlugin, RbrPacenote
-from roadbook import Roadbooks
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Mapping, Optional, Union
+from audio import AudioCache, AudioError, Transcoder
+from rbr_pacenote_plugin import RbrPacenote, load_plugins
+from roadbook_cache import RoadbookCache
+from roadbook_diff import RoadbookDiff
+from roadbook_index import RoadbookIndex, parse_query
+from roadbook_library import is_roadbook_library, open_roadbooks, write_roadbook_library
+from task_graph import TaskGraph
 
 
 class MappedNote:
@@ -162,11 +169,7 @@ class CrewChiefNote:
         self.notes.append(note)
 
     def add_file(self, file, package, sounds_dir, id = -1):
-        rbr_note = RbrPacenote(file)
-        rbr_note.id = id
-        rbr_note.sounds.append(file)
-        rbr_note.sounds_dir = sounds_dir
-        rbr_note.package = package
+        rbr_note = RbrPacenote(file, id=id, package=package, sounds=[file], sounds_dir=sounds_dir)
         self.notes.append(rbr_note)
 
     def __str__(self):
@@ -207,15 +210,76 @@ class CoDriver:
         self.init_cc_pacenotes_modifier(cc_pacenote_modifier)
         self.init_cc_sounds(self.cc_sounds_dir)
 
-        self.mapped_cc_notes : List[CrewChiefNote] = []
+        # the mapping rules compiled into dicts, see get_rbr_pacenotes and
+        # get_pacenote_type_for_cc_sound
+        self.compile_map_notes()
+        self.compile_cc_types()
+        # package: {rbr id: (package, id, name)}, see add_pacenote_plugin
+        self.rbr_id_targets = {}
+
+        # cc sound name: mapped note, see map_notes_from_cc
+        self.mapped_cc_notes : Dict[str, CrewChiefNote] = {}
+        self.cc_notes_mapped = False
+        # results of mapped_notes and unmapped_base_mod_notes, see invalidate_mapping
+        self.mapping : Optional[List[MappedNote]] = None
+        self.mapping_final : Optional[List[MappedNote]] = None
+        self.mapping_base : Optional[List[MappedNote]] = None
+        self.unmapped_mapping : Optional[List[MappedNote]] = None
 
     def set_base_codriver(self, base_codriver, package):
         self.base_codriver = base_codriver
         self.base_codriver_package = package
+        self.invalidate_mapping()
+
+    def invalidate_mapping(self):
+        # the mapping depends on the plugins, the base codriver and map_notes_from_cc
+        self.mapping = None
+        self.mapping_final = None
+        self.mapping_base = None
+        self.unmapped_mapping = None
 
     def add_pacenote_plugin(self, type, rbr_pacenote_plugin, map_rbr_ids = {}):
         self.rbr_pacenote_plugins[type] = rbr_pacenote_plugin
         self.map_rbr_ids[type] = map_rbr_ids
+        self.rbr_id_targets[type] = self.compile_map_rbr_ids(type, map_rbr_ids)
+        self.invalidate_mapping()
+
+    def compile_map_notes(self):
+        # positions of the map_notes rules by cc_id and by cc_name
+        self.map_notes_by_cc_id = {}
+        self.map_notes_by_cc_name = {}
+        for index, mapping in enumerate(self.map_notes):
+            if mapping.get('cc_id') is not None:
+                self.map_notes_by_cc_id.setdefault(mapping['cc_id'], []).append(index)
+            if mapping.get('cc_name') is not None:
+                self.map_notes_by_cc_name.setdefault(mapping['cc_name'], []).append(index)
+
+    def compile_map_rbr_ids(self, package, map_rbr_ids):
+        # rbr id: (package, id, name) the id is mapped to, name is None if it stays
+        targets = {}
+        for from_id, to_id in map_rbr_ids.items():
+            # a rule only changes the package of its own target
+            target_package = package
+            name = None
+            if isinstance(to_id, int):
+                id = to_id
+            else:
+                target_package = to_id[0]
+                id = to_id[1]
+
+            if isinstance(id, str):
+                name = id
+                id = -1
+            targets[from_id] = (target_package, id, name)
+        return targets
+
+    def compile_cc_types(self):
+        # lower case name: type, a type wins over a modifier of the same name
+        self.cc_types_by_name = {}
+        for type in self.cc_pacenotes_types.values():
+            self.cc_types_by_name.setdefault(type.name.lower(), type)
+        for type in self.cc_pacenotes_modifiers.values():
+            self.cc_types_by_name.setdefault(type.name.lower(), type)
 
     # 2. Get the mapping from CC CoDriver.cs
     # public enum PacenoteType
@@ -244,23 +308,20 @@ class CoDriver:
             'stages': []
         }
         if pacenote_stats:
-            # open pacenote_stats as a csv file
-            with open(pacenote_stats, mode='r', encoding='utf-8') as file:
-                csv_reader = csv.DictReader(file)
-                for row in csv_reader:
-                    stats['stages'].append(row)
-                    for key, value in row.items():
-                        if key.isnumeric():
-                            id = int(key)
-                            count = int(value)
-                            if not id in stats['count']:
-                                stats['count'][id] = 0
-                            stats['count'][id] += count
-
-                            if not id in stats['seen_per_stage']:
-                                stats['seen_per_stage'][id] = 0
-                            if count > 0:
-                                stats['seen_per_stage'][id] += 1
+            for row in self.read_pacenote_stats(pacenote_stats):
+                stats['stages'].append(row)
+                for key, value in row.items():
+                    if key.isnumeric():
+                        id = int(key)
+                        count = int(value)
+                        if not id in stats['count']:
+                            stats['count'][id] = 0
+                        stats['count'][id] += count
+
+                        if not id in stats['seen_per_stage']:
+                            stats['seen_per_stage'][id] = 0
+                        if count > 0:
+                            stats['seen_per_stage'][id] += 1
 
             # calculate popularity
             # 100 means it is in every stage
@@ -270,6 +331,20 @@ class CoDriver:
                 stats['popularity'][id] = round(count / count_stages, 2)
         return stats
 
+    def read_pacenote_stats(self, pacenote_stats):
+        # pacenote_stats is the roadbook csv, a roadbook directory or a roadbook library
+        if os.path.isdir(pacenote_stats) or is_roadbook_library(pacenote_stats):
+            roadbooks = open_roadbooks(pacenote_stats)
+            roadbooks.read_roadbooks('/.*/')
+            yield from roadbooks.analysis_dicts()
+            return
+
+        # open pacenote_stats as a csv file
+        with open(pacenote_stats, mode='r', encoding='utf-8') as file:
+            csv_reader = csv.DictReader(file)
+            for row in csv_reader:
+                yield row
+
     def parse_cc_types_files(self, file):
         # // Weird naming is used to simplify sound reading.
         # corner_1_left = 0,
@@ -342,14 +417,11 @@ class CoDriver:
 
     def get_rbr_pacenote_by_name(self, name, package = "numeric"):
         plugin = self.rbr_pacenote_plugins[package]
-        name = name.lower()
-        notes = [ note for note in plugin.pacenotes if note.name.lower() == name]
-        return notes
+        return plugin.pacenotes_with_name(name)
 
     def get_rbr_pacenotes_by_id(self, id, package = "numeric"):
         plugin = self.rbr_pacenote_plugins[package]
-        notes = [ note for note in plugin.pacenotes if note.id == id]
-        return notes
+        return plugin.pacenotes_with_id(id)
 
     def get_rbr_pacenotes(self, id=-1, name='', package = "numeric", type: Union[PacenoteType, PacenoteModifier, None] = None) -> List[RbrPacenote]:
         notes = []
@@ -360,30 +432,14 @@ class CoDriver:
         logging.debug(f'get_rbr_pacenotes: id: {id} - name: {name} - package: {package}')
 
         # if mapping is configured
-        for mapping in self.map_notes:
-            cc_id = mapping.get('cc_id')
-            if id == cc_id:
-                id = mapping.get('rbr_id', id)
-                name = mapping.get('rbr_name', name)
-            cc_name = mapping.get('cc_name')
-            if name == cc_name:
-                id = mapping.get('rbr_id', id)
-                name = mapping.get('rbr_name', name)
+        (id, name) = self.apply_map_notes(id, name)
 
         # if mapping for package is configured
-        package_mapping = self.map_rbr_ids.get(package, {})
-        for from_id, to_id in package_mapping.items():
-            if id == from_id:
-                if isinstance(to_id, int):
-                    id = to_id
-                else:
-                    package = to_id[0]
-                    id = to_id[1]
-
-                if isinstance(id, str):
-                    name = id
-                    id = -1
-                break
+        target = self.rbr_id_targets.get(package, {}).get(id)
+        if target:
+            (package, id, target_name) = target
+            if target_name is not None:
+                name = target_name
 
         # check if id is a number
         if not isinstance(id, int):
@@ -400,13 +456,35 @@ class CoDriver:
 
         return []
 
+    def apply_map_notes(self, id, name):
+        # The map_notes rules in order, each one sees the id and name the rules
+        # before it left. Only the rules that match by cc_id or cc_name are visited.
+        index = 0
+        while True:
+            next_rules = []
+            for indexes in (self.map_notes_by_cc_id.get(id, []), self.map_notes_by_cc_name.get(name, [])):
+                position = bisect_left(indexes, index)
+                if position < len(indexes):
+                    next_rules.append(indexes[position])
+            if not next_rules:
+                return (id, name)
+
+            index = min(next_rules)
+            mapping = self.map_notes[index]
+            cc_id = mapping.get('cc_id')
+            if id == cc_id:
+                id = mapping.get('rbr_id', id)
+                name = mapping.get('rbr_name', name)
+            cc_name = mapping.get('cc_name')
+            if name == cc_name:
+                id = mapping.get('rbr_id', id)
+                name = mapping.get('rbr_name', name)
+            index += 1
+
     def get_pacenote_type_for_cc_sound(self, sound) -> Union[PacenoteType, PacenoteModifier, PacenoteRange, None]:
-        for id, type in self.cc_pacenotes_types.items():
-            if type.name.lower() == sound.lower():
-                return type
-        for id, type in self.cc_pacenotes_modifiers.items():
-            if type.name.lower() == sound.lower():
-                return type
+        type = self.cc_types_by_name.get(sound.lower())
+        if type:
+            return type
 
         if sound.isnumeric():
             return PacenoteRange(sound)
@@ -414,10 +492,7 @@ class CoDriver:
         return None
 
     def map_package_and_type(self, type = '', package = 'numeric'):
-        for src, dst in self.map_cc_types.items():
-            if type == src:
-                type = dst
-                break
+        type = self.map_cc_types.get(type, type)
 
         if type.endswith('_descriptive'):
             package = 'descriptive'
@@ -523,10 +598,14 @@ class CoDriver:
 
             cc_notes.append(cc_note)
 
-        self.mapped_cc_notes = cc_notes
+        self.mapped_cc_notes = {}
+        for cc_note in cc_notes:
+            self.mapped_cc_notes.setdefault(cc_note.name, cc_note)
+        self.cc_notes_mapped = True
+        self.invalidate_mapping()
 
 
-    def cc_copy_original_sounds(self, type, dst_path):
+    def cc_copy_original_sounds(self, type, dst_path, build : Optional['CodriverBuild'] = None):
         # just copy the original sound
         src = os.path.join(self.cc_sounds_dir, type)
         # if src doesnt exist, just return
@@ -535,28 +614,16 @@ class CoDriver:
         # copy each file from src directory to the destination directory
         for file in os.listdir(src):
             file = os.path.join(src, file)
-            shutil.copy(file, dst_path)
-
-    def cc_copy_note(self, note : MappedNote, dst_path):
-        if not os.path.exists(dst_path):
-            os.makedirs(dst_path)
+            if build:
+                build.add_file(file, dst_path)
+            else:
+                shutil.copy(file, dst_path)
 
-        cc_note = note.get_cc_note()
-        rbr_note = note.get_rbr_note()
-        prefix = None
-        if cc_note.prefix:
-            prefix = cc_note.prefix.notes[0]
-        sound = note.file
-        wave_file = rbr_note.sound_as_wav(sound, prefix=prefix, rushed=cc_note.rushed)
-        wave_file = os.path.join(rbr_note.sounds_dir, wave_file)
-        shutil.copy(wave_file, dst_path)
-
-        # create subtitles.csv
-        with open(os.path.join(dst_path, 'subtitles.csv'), mode='a+', encoding='utf-8') as file:
-            csv_writer = csv.writer(file)
-            subtitle = rbr_note.translation
-            sound_file_basename = os.path.basename(wave_file)
-            csv_writer.writerow([sound_file_basename, subtitle])
+    def cc_copy_note(self, note : MappedNote, dst_path, transcoder : Optional[Transcoder] = None):
+        # a build of just this note, see CodriverBuild
+        build = CodriverBuild(transcoder or Transcoder())
+        build.add_note(note, dst_path)
+        build.run()
 
     def get_popularity(self, note : Union[RbrPacenote, CrewChiefNote, int]):
         popularity = 0
@@ -572,12 +639,36 @@ class CoDriver:
         popularity = self.pacenote_stats['popularity'].get(rbr_id, -1)
         return popularity
 
-    def mapped_notes(self):
-        mapped_base_notes = []
+    def mapped_notes(self) -> List[MappedNote]:
+        # the mapping of the cc sounds, computed once and shared by all consumers
+        if self.fallback_to_base:
+            if not self.base_codriver.cc_notes_mapped:
+                self.base_codriver.map_notes_from_cc()
+            # the base codriver mapped again
+            if self.mapping_base is not self.base_codriver.mapped_notes():
+                self.mapping = None
+        if self.mapping is None:
+            if self.fallback_to_base:
+                self.mapping_base = self.base_codriver.mapped_notes()
+            # map_cc_sounds mutates one note per cc sound while it yields its
+            # sounds: mapping keeps a copy of every row, mapping_final the notes
+            # in the state they were left in, which the fallback and the
+            # unmapped join go by
+            self.mapping = []
+            self.mapping_final = []
+            for note in self.map_cc_sounds():
+                self.mapping.append(MappedNote(note))
+                self.mapping_final.append(note)
+        return self.mapping
+
+    def map_cc_sounds(self) -> Iterator[MappedNote]:
+        # cc sound name: the note of the base codriver, if it was left as mapped from rbr
+        mapped_base_notes = {}
         if self.fallback_to_base:
-            self.base_codriver.map_notes_from_cc()
-            for base_note in self.base_codriver.mapped_notes():
-                mapped_base_notes.append(base_note)
+            self.base_codriver.mapped_notes()
+            for base_note in self.base_codriver.mapping_final:
+                if base_note.is_rbr():
+                    mapped_base_notes.setdefault(base_note.type, base_note)
 
         cc_sounds = sorted(self.cc_sounds.values(), key=lambda x: x.name)
         for cc_note in cc_sounds:
@@ -588,16 +679,14 @@ class CoDriver:
             yield_note = MappedNote()
 
             # find the mapped note
-            mapped_cc_note = next((x for x in self.mapped_cc_notes if x.name == cc_note.name), None)
+            mapped_cc_note = self.mapped_cc_notes.get(cc_note.name)
             yield_note.cc_note = mapped_cc_note
 
-            mapped_base_note = None
-            if self.fallback_to_base:
-                for base_note in mapped_base_notes:
-                    if base_note.type == cc_note.name and base_note.is_rbr():
-                        base_note.set_src_from_rbr_base()
-                        mapped_base_note = base_note
-                        break
+            mapped_base_note = mapped_base_notes.get(cc_note.name)
+            if mapped_base_note:
+                # a copy, the mapping of the base codriver is shared
+                mapped_base_note = MappedNote(mapped_base_note)
+                mapped_base_note.set_src_from_rbr_base()
 
             if not mapped_cc_note:
                 yield_note.set_no_rbr_note()
@@ -650,7 +739,13 @@ class CoDriver:
                         yield_note.set_src_from_rbr()
                         yield yield_note
 
-    def unmapped_base_mod_notes(self) -> Iterator[MappedNote]:
+    def unmapped_base_mod_notes(self) -> List[MappedNote]:
+        # the base mod notes this codriver does not map, computed once
+        if self.unmapped_mapping is None or self.mapping is not self.mapped_notes():
+            self.unmapped_mapping = list(self.map_unmapped_base_mod_notes())
+        return self.unmapped_mapping
+
+    def map_unmapped_base_mod_notes(self) -> Iterator[MappedNote]:
         # collect all rbr notes from all plugins
         rbr_base_mod_notes = self.base_codriver.rbr_pacenote_plugins[
             self.base_codriver_package
@@ -661,10 +756,27 @@ class CoDriver:
         for rbr_pacenote_plugin in self.rbr_pacenote_plugins.values():
             rbr_notes |= rbr_pacenote_plugin.pacenotes
 
-        # collect all mapped notes for this codriver
-        mapped_notes : List[MappedNote] = []
-        for note in self.mapped_notes():
-            mapped_notes.append(note)
+        # ids and names of the rbr notes mapped in this codriver,
+        # a mapped note with an id matches by id, one without by name
+        mapped_ids = set()
+        mapped_names = set()
+        self.mapped_notes()
+        for mapped_note in self.mapping_final:
+            if mapped_note.rbr_note:
+                if mapped_note.rbr_id >= 0:
+                    mapped_ids.add(mapped_note.rbr_id)
+                else:
+                    mapped_names.add(mapped_note.rbr_note.name)
+        # ids mapped to other notes by map_rbr_ids
+        for package in self.rbr_pacenote_plugins.keys():
+            mapped_ids.update(self.map_rbr_ids.get(package, {}).keys())
+
+        # our rbr note for a base note, the first one in the order of rbr_notes
+        rbr_notes_by_id = {}
+        rbr_notes_by_name = {}
+        for my_rbr_note in rbr_notes:
+            rbr_notes_by_id.setdefault(my_rbr_note.id, my_rbr_note)
+            rbr_notes_by_name.setdefault(my_rbr_note.name, my_rbr_note)
 
         # iterate through all rbr notes
         rbr_base_mod_notes = list(rbr_base_mod_notes)
@@ -672,39 +784,16 @@ class CoDriver:
         for rbr_note in rbr_base_mod_notes:
             yield_note = MappedNote()
             # check if the note is mapped in our codriver
-            found = False
-            for mapped_note in mapped_notes:
-                if mapped_note.rbr_note:
-                    if mapped_note.rbr_id >= 0:
-                        if rbr_note.id == mapped_note.rbr_id:
-                            found = True
-                            break
-                    else:
-                        if rbr_note.name == mapped_note.rbr_note.name:
-                            found = True
-                            break
-
-            if not found:
-                for package in self.rbr_pacenote_plugins.keys():
-                    package_mapping = self.map_rbr_ids.get(package, {})
-                    for from_id, to_id in package_mapping.items():
-                        if rbr_note.id == from_id:
-                            found = True
-                            break
-
+            found = rbr_note.id in mapped_ids or rbr_note.name in mapped_names
 
             # the note is not mapped
             if not found:
                 base_note = rbr_note
                 # try to find the rbr_note in our rbr_notes
-                for my_rbr_note in rbr_notes:
-                    if rbr_note.id >= 0:
-                        if my_rbr_note.id == rbr_note.id:
-                            rbr_note = my_rbr_note
-                            break
-                    elif my_rbr_note.name == rbr_note.name:
-                        rbr_note = my_rbr_note
-                        break
+                if rbr_note.id >= 0:
+                    rbr_note = rbr_notes_by_id.get(rbr_note.id, rbr_note)
+                else:
+                    rbr_note = rbr_notes_by_name.get(rbr_note.name, rbr_note)
 
                 popularity = self.get_popularity(rbr_note)
                 yield_note.popularity = popularity
@@ -735,7 +824,7 @@ class CoDriver:
                             yield_note.rbr_note = base_note
                         else:
                             continue
-                    yield yield_note
+                    yield MappedNote(yield_note)
 
     def cc_list_csv(self):
         csv_writer = csv.DictWriter(sys.stdout, MappedNote().as_dict().keys())
@@ -762,41 +851,35 @@ class CoDriver:
             notes = sorted(notes, key=lambda x: (x.id, x.name, x.category))
 
             for note in notes:
-                popularity = self.get_popularity(note)
-                for sound in note.sounds:
-                    error = ''
-                    if sound in note.sounds_mapped.values():
-                        from_sound = next((k for k, v in note.sounds_mapped.items() if v == sound), None)
-                        error = f'file mapped from {from_sound}'
-                    if sound in note.sounds_not_found:
-                        error = 'file missing'
-                    csv_writer.writerow([name, note.id, note.name, note.type, note.category, note.package, note.ini, note.sound_count, note.translation, sound, popularity, error])
+                self.rbr_list_rows(csv_writer, name, note)
 
+            # a note with an id matches a base note by id, one without by name
+            ids = {note.id for note in notes if note.id >= 0}
+            names = {note.name for note in notes if note.id < 0}
             name = 'base_mod'
             for base_note in rbr_base_mod_notes:
-                found = False
-                for note in notes:
-                    if note.id >= 0:
-                        if note.id == base_note.id:
-                            found = True
-                            break
-                    elif note.name == base_note.name:
-                        found = True
-                        break
-
-                if not found:
-                    note = base_note
-                    popularity = self.get_popularity(note)
-                    for sound in note.sounds:
-                        error = ''
-                        if sound in note.sounds_mapped.values():
-                            from_sound = next((k for k, v in note.sounds_mapped.items() if v == sound), None)
-                            error = f'file mapped from {from_sound}'
-                        if sound in note.sounds_not_found:
-                            error = 'file missing'
-                        csv_writer.writerow([name, note.id, note.name, note.type, note.category, note.package, note.ini, note.sound_count, note.translation, sound, popularity, error])
-
-    def create_codriver(self, directory):
+                if base_note.id not in ids and base_note.name not in names:
+                    self.rbr_list_rows(csv_writer, name, base_note)
+
+    def rbr_list_rows(self, csv_writer, name, note : RbrPacenote):
+        popularity = self.get_popularity(note)
+        # mapped file: the first sound it was mapped from
+        mapped_from = {}
+        for from_sound, sound in note.sounds_mapped.items():
+            mapped_from.setdefault(sound, from_sound)
+        sounds_not_found = set(note.sounds_not_found)
+        for sound in note.sounds:
+            error = ''
+            if sound in mapped_from:
+                error = f'file mapped from {mapped_from[sound]}'
+            if sound in sounds_not_found:
+                error = 'file missing'
+            csv_writer.writerow([name, note.id, note.name, note.type, note.category, note.package, note.ini, note.sound_count, note.translation, sound, popularity, error])
+
+    def create_codriver(self, directory, jobs = 0, audio_cache : Optional[AudioCache] = None):
+        # the notes are added to the build in order, the sounds are built by run
+        build = CodriverBuild(Transcoder(jobs, audio_cache))
+
         # create the directory
         if not os.path.exists(directory):
             os.makedirs(directory)
@@ -822,23 +905,23 @@ class CoDriver:
 
             if note.no_rbr_note():
                 logging.error(f'No mapping for {note.type} - using original sound')
-                self.cc_copy_original_sounds(note.type, dst_path)
+                self.cc_copy_original_sounds(note.type, dst_path, build)
                 log_writer.writerow(note.as_dict())
                 continue
 
             if note.no_sound_in_rbr_note():
                 logging.error(f'No sounds for {note.type} in mapped note {note.rbr_note}')
-                self.cc_copy_original_sounds(note.type, dst_path)
+                self.cc_copy_original_sounds(note.type, dst_path, build)
                 log_writer.writerow(note.as_dict())
                 continue
 
             if note.sound_not_found():
                 logging.error(f'No sound found for {note.type} in mapped note {note.rbr_note}')
-                self.cc_copy_original_sounds(note.type, dst_path)
+                self.cc_copy_original_sounds(note.type, dst_path, build)
                 log_writer.writerow(note.as_dict())
                 continue
 
-            self.cc_copy_note(note, dst_path)
+            build.add_note(note, dst_path)
             log_writer.writerow(note.as_dict())
 
         for note in self.unmapped_base_mod_notes():
@@ -846,7 +929,10 @@ class CoDriver:
                 # prepend 'detail_' to the name
                 dst_path = os.path.join(directory, note.type)
                 log_writer.writerow(note.as_dict())
-                self.cc_copy_note(note, dst_path)
+                build.add_note(note, dst_path)
+
+        log_csv_file.flush()
+        build.run()
 
         if False:
             # find the note in our rbr_pacenote_plugins
@@ -880,10 +966,96 @@ class CoDriver:
 
         log_csv_file.close()
 
-def make_codriver(name, config, config_package = 'all', fallback_to_base = False):
+class CodriverBuild:
+    # The sounds of a codriver as a TaskGraph: each ogg is converted (a wav is
+    # used as it is), composed with its prefix and rushed in the audio cache
+    # (see RbrPacenote.add_wav_task), then placed into the codriver, then the
+    # subtitles.csv of a directory is written once all of its sounds are placed.
+    # The notes are added in order, so the random prefix sounds, the copies and
+    # the subtitles come out as in a build that copies one note after the other.
+
+    def __init__(self, transcoder : Transcoder):
+        self.transcoder = transcoder
+        self.graph = TaskGraph()
+        # destination file: task of the wav in the audio cache, the last note wins
+        self.places : Dict[str, tuple] = {}
+        # subtitles.csv: [row], the destination files it waits for and
+        # the original subtitles.csv it starts from
+        self.subtitles : Dict[str, list] = {}
+        self.subtitles_places : Dict[str, set] = {}
+        self.subtitles_originals : Dict[str, str] = {}
+
+    def add_note(self, note : MappedNote, dst_path):
+        if not os.path.exists(dst_path):
+            os.makedirs(dst_path)
+
+        cc_note = note.get_cc_note()
+        rbr_note = note.get_rbr_note()
+        prefix = None
+        if cc_note.prefix:
+            prefix = cc_note.prefix.notes[0]
+        (task, wave_file) = rbr_note.add_wav_task(self.graph, self.transcoder, note.file, prefix=prefix, rushed=cc_note.rushed)
+        # the cached file is named by its hash, the codriver gets the sound name
+        sound_file_basename = os.path.basename(wave_file)
+        destination = os.path.join(dst_path, sound_file_basename)
+        self.places[destination] = task
+        subtitles_file = os.path.join(dst_path, 'subtitles.csv')
+        self.subtitles.setdefault(subtitles_file, []).append([sound_file_basename, rbr_note.translation])
+        self.subtitles_places.setdefault(subtitles_file, set()).add(destination)
+
+    def add_file(self, src, dst_path):
+        # a file that is copied as it is, e.g. an original crew chief sound
+        destination = os.path.join(dst_path, os.path.basename(src))
+        if os.path.basename(src) == 'subtitles.csv':
+            # the copy replaces the subtitles of the notes added so far
+            self.subtitles[destination] = []
+            self.subtitles_places.setdefault(destination, set())
+            self.subtitles_originals[destination] = src
+            return
+        self.places[destination] = self.graph.add(('file', src), lambda: src)
+
+    def run(self):
+        for destination, task in self.places.items():
+            self.graph.add(('place', destination), functools.partial(place_sound, destination), task)
+        for subtitles_file, rows in self.subtitles.items():
+            places = [('place', destination) for destination in sorted(self.subtitles_places[subtitles_file])]
+            original = self.subtitles_originals.get(subtitles_file)
+            self.graph.add(('subtitles', subtitles_file), functools.partial(write_subtitles, subtitles_file, original, rows), *places)
+
+        errors = self.graph.run(self.transcoder.jobs)
+        if errors:
+            raise AudioError(f'{len(errors)} of {len(self.graph.tasks)} tasks of the build failed, e.g. {next(iter(errors.values()))}')
+
+
+def place_sound(destination, wave_fullname):
+    shutil.copy(wave_fullname, destination)
+
+
+def write_subtitles(subtitles_file, original, rows, *placed):
+    if original:
+        shutil.copy(original, subtitles_file)
+    # appends, the directory may have subtitles already
+    with open(subtitles_file, mode='a+', encoding='utf-8') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerows(rows)
+
+
+def codriver_packages(name, config, config_package = 'all'):
+    # (package config, plugin arguments for load_plugins) of a codriver
     config_codriver_packages = config['codrivers'][name]['packages']
     map_files = config['codrivers'][name].get('map_files', {})
     additional_sounds_dir = config['codrivers'][name].get('additional_sounds_dir', '')
+
+    if config_package != 'all':
+        # select only the package that is specified
+        config_codriver_packages = [ package for package in config_codriver_packages if package['type'] == config_package]
+    packages = []
+    for package in config_codriver_packages:
+        pacenote_dir_absolute = os.path.join(base_dir, package['base_dir'])
+        packages.append((package, (pacenote_dir_absolute, package['ini_files'], map_files, additional_sounds_dir)))
+    return packages
+
+def make_codriver(name, config, config_package = 'all', fallback_to_base = False, plugin_snapshots = True):
     map_static = config['codrivers'][name].get('map_static', {})
 
     codriver = CoDriver(
@@ -897,20 +1069,14 @@ def make_codriver(name, config, config_package = 'all', fallback_to_base = False
         pacenote_stats=config.get('pacenote_stats', {}),
     )
 
-    if config_package != 'all':
-        # select only the package that is specified
-        config_codriver_packages = [ package for package in config_codriver_packages if package['type'] == config_package]
-    for package in config_codriver_packages:
-        pacenote_dir_absolute = os.path.join(base_dir, package['base_dir'])
-        ini_files = package['ini_files']
+    packages = codriver_packages(name, config, config_package)
+    # plugins that are already loaded, e.g. by the base codriver, are shared
+    rbr_pacenote_plugins = load_plugins([plugin for package, plugin in packages], snapshots=plugin_snapshots)
+    for (package, plugin), rbr_pacenote_plugin in zip(packages, rbr_pacenote_plugins):
         map_rbr_ids = package.get('map_rbr_ids', {})
         # convert the keys to int
         # remove all keys that are note numeric
         map_rbr_ids = {int(k): v for k, v in map_rbr_ids.items() if k.isnumeric()}
-        rbr_pacenote_plugin = RbrPacenotePlugin(pacenote_dir_absolute,
-                                                ini_files=ini_files,
-                                                map_files=map_files,
-                                                additional_sounds_dir=additional_sounds_dir)
         codriver.add_pacenote_plugin(package['type'], rbr_pacenote_plugin, map_rbr_ids)
 
     return codriver
@@ -924,53 +1090,118 @@ if __name__ == '__main__':
     parser.add_argument('--codriver', help='Codriver in config.json', default='bollinger')
     parser.add_argument('--rbr-find-note-by-name', help='Find a note by name')
     parser.add_argument('--rbr-list-csv', action='store_true', help='List RBR pacenotes as CSV')
+    parser.add_argument('--rbr-include-graph', action='store_true', help='Show the ini include graph of the RBR pacenote plugins with parse times')
     parser.add_argument('--rbr-package', default='all', help='Only list pacenotes for a specific package, defaults to all')
     parser.add_argument('--roadbook-csv-default', action='store_true', help='Analyzes a Roabook file and creates a CSV file')
     parser.add_argument('--roadbook-csv-v2', action='store_true', help='Analyzes a Roabook file and creates a CSV file')
     parser.add_argument('--roadbook-csv-v3', action='store_true', help='Analyzes a Roabook file and creates a CSV file')
     parser.add_argument('--roadbook-name', default='/.*/', help='Which Roabook file to analyze, defaults to all')
+    parser.add_argument('--roadbooks', help='Roadbook directory or library, either a path or a key in config.json like roadbooks_v3')
+    parser.add_argument('--roadbook-export', help='Write the selected Roadbook files into one roadbook library file')
+    parser.add_argument('--roadbook-query', help='Query the Roadbook notes, e.g. "type 2061", "flag 64" or "type 2061 after type 2055 within 50"')
+    parser.add_argument('--roadbook-diff', nargs=2, metavar=('OLD', 'NEW'), help='Diff two Roadbook directories or libraries, paths or keys in config.json like roadbooks_v2 roadbooks_v3')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes for parsing Roadbook files, 0 uses all cores')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the Roadbook parse cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Clear the Roadbook parse cache before reading')
+    parser.add_argument('--no-plugin-cache', action='store_true', help='Always read the Pacenote plugins, do not use or write snapshots')
+    parser.add_argument('--stream', action='store_true', help='Write the Roadbook CSV stage by stage instead of reading all stages first, parses every stage twice with --no-cache')
     parser.add_argument('--create-codriver', help='Map RBR pacenotes to CC pacenotes and create folder structure')
+    parser.add_argument('--transcode-jobs', type=int, default=0, help='Number of parallel jobs (ffmpeg, rendering, copies) for --create-codriver, 0 uses all cores')
+    parser.add_argument('--audio-cache-size', type=int, default=1024, help='Size limit of the derived audio cache in MiB')
+    parser.add_argument('--audio-cache-stats', action='store_true', help='Show the size of the derived audio cache')
+    parser.add_argument('--audio-cache-prune', type=int, metavar='MIB', nargs='?', const=-1, help='Shrink the derived audio cache to MIB, defaults to --audio-cache-size')
     parser.add_argument('--codriver-fallback-to-base', action='store_true', help='Use sound from base codriver if not found')
     parser.add_argument('--map-to-cc-csv', action='store_true', help='Map RBR pacenotes to CC pacenotes and write to CSV')
 
     args = parser.parse_args()
+    if args.roadbook_query:
+        try:
+            parse_query(args.roadbook_query)
+        except ValueError as e:
+            parser.error(str(e))
 
     # read the configuration file, which is a json file
     config = json.load(open('config.json'))
 
-    if args.roadbook_csv_v2:
+    roadbook_dir = None
+    if args.roadbooks:
+        roadbook_dir = config.get(args.roadbooks, args.roadbooks)
+    elif args.roadbook_csv_v2:
         roadbook_dir = config['roadbooks_v2']
-        roadbooks = Roadbooks(roadbook_dir)
-        roadbooks.read_roadbooks(args.roadbook_name)
-        roadbooks.analyze_books()
+    elif args.roadbook_csv_default:
+        roadbook_dir = config['roadbooks']
+    elif args.roadbook_csv_v3:
+        roadbook_dir = config['roadbooks_v3']
+
+    if roadbook_dir or args.roadbook_diff:
+        roadbook_cache = None
+        if not args.no_cache:
+            roadbook_cache = RoadbookCache()
+            if args.rebuild_cache:
+                roadbook_cache.clear()
+
+    if args.roadbook_diff:
+        (old_dir, new_dir) = [config.get(x, x) for x in args.roadbook_diff]
+        old_roadbooks = open_roadbooks(old_dir, cache=roadbook_cache)
+        old_roadbooks.read_roadbooks(args.roadbook_name, jobs=args.jobs)
+        new_roadbooks = open_roadbooks(new_dir, cache=roadbook_cache)
+        new_roadbooks.read_roadbooks(args.roadbook_name, jobs=args.jobs)
+        roadbook_diff = RoadbookDiff(old_roadbooks, new_roadbooks)
+        roadbook_diff.diff_csv(jobs=args.jobs)
+        if roadbook_cache:
+            roadbook_cache.close()
         exit(0)
 
-    if args.roadbook_csv_default:
-        roadbook_dir = config['roadbooks']
-        roadbooks = Roadbooks(roadbook_dir)
-        roadbooks.read_roadbooks(args.roadbook_name)
-        roadbooks.analyze_books()
+    if roadbook_dir:
+        roadbooks = open_roadbooks(roadbook_dir, cache=roadbook_cache)
+        if args.roadbook_export:
+            roadbooks.read_roadbooks(args.roadbook_name, jobs=args.jobs)
+            write_roadbook_library(args.roadbook_export, roadbooks)
+        elif args.roadbook_query:
+            roadbooks.read_roadbooks(args.roadbook_name, jobs=args.jobs)
+            roadbook_index = RoadbookIndex(roadbooks)
+            roadbook_index.query_csv(args.roadbook_query)
+        elif args.stream:
+            roadbooks.stream_books(args.roadbook_name, jobs=args.jobs)
+        else:
+            roadbooks.read_roadbooks(args.roadbook_name, jobs=args.jobs)
+            roadbooks.analyze_books()
+        if roadbook_cache:
+            roadbook_cache.close()
         exit(0)
 
-    if args.roadbook_csv_v3:
-        roadbook_dir = config['roadbooks_v3']
-        roadbooks = Roadbooks(roadbook_dir)
-        roadbooks.read_roadbooks(args.roadbook_name)
-        roadbooks.analyze_books()
+    audio_cache = AudioCache(max_size=args.audio_cache_size * 1024 * 1024)
+    if args.audio_cache_stats or args.audio_cache_prune is not None:
+        if args.audio_cache_prune is not None:
+            audio_cache.prune(None if args.audio_cache_prune < 0 else args.audio_cache_prune * 1024 * 1024)
+        if args.audio_cache_stats:
+            print(json.dumps(audio_cache.stats(), indent=2))
         exit(0)
 
     codriver_name = args.codriver
-    codriver = make_codriver(codriver_name, config, args.rbr_package, fallback_to_base=args.codriver_fallback_to_base)
-
     rbr_base_mod = config['rbr_base_mod']
+    # read the distinct Pacenote trees of both codrivers in one process pool,
+    # make_codriver finds them in the plugin registry
+    load_plugins([plugin for package, plugin in
+                  codriver_packages(codriver_name, config, args.rbr_package) + codriver_packages(rbr_base_mod, config)],
+                 snapshots=not args.no_plugin_cache)
+    codriver = make_codriver(codriver_name, config, args.rbr_package, fallback_to_base=args.codriver_fallback_to_base,
+                             plugin_snapshots=not args.no_plugin_cache)
+
     rbr_base_package = config['rbr_base_package']
-    codriver_base = make_codriver(rbr_base_mod, config)
+    codriver_base = make_codriver(rbr_base_mod, config, plugin_snapshots=not args.no_plugin_cache)
 
     codriver.set_base_codriver(codriver_base, rbr_base_package)
 
     if args.rbr_list_csv:
         codriver.rbr_list_csv()
 
+    if args.rbr_include_graph:
+        for type, rbr_pacenote_plugin in codriver.rbr_pacenote_plugins.items():
+            print(f'{type}: {rbr_pacenote_plugin.plugin_dir}')
+            for line in rbr_pacenote_plugin.include_graph():
+                print(f'  {line}')
+
     if args.rbr_find_note_by_name:
         note = codriver.get_rbr_pacenote_by_name(args.rbr_find_note_by_name)
         if note:
@@ -984,4 +1215,6 @@ if __name__ == '__main__':
 
     if args.create_codriver:
         codriver.map_notes_from_cc()
-        codriver.create_codriver(args.create_codriver)
+        codriver.create_codriver(args.create_codriver, jobs=args.transcode_jobs, audio_cache=audio_cache)
+        audio_cache.prune()
+        logging.info(f'Audio cache: {audio_cache.hits} hits, {audio_cache.misses} misses')
@@ -1,82 +1,123 @@
 import configparser
+import hashlib
 import logging
 import os
+import pickle
 import random
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
+from audio import Transcoder, is_wav
+from cache import cache_dir
+from task_graph import TaskGraph
+
+# bump when the plugin state or the way it is read changes
+PLUGIN_SNAPSHOT_VERSION = 2
 
-class RbrPacenote:
-    def __init__(self, name):
-        self.name = name
-        self.id = -1
-        self.type = ''
-        self.category = ''
-        self.package = ''
-        self.ini = ''
-        self.sounds = []
-        self.sounds_not_found = []
-        self.sounds_mapped = {}
-        self.sound_count = 0
-        self.translation = ''
-        self.sounds_dir = ''
-
-    def sound_as_wav(self, sound, prefix: Optional['RbrPacenote'] = None, rushed: bool = False):
-        ogg = os.path.join(self.sounds_dir, sound)
-        if not os.path.exists(ogg):
-            raise FileNotFoundError(f'Not found: {ogg}')
 
+class RbrPacenote:
+    # Immutable record of a pacenote from the plugin ini files.
+    # Equality and the hash go by id, name, translation and the set of sounds,
+    # the hash is computed once, so the plugin sets stay cheap.
+    __slots__ = ('name', 'id', 'type', 'category', 'package', 'ini', 'sounds', 'sounds_not_found',
+                 'sounds_mapped', 'sound_count', 'translation', 'sounds_dir', '_hash')
+
+    def __init__(self, name, id=-1, type='', category='', package='', ini='',
+                 sounds=(), sounds_not_found=(), sounds_mapped=None, sound_count=0,
+                 translation='', sounds_dir=''):
+        init = super().__setattr__
+        init('name', sys.intern(name))
+        init('id', id)
+        init('type', sys.intern(type))
+        init('category', sys.intern(category))
+        init('package', sys.intern(package))
+        init('ini', sys.intern(ini))
+        init('sounds', tuple(sounds))
+        init('sounds_not_found', tuple(sounds_not_found))
+        init('sounds_mapped', dict(sounds_mapped or {}))
+        init('sound_count', sound_count)
+        init('translation', translation)
+        init('sounds_dir', sys.intern(sounds_dir))
+        init('_hash', hash((self.id, self.name, self.translation, frozenset(self.sounds))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'RbrPacenote is immutable, cannot set {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'RbrPacenote is immutable, cannot delete {name}')
+
+    def __reduce__(self):
+        return (RbrPacenote, (self.name, self.id, self.type, self.category, self.package, self.ini,
+                              self.sounds, self.sounds_not_found, self.sounds_mapped, self.sound_count,
+                              self.translation, self.sounds_dir))
+
+    def sound_as_wav(self, sound, prefix: Optional['RbrPacenote'] = None, rushed: bool = False,
+                     transcoder: Optional[Transcoder] = None):
+        # (path in the audio cache, file name for the codriver) of the wav,
+        # built by the tasks of add_wav_task in a graph of its own
+        graph = TaskGraph()
+        (task, wave_filename) = self.add_wav_task(graph, transcoder or Transcoder(), sound, prefix=prefix, rushed=rushed)
+        graph.run(jobs=1)
+        if task in graph.errors:
+            raise graph.errors[task]
+        return (graph.results[task], wave_filename)
+
+    def add_wav_task(self, graph: TaskGraph, transcoder: Transcoder, sound,
+                     prefix: Optional['RbrPacenote'] = None, rushed: bool = False):
+        # adds the tasks that build the wav of sound to graph, see sound_as_wav
+        # returns (task, file name for the codriver), the result of the task is
+        # the path in the audio cache, or the source itself if it is a wav
+        source = os.path.join(self.sounds_dir, sound)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f'Not found: {source}')
+
+        audio_cache = transcoder.cache
+        if is_wav(source):
+            task = graph.add(('file', source), lambda: source)
+        else:
+            transcoder.add(source)
+            task = graph.add(('ffmpeg', source), lambda: transcoder.convert(source))
         # replace .ogg with .wav
         wave_filename = sound.replace('.ogg', '.wav')
-        # check if the sound file exists
-        wave_fullname = os.path.join(self.sounds_dir, wave_filename)
-        if not os.path.exists(wave_fullname):
-            # convert the sound file from .ogg to .wav
-            # convert the sound file
-            logging.debug(f'Converting {ogg} to {wave_fullname}')
-            rv = os.system(f'ffmpeg -i "{ogg}" "{wave_fullname}"')
-            if rv != 0:
-                raise Exception(f'Error converting {ogg} to {wave_fullname}')
 
         if prefix:
-            # pick a random sound from the prefix
+            # pick a random sound from the prefix, while the tasks are added in order
             prefix_sound = random.choice(prefix.sounds)
-            prefix_wave_filename = prefix.sound_as_wav(prefix_sound)
-            prefix_wave_fullname = os.path.join(prefix.sounds_dir, prefix_wave_filename)
-            cmp_filename = f'{prefix.name}_{wave_filename.replace("/", "-")}'
-            cmp_fullname = os.path.join(self.sounds_dir, cmp_filename)
-            if not os.path.exists(cmp_fullname):
-                rv = os.system(f'sox "{prefix_wave_fullname}" "{wave_fullname}" "{cmp_fullname}"')
-                if rv != 0:
-                    raise Exception(f'Error merging {prefix_wave_filename} and {wave_filename} to {cmp_filename}')
-            wave_filename = cmp_filename
-            wave_fullname = cmp_fullname
+            (prefix_task, prefix_wave_filename) = prefix.add_wav_task(graph, transcoder, prefix_sound)
+            task = graph.add(('render', prefix_task, task),
+                             lambda prefix_wave_fullname, wave_fullname: audio_cache.render([prefix_wave_fullname, wave_fullname]),
+                             prefix_task, task)
+            wave_filename = f'{prefix.name}_{wave_filename.replace("/", "-")}'
 
         if rushed:
-            factor = random.uniform(1.1, 1.5)
-            rushed_filename = f'rushed_{wave_filename}'.replace("/", "-")
-            rushed_fullname = os.path.join(self.sounds_dir, rushed_filename)
-            if not os.path.exists(rushed_fullname):
-                rv = os.system(f'sox "{wave_fullname}" "{rushed_fullname}" tempo {factor}')
-                if rv != 0:
-                    raise Exception(f'Error rushing {wave_filename} to {rushed_filename}')
-            wave_filename = rushed_filename
+            def rush(wave_fullname):
+                factor = audio_cache.random(wave_fullname).uniform(1.1, 1.5)
+                return audio_cache.render([wave_fullname], tempo=factor)
+            task = graph.add(('rushed', task), rush, task)
+            wave_filename = f'rushed_{wave_filename}'.replace("/", "-")
 
-        return wave_filename
+        return (task, wave_filename)
 
     def __str__(self):
-        return f'{self.id}: {self.name} - T: {self.type} - C: {self.category} - P: {self.package} - Sounds: {self.sounds} - Translation: {self.translation} - Ini: {self.ini}'
+        return f'{self.id}: {self.name} - T: {self.type} - C: {self.category} - P: {self.package} - Sounds: {list(self.sounds)} - Translation: {self.translation} - Ini: {self.ini}'
 
     def __repr__(self):
-        return f'{self.id}: {self.name} - T: {self.type} - C: {self.category} - P: {self.package} - Sounds: {self.sounds} - Translation: {self.translation} - Ini: {self.ini}'
+        return f'{self.id}: {self.name} - T: {self.type} - C: {self.category} - P: {self.package} - Sounds: {list(self.sounds)} - Translation: {self.translation} - Ini: {self.ini}'
 
     def __hash__(self) -> int:
-        str = f'{self.id}: {self.name} - Sounds: {self.sounds.sort()} - Translation: {self.translation}'
-        return hash(str)
+        return self._hash
 
     def __eq__(self, other):
         if not isinstance(other, RbrPacenote):
             return False
 
+        if self is other:
+            return True
+        if self._hash != other._hash:
+            return False
         if self.name != other.name:
             return False
         if self.id != other.id:
@@ -124,18 +165,36 @@ class RbrPacenotePlugin:
                  map_files = {},
                  additional_sounds_dir = ''):
         self.pacenotes = set()
+        # id -> notes, lower case name -> notes, kept in sync by add_pacenote
+        self.pacenotes_by_id = {}
+        self.pacenotes_by_name = {}
         # self.ini_file = ini_file
         # base_dir is the directory of this file + ini_file
         self.plugin_dir = plugin_dir
         self.map_files = map_files
         self.additional_sounds_dir = additional_sounds_dir
+        # language file -> strings, (category, ini) -> merged strings of the fallback chain
+        self.language_strings = {}
+        self.translation_index = {}
+        # scanned sound directories and the files in them, see scan_sounds
+        self.sound_roots = []
+        self.sound_links = []
+        self.sound_files = set()
+        # path -> mtime_ns (None if missing) of everything read, see read_snapshot
+        self.dependencies = {}
+        # ini file -> parsed ConfigParser while reading, see parse_ini
+        self.parsed_ini = {}
+        # the includes in the order they were walked, see include_graph
+        self.includes = []
 
         # make sure the plugin_dir is a directory
         if not os.path.isdir(plugin_dir):
             logging.error(f'Not a directory: {plugin_dir}')
+            self.depend(plugin_dir)
             return
 
         ini_file = os.path.join(plugin_dir, 'PaceNote.ini')
+        self.depend(ini_file)
         # make sure the ini_file exists
         if not os.path.exists(ini_file):
             logging.error(f'Not found: {ini_file}')
@@ -156,12 +215,22 @@ class RbrPacenotePlugin:
         logging.debug(f'language: {self.language}')
         logging.debug(f'sounds: {self.sounds}')
 
+        self.scan_sounds()
+
         for ini_file in ini_files:
             ini_file = os.path.join(plugin_dir, 'config', 'pacenotes', ini_file)
             self.read_ini(ini_file)
 
         ini_file = os.path.join(plugin_dir, 'config', 'ranges', 'Rbr.ini')
         self.read_ini(ini_file)
+        # only needed while reading
+        self.parsed_ini = {}
+
+    def depend(self, path):
+        try:
+            self.dependencies[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            self.dependencies[path] = None
 
     def sound_file(self, sound):
         return os.path.join(self.sounds_dir(), sound)
@@ -169,7 +238,57 @@ class RbrPacenotePlugin:
     def sounds_dir(self):
         return os.path.join(self.plugin_dir, 'sounds', self.sounds)
 
-    def add_translation(self, note):
+    def scan_sounds(self):
+        # One scandir walk over the sounds directory and the additional sounds
+        # directory, so read_ini does not stat every sound and variant on its own.
+        # The paths are kept normcased, Windows finds sound.ogg as Sound.OGG too.
+        self.sound_roots = []
+        self.sound_links = []
+        self.sound_files = set()
+        roots = [self.sounds_dir()]
+        if self.additional_sounds_dir:
+            roots.append(self.sound_file(self.additional_sounds_dir))
+        for root in roots:
+            root = os.path.normcase(os.path.normpath(root))
+            if any(self.in_sound_root(root, x) for x in self.sound_roots):
+                continue
+            self.sound_roots.append(root)
+            self.scan_dir(root)
+        logging.debug(f'Found {len(self.sound_files)} files in {self.sound_roots}')
+
+    def scan_dir(self, directory):
+        # a new or removed sound changes the mtime of its directory
+        self.depend(directory)
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                path = os.path.normcase(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    self.scan_dir(path)
+                elif entry.is_symlink() and entry.is_dir():
+                    # not walked, it may link back to a parent, sound_exists stats
+                    # the sounds below it
+                    self.sound_links.append(path)
+                elif entry.is_file():
+                    self.sound_files.add(path)
+
+    @staticmethod
+    def in_sound_root(path, root):
+        return path == root or path.startswith(root + os.sep)
+
+    def sound_exists(self, sound):
+        sound_file = os.path.normcase(os.path.normpath(self.sound_file(sound)))
+        if (any(self.in_sound_root(sound_file, x) for x in self.sound_roots)
+                and not any(self.in_sound_root(sound_file, x) for x in self.sound_links)):
+            return sound_file in self.sound_files
+        # somewhere outside of the scanned directories, e.g. ../../other/sound.ogg
+        self.depend(sound_file)
+        return self.dependencies[sound_file] is not None
+
+    def translate(self, name, category, ini):
         # ; So, if the plugin searches for a string to translate, e.g. ONE_LEFT
         # ; initially defined in the "cat1.ini" file in the "packages/category1"
         # ; directory, it searches for a file with an identical name, "cat1.ini", in
@@ -186,29 +305,42 @@ class RbrPacenotePlugin:
         # ; alternative or for convenience.
         # ; The above structure should be seen as an example. No need to create all
         # ; those files.
-        files = [
-            os.path.join('pacenotes', 'packages', note.category.lower(), f'{note.ini}'),
-            os.path.join('pacenotes', 'packages', note.category.lower(), 'strings.ini'),
-            os.path.join('pacenotes', 'packages', 'strings.ini'),
-            os.path.join('pacenotes', 'strings.ini'),
-        ]
-        for file in files:
-            file = os.path.join(self.plugin_dir, 'language', self.language, file)
-            strings = self.strings(file)
-            if strings and note.name in strings:
-                note.translation = strings[note.name]
-                # logging.debug(f'Translation: {note.name} -> {note.translation}')
-                return
-
-        if not note.translation:
-            if note.name.isnumeric():
-                note.translation = note.name
-            else:
-                logging.error(f'No translation for: {note.name}')
-            # exit(1)
-        # logging.debug(f'add_translation: {note}')
+        translation = self.translations(category, ini).get(name)
+        if translation:
+            return translation
+
+        if name.isnumeric():
+            return name
+        logging.error(f'No translation for: {name}')
+        return ''
+
+    def translations(self, category, ini):
+        # All strings a note of category and ini can be translated with.
+        # The files of the search order above are merged once, the first file wins,
+        # so every lookup after that is a dict get.
+        key = (category.lower(), ini)
+        if key not in self.translation_index:
+            files = [
+                os.path.join('pacenotes', 'packages', key[0], ini),
+                os.path.join('pacenotes', 'packages', key[0], 'strings.ini'),
+                os.path.join('pacenotes', 'packages', 'strings.ini'),
+                os.path.join('pacenotes', 'strings.ini'),
+            ]
+            translations = {}
+            for file in reversed(files):
+                file = os.path.join(self.plugin_dir, 'language', self.language, file)
+                translations.update(self.cached_strings(file))
+            self.translation_index[key] = translations
+        return self.translation_index[key]
+
+    def cached_strings(self, file):
+        # every language file is parsed only once per plugin
+        if file not in self.language_strings:
+            self.language_strings[file] = self.strings(file) or {}
+        return self.language_strings[file]
 
     def strings(self, file):
+        self.depend(file)
         if not os.path.exists(file):
             # logging.debug(f'Not found: {file}')
             return
@@ -236,20 +368,53 @@ class RbrPacenotePlugin:
         return strings
 
 
-    def read_ini(self, ini_file = '', recursion = 0, category = '', package = ''):
+    def parse_ini(self, ini_file):
+        # (config, seconds it took to parse), seconds is None if it was parsed before
+        if ini_file in self.parsed_ini:
+            return (self.parsed_ini[ini_file], None)
+        start = time.perf_counter()
+        config = configparser.ConfigParser(strict=False)
+        config.read(ini_file)
+        self.parsed_ini[ini_file] = config
+        return (config, time.perf_counter() - start)
+
+    def include_graph(self):
+        # the walk of read_ini as an indented tree, with the parse time of every file,
+        # or 'from snapshot' if the plugin was not read in this process
+        lines = []
+        for recursion, short_file, package, category, status in self.includes:
+            if isinstance(status, float):
+                status = f'{status * 1000:.2f} ms'
+            lines.append(f'{"  " * recursion}{short_file} [{package}/{category}] {status}')
+        return lines
+
+    def read_ini(self, ini_file = '', recursion = 0, category = '', package = '', including = ()):
+        # Reads the pacenotes of ini_file and the files it includes.
+        # Every file is parsed once, an include that is read again, e.g. from
+        # another package, reuses the parsed file with its own package and
+        # category. Including a file that is currently being read is a cycle
+        # and is skipped.
+        short_file = os.path.relpath(ini_file, self.plugin_dir)
+        self.depend(ini_file)
         # make sure the ini_file exists
         if not os.path.exists(ini_file):
             logging.error(f'Not found: {ini_file}')
+            self.includes.append((recursion, short_file, package, category, 'not found'))
+            return
+        real_file = os.path.realpath(ini_file)
+        if real_file in including:
+            logging.error(f'Include cycle: {" -> ".join(including + (real_file,))}')
+            self.includes.append((recursion, short_file, package, category, 'cycle'))
             return
 
-        short_file = ini_file.replace(self.plugin_dir, '')
         # logging.debug("%sfile: %s" % (recursion * "\t", short_file))
         logging.debug("file: %s" % ( short_file))
         current_base_dir = os.path.dirname(ini_file)
         ini_filename = os.path.basename(ini_file)
+        including = including + (real_file,)
 
-        config = configparser.ConfigParser(strict=False)
-        config.read(ini_file)
+        (config, seconds) = self.parse_ini(real_file)
+        self.includes.append((recursion, short_file, package, category, 'parsed before' if seconds is None else seconds))
         # check if the file is valid
         if len(config.sections()) == 0:
             logging.error("Invalid file: %s" % ini_file)
@@ -270,51 +435,176 @@ class RbrPacenotePlugin:
                         self.read_ini(file,
                                       recursion + 1,
                                       package=package,
-                                      category=category)
+                                      category=category,
+                                      including=including)
 
             if section.startswith('PACENOTE') or section.startswith('RANGE'):
                 (type, name) = section.split('::')
-                note = RbrPacenote(name.lower())
-                note.ini = ini_filename
-                note.type = type
-                note.category = category
-                note.package = package
-                note.id = config.getint(section, 'id', fallback=-1)
-                note.sounds_dir = self.sounds_dir()
-                if not note.id and note.type == 'PACENOTE':
+                name = name.lower()
+                id = config.getint(section, 'id', fallback=-1)
+                if not id and type == 'PACENOTE':
                     logging.debug(f'No id in {section}')
-                note.sound_count = config.getint(section, 'Sounds', fallback=-1)
+                sound_count = config.getint(section, 'Sounds', fallback=-1)
+                sounds = []
+                sounds_not_found = []
+                sounds_mapped = {}
                 for option in config.options(section):
                     if option.startswith('snd'):
                         sound = config.get(section, option)
                         # map the sound file
                         if sound in self.map_files:
                             new_file = self.map_files[sound]
-                            note.sounds_mapped[sound] = new_file
+                            sounds_mapped[sound] = new_file
                             sound = new_file
                         # check if the sound file exists
-                        sound_file = self.sound_file(sound)
-                        if not os.path.exists(sound_file):
-                            logging.error(f'Not found: {sound_file}')
-                            note.sounds_not_found.append(sound)
-                        note.sounds.append(sound)
+                        if not self.sound_exists(sound):
+                            logging.error(f'Not found: {self.sound_file(sound)}')
+                            sounds_not_found.append(sound)
+                        sounds.append(sound)
                         # check additional sounds directory
                         if self.additional_sounds_dir:
                             # split the extension off the sound file
                             sound_base, ext = os.path.splitext(sound)
                             for i in range(0, 5):
                                 add_sound = os.path.join(self.additional_sounds_dir, f'{sound_base}_{i}{ext}')
-                                sound_file = self.sound_file(add_sound)
-                                if os.path.exists(sound_file):
-                                    note.sounds.append(add_sound)
-                                    logging.debug(f'Additional sound: {sound_file}')
+                                if self.sound_exists(add_sound):
+                                    sounds.append(add_sound)
+                                    logging.debug(f'Additional sound: {self.sound_file(add_sound)}')
+
+                note = RbrPacenote(name,
+                                   id=id,
+                                   type=type,
+                                   category=category,
+                                   package=package,
+                                   ini=ini_filename,
+                                   # sorted, like the old hash left them as a side effect
+                                   sounds=sorted(sounds),
+                                   sounds_not_found=sounds_not_found,
+                                   sounds_mapped=sounds_mapped,
+                                   sound_count=sound_count,
+                                   translation=self.translate(name, category, ini_filename),
+                                   sounds_dir=self.sounds_dir())
                 if note.sound_count != len(note.sounds):
                     logging.error(f'Invalid sound count: {note.sound_count} - {note}')
 
-                self.add_translation(note)
                 # only add the pacenote if it has sounds
                 if len(note.sounds) > 0:
-                    self.pacenotes.add(note)
+                    self.add_pacenote(note)
+
+    def add_pacenote(self, note):
+        if note in self.pacenotes:
+            return
+        self.pacenotes.add(note)
+        self.pacenotes_by_id.setdefault(note.id, []).append(note)
+        self.pacenotes_by_name.setdefault(note.name.lower(), []).append(note)
+
+    def pacenotes_with_id(self, id):
+        return list(self.pacenotes_by_id.get(id, []))
+
+    def pacenotes_with_name(self, name):
+        return list(self.pacenotes_by_name.get(name.lower(), []))
+
+# Process wide registry of loaded plugins, a codriver and the base codriver
+# often use the same Pacenote trees.
+plugin_registry = {}
+plugin_registry_lock = threading.Lock()
+
+
+def plugin_key(plugin_dir, ini_files, map_files, additional_sounds_dir):
+    return (os.path.abspath(plugin_dir), tuple(ini_files), tuple(sorted(map_files.items())), additional_sounds_dir)
+
+
+def snapshot_filename(key):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir('plugins'), f'{digest}.pickle')
+
+
+def read_snapshot(key):
+    # The plugin state saved by write_snapshot, as long as none of the files and
+    # directories it was read from changed. None if there is no valid snapshot.
+    filename = snapshot_filename(key)
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f'Invalid plugin snapshot {filename}: {e}')
+        return None
+
+    if snapshot.get('version') != PLUGIN_SNAPSHOT_VERSION or snapshot.get('key') != key:
+        return None
+    plugin = snapshot['plugin']
+    for path, mtime_ns in plugin.dependencies.items():
+        try:
+            current = os.stat(path).st_mtime_ns
+        except OSError:
+            current = None
+        if current != mtime_ns:
+            logging.debug(f'Plugin snapshot outdated by {path}')
+            return None
+    logging.debug(f'Plugin snapshot {filename} for {key[0]}')
+    # the parse times are those of the run that wrote the snapshot, nothing was parsed now
+    plugin.includes = [(recursion, short_file, package, category, 'from snapshot' if isinstance(status, float) else status)
+                       for recursion, short_file, package, category, status in plugin.includes]
+    return plugin
+
+
+def write_snapshot(key, plugin):
+    filename = snapshot_filename(key)
+    snapshot = {'version': PLUGIN_SNAPSHOT_VERSION, 'key': key, 'plugin': plugin}
+    try:
+        with open(f'{filename}.tmp', 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{filename}.tmp', filename)
+    except OSError as e:
+        logging.warning(f'Cannot write plugin snapshot {filename}: {e}')
+
+
+def load_plugin(plugin_dir, ini_files = ["Rbr.ini", "Rbr-Enhanced.ini"], map_files = {}, additional_sounds_dir = '',
+                snapshots = True):
+    # the RbrPacenotePlugin for these arguments, only read once per process
+    # and with snapshots only read again when one of its files changed
+    key = plugin_key(plugin_dir, ini_files, map_files, additional_sounds_dir)
+    with plugin_registry_lock:
+        plugin = plugin_registry.get(key)
+    if plugin is not None:
+        return plugin
+
+    if snapshots:
+        plugin = read_snapshot(key)
+    if plugin is None:
+        plugin = RbrPacenotePlugin(plugin_dir,
+                                   ini_files=list(ini_files),
+                                   map_files=dict(map_files),
+                                   additional_sounds_dir=additional_sounds_dir)
+        if snapshots:
+            write_snapshot(key, plugin)
+    with plugin_registry_lock:
+        return plugin_registry.setdefault(key, plugin)
+
+
+def load_plugins(plugins, snapshots = True, jobs = 0):
+    # plugins is a list of (plugin_dir, ini_files, map_files, additional_sounds_dir),
+    # returns the plugins in the same order. The distinct plugins that are not
+    # loaded yet are read in a process pool, reading is configparser work that
+    # threads do not speed up, the pickled plugins go into the registry.
+    # jobs = 0 uses all cores, jobs = 1 reads them one after the other.
+    missing = {}
+    for args in plugins:
+        key = plugin_key(*args)
+        if key not in plugin_registry:
+            missing.setdefault(key, args)
+    if jobs != 1 and len(missing) > 1:
+        workers = min(jobs or os.cpu_count() or 1, len(missing))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {key: executor.submit(load_plugin, *args, snapshots=snapshots) for key, args in missing.items()}
+            for key, future in futures.items():
+                plugin = future.result()
+                with plugin_registry_lock:
+                    plugin_registry.setdefault(key, plugin)
+    return [load_plugin(*args, snapshots=snapshots) for args in plugins]
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
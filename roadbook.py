@@ -1,9 +1,13 @@
-import configparser
+import array
+import codecs
 import csv
+import hashlib
 import logging
 import os
 import re
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Note:
@@ -12,7 +16,9 @@ class Note:
     # distance = 0.00001
     # flag = 0
 
-    flags = {
+    __slots__ = ('type', 'distance', 'flag')
+
+    flag_values = {
         "None": 0x00,
         "Narrows": 0x01,
         "WideOut": 0x02,
@@ -23,8 +29,7 @@ class Note:
         "Cut": 0x40,
         "TightensBad": 0x80,
         "x3": 0x0100,
-        "x4": 0x0100,
-        "x5": 0x0200,
+        "x4": 0x0200,
         "Long": 0x0400,
         "x6": 0x0800,
         "x7": 0x1000,
@@ -62,159 +67,381 @@ class Note:
         "Maybe": 0x2000,
     }
 
-
     def __init__(self, type, distance, flag):
         self.type = type
         self.distance = distance
         self.flag = flag
-        self.flags = self.parse_flag(flag)
 
-    def parse_flag(self, flag_value):
-        # Parse the flags
-        set_flags = {name for name, value in self.flags.items() if flag_value & value}
-        named_set_flags = {name for name, value in self.named_flags.items() if flag_value & value}
+    @property
+    def flags(self):
+        return self.parse_flag(self.flag)
 
+    @staticmethod
+    def parse_flag(flag_value):
+        # only the low 16 bits are used by the roadbooks, those come from the tables
+        set_flags = FLAG_TABLE_LOW[flag_value & 0xff] | FLAG_TABLE_HIGH[(flag_value >> 8) & 0xff]
+        if flag_value > 0xffff:
+            set_flags |= {name for name, value in Note.flag_values.items() if flag_value & value > 0xffff}
         return set_flags
 
     def print_flags_in_binary(self):
-        for name, value in self.flags.items():
+        for name, value in self.flag_values.items():
             print(f"{name}: {format(value, 'b')}")
 
 
-
-    # def parse_flag(self, flag):
-    #     # flag is a bitfield
-    #     # get all bits up to 16384
-    #     flags = set()
-    #     for i in range(15):
-    #         if flag & (1 << i):
-    #             flags.add(1 << i)
-    #     return flags
+def flag_table(shift):
+    # the flag names for each value of one byte of the flag
+    names = [(name, value >> shift) for name, value in Note.flag_values.items()
+             if value and value >> shift and value >> shift <= 0xff]
+    return tuple(frozenset(name for name, value in names if byte & value) for byte in range(256))
+
+
+FLAG_TABLE_LOW = flag_table(0)
+FLAG_TABLE_HIGH = flag_table(8)
+
+
+# byte order marks we know of, everything else is read as cp1252
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# key = value or key: value, like configparser does it
+OPTION = re.compile(rb'(.*?)\s*[=:]\s*(.*)')
+
+
+def sniff_encoding(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    return 'cp1252'
+
+
+def parse_pacenotes(data):
+    # Single pass tokenizer for the roadbook ini files.
+    # Returns (count, [(id, type, distance, flag), ...]) in section order.
+    # Duplicate sections and options behave like configparser(strict=False):
+    # they are merged and the last value wins. The options of [DEFAULT] apply
+    # to every section and an indented line continues the option before it,
+    # like in configparser, so such a value is no number and the note is invalid.
+    encoding = sniff_encoding(data)
+    if encoding != 'cp1252':
+        # all we care about is ascii, so go back to bytes once
+        data = data.decode(encoding).encode('utf-8')
+
+    defaults = {}
+    pacenotes = None
+    sections = {}
+    options = None
+    # (options, key, indent) of the last option, for continuation lines
+    option = None
+    for line in data.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] in b'#;':
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        if option and indent > option[2]:
+            (option_options, key, option_indent) = option
+            option_options[key] += b'\n' + stripped
+            continue
+        option = None
+
+        if stripped[0] == 0x5b:  # [
+            end = stripped.rfind(b']')
+            header = stripped[1:end] if end > 1 else b''
+            if header == b'DEFAULT':
+                options = defaults
+            elif header == b'PACENOTES':
+                pacenotes = pacenotes if pacenotes is not None else {}
+                options = pacenotes
+            elif header[:1] == b'P' and header[1:].isdigit():
+                options = sections.setdefault(header, {})
+            else:
+                options = None
+            continue
+
+        if options is None:
+            continue
+
+        match = OPTION.match(stripped)
+        if match:
+            key = match.group(1).lower()
+            options[key] = match.group(2)
+            option = (options, key, indent)
+
+    count = 0
+    if pacenotes is not None:
+        count = int({**defaults, **pacenotes}.get(b'count', 0))
+    notes = []
+    for header, options in sections.items():
+        options = {**defaults, **options}
+        try:
+            notes.append((int(header[1:]),
+                          int(options[b'type']),
+                          float(options[b'distance']),
+                          int(options[b'flag'])))
+        except (KeyError, ValueError) as e:
+            logging.error(f'Invalid pacenote {header.decode()}: {e}')
+    return count, notes
 
 
 class Roadbook:
-    def __init__(self, filename):
-        self.notes = {}
-        self.read_ini(filename)
+    def __init__(self, filename=None):
+        # the notes are stored as columns, one entry per note
+        self.ids = array.array('i')
+        self.types = array.array('i')
+        self.distances = array.array('d')
+        self.flags = array.array('i')
+        self.num_notes = 0
+        # what the notes were read from, used by the RoadbookCache
+        self.size = -1
+        self.mtime_ns = -1
+        self.digest = b''
+        if filename:
+            self.read_ini(filename)
+
+    @classmethod
+    def from_columns(cls, ids, types, distances, flags, num_notes=0):
+        book = cls()
+        book.ids = ids
+        book.types = types
+        book.distances = distances
+        book.flags = flags
+        book.num_notes = num_notes
+        return book
 
     def read_ini(self, filename):
-        config = configparser.ConfigParser(strict=False)
-        encoding = 'utf-8'
-        encoding = 'cp1252'
         logging.info(f"Reading {filename}")
-        try:
-            config.read(filename, encoding=encoding)
-        except Exception as e:
-            logging.error(f'Error reading {filename}: {e}')
-            # work around for configparser not handling utf-8
-            with open(filename, 'r', encoding=encoding) as f:
-                content = f.read()
-            # remove the BOM
-            content = content.replace('\ufeff', '')
-            config.read_string(content)
-
-        for section in config.sections():
-            if section == 'PACENOTES':
-                self.num_notes = config.getint(section, 'count')
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.digest = hashlib.sha1(data).digest()
+
+        self.num_notes, notes = parse_pacenotes(data)
+        rows = {}
+        for note_id, note_type, distance, flag in notes:
+            # the high notes are not interesting
+            if note_type > 6_000_000:
                 continue
 
-            if section.startswith('P'):
-                note = Note(config.getint(section, 'type'),
-                            config.getfloat(section, 'distance'),
-                            config.getint(section, 'flag'))
+            if flag > 65_000:
+                flag = 0
 
-                # the high notes are not interesting
-                if note.type > 6_000_000:
-                    continue
+            rows[note_id] = (note_type, distance, flag)
 
-                if note.flag > 65_000:
-                    note.flag = 0
+        self.ids.extend(rows.keys())
+        for note_type, distance, flag in rows.values():
+            self.types.append(note_type)
+            self.distances.append(distance)
+            self.flags.append(flag)
 
-                note_id = int(section[1:])
-                self.notes[note_id] = note
+    @property
+    def notes(self):
+        # Note objects are built on request only, the analysis works on the columns
+        return {note_id: Note(note_type, distance, flag)
+                for note_id, note_type, distance, flag
+                in zip(self.ids, self.types, self.distances, self.flags)}
 
-    def get_notes(self, note_type):
-        notes = []
-        for note_id, note in self.notes.items():
-            if note.type == note_type:
-                notes.append(note)
-        return notes
+    def type_counts(self):
+        # histogram of the note types in one pass
+        return Counter(self.types)
 
-    def get_notes_flag(self, note_flag):
-        notes = []
-        for note_id, note in self.notes.items():
-            if note.flag == note_flag:
-                notes.append(note)
-        return notes
+    def flag_counts(self):
+        # histogram of the note flags in one pass
+        return Counter(self.flags)
 
     def note_types(self):
-        types = set()
-        for note in self.notes.values():
-            types.add(note.type)
-        return types
+        return set(self.types)
 
     def note_flags(self):
+        # the names are only decoded here, once per distinct flag value
         flags = set()
-        for note in self.notes.values():
-            flags |= note.flags
+        for flag in set(self.flags):
+            flags |= Note.parse_flag(flag)
         return flags
 
+    def flag_bits(self):
+        # all bits that are set in any of the flags
+        bits = 0
+        for flag in set(self.flags):
+            bits |= flag
+        return {1 << i for i in range(bits.bit_length()) if bits & (1 << i)}
+
+def roadbook_name_matcher(name):
+    # --roadbook-name is either a file name or a /regex/
+    if name.startswith('/'):
+        regex = name.lstrip('/')
+        regex = regex.rstrip('/')
+        regex = re.compile(regex)
+        return lambda file: bool(regex.match(file))
+    return lambda file: file == name
+
+
 class Roadbooks:
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         self.base_path = path
         self.books = {}
+        # optional RoadbookCache, only new or changed stages are parsed
+        self.cache = cache
 
-    def read_roadbooks(self, name):
-        # recurse into self.base_path
-        logging.info(f"Analyzing {name}")
-        if name.startswith('/'):
-            # name is a regex
-            regex = name.lstrip('/')
-            regex = regex.rstrip('/')
-            name = re.compile(regex)
+    def find_roadbooks(self, name):
+        # recurse into self.base_path, returns [(file, filename), ...] in walk order
+        name_matches = roadbook_name_matcher(name)
+        roadbooks = []
         for root, dirs, files in os.walk(self.base_path):
             for file in files:
-                if name == file or (isinstance(name, re.Pattern) and name.match(file)):
-                    if file.endswith('.ini'):
-                        self.read_roadbook(file, os.path.join(root, file))
+                if name_matches(file) and file.endswith('.ini'):
+                    roadbooks.append((file, os.path.join(root, file)))
+        return roadbooks
+
+    def read_roadbooks(self, name, jobs=1):
+        logging.info(f"Analyzing {name}")
+        roadbooks = self.find_roadbooks(name)
+        books = self.load_roadbooks([filename for file, filename in roadbooks], jobs=jobs)
+        # insert in walk order, so self.books ends up the same for any number of jobs
+        for (file, filename), book in zip(roadbooks, books):
+            self.books[file] = book
+
+    def load_roadbooks(self, filenames, jobs=1):
+        books = list(self.iter_roadbooks(filenames, jobs=jobs))
+        if self.cache:
+            self.cache.commit()
+        return books
+
+    def iter_roadbooks(self, filenames, jobs=1):
+        # yields the books in the order of filenames
+        # cached stages are not parsed again, the others are parsed serial or in a process pool
+        cached = [bool(self.cache) and self.cache.contains(filename) for filename in filenames]
+        missing = [filename for filename, is_cached in zip(filenames, cached) if not is_cached]
+        if jobs == 1 or len(missing) < 2:
+            for filename in filenames:
+                yield self.load_roadbook(filename)
+            return
+
+        # jobs = 0 uses all cores
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(missing) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = executor.map(Roadbook, missing, chunksize=chunksize)
+            for filename, is_cached in zip(filenames, cached):
+                if is_cached:
+                    yield self.load_roadbook(filename)
+                    continue
+                book = next(parsed)
+                if self.cache:
+                    self.cache.put(filename, book)
+                yield book
+
+    def load_roadbook(self, filename):
+        book = None
+        if self.cache:
+            book = self.cache.get(filename)
+        if book is None:
+            book = Roadbook(filename)
+            if self.cache:
+                self.cache.put(filename, book)
+        return book
 
     def read_roadbook(self, name, filename):
-        book = Roadbook(filename)
-        self.books[name] = book
+        self.books[name] = self.load_roadbook(filename)
+        if self.cache:
+            self.cache.commit()
 
-    def analyze_books(self):
-        # get all note types
+    def note_columns(self):
+        # all note types and flag bits of self.books
         note_types = set()
         note_flags = set()
         for book in self.books.values():
             note_types |= book.note_types()
-            note_flags |= book.note_flags()
-
-        row = ['name']
-        note_types_list = sorted(list(note_types))
-        note_flags_list = sorted(list(note_flags))
-        row.extend(note_types_list)
-        # prepend 'flag_' to note_flags
-        note_flags_list = [f'flag_{x}' for x in note_flags_list]
-        row.extend(note_flags_list)
+            note_flags |= book.flag_bits()
+        return (note_types, note_flags)
 
+    def analyze_books(self):
+        (note_types, note_flags) = self.note_columns()
         csv_writer = csv.writer(sys.stdout)
+        (row, note_types_list, note_flags_list) = self.analysis_header(note_types, note_flags)
         csv_writer.writerow(row)
 
         books = self.books.items()
         # sort by name
         books = sorted(books, key=lambda x: x[0])
         for name, book in books:
-            row = []
-            row.append(name)
-            for note_type in note_types_list:
-                book_note_types = book.get_notes(note_type)
-                row.append(len(book_note_types))
-            for note_flag in note_flags_list:
-                note_flag_id = int(note_flag[5:])
-                book_note_flags = book.get_notes_flag(note_flag_id)
-                row.append(len(book_note_flags))
-            csv_writer.writerow(row)
+            csv_writer.writerow(self.analysis_row(name, book, note_types_list, note_flags_list))
+
+    def stream_books(self, name, jobs=1):
+        # Same CSV as read_roadbooks + analyze_books, but the stages are not kept.
+        # The columns come from a first pass, which is answered by the column
+        # index of the cache if there is one, then every stage is parsed,
+        # written and dropped. Without a cache every stage is parsed twice.
+        logging.info(f"Streaming {name}")
+        # the last file with a name wins, like in self.books
+        roadbooks = dict(self.find_roadbooks(name))
+        names = sorted(roadbooks.keys())
+        filenames = [roadbooks[name] for name in names]
+
+        (note_types, note_flags) = self.column_index(filenames, jobs=jobs)
+        csv_writer = csv.writer(sys.stdout)
+        (row, note_types_list, note_flags_list) = self.analysis_header(note_types, note_flags)
+        csv_writer.writerow(row)
+        sys.stdout.flush()
+
+        for book_name, book in zip(names, self.iter_roadbooks(filenames, jobs=jobs)):
+            csv_writer.writerow(self.analysis_row(book_name, book, note_types_list, note_flags_list))
+            sys.stdout.flush()
+
+        if self.cache:
+            self.cache.commit()
+
+    def column_index(self, filenames, jobs=1):
+        # all note types and flag bits of the stages
+        note_types = set()
+        note_flags = set()
+        missing = []
+        for filename in filenames:
+            columns = self.cache.columns(filename) if self.cache else None
+            if columns is None:
+                missing.append(filename)
+                continue
+            note_types |= columns[0]
+            note_flags |= columns[1]
+
+        if missing and not self.cache:
+            # nothing keeps the stages of this pass, stream_books parses them again
+            logging.warning(f'Parsing {len(missing)} stages twice without the parse cache, '
+                            'once for the columns and once for the rows')
+        for book in self.iter_roadbooks(missing, jobs=jobs):
+            note_types |= book.note_types()
+            note_flags |= book.flag_bits()
+        return (note_types, note_flags)
+
+    def analysis_dicts(self):
+        # the rows of analyze_books as dicts, the way csv.DictReader reads them back
+        (note_types, note_flags) = self.note_columns()
+        (header, note_types_list, note_flags_list) = self.analysis_header(note_types, note_flags)
+        header = [str(x) for x in header]
+        for name, book in sorted(self.books.items(), key=lambda x: x[0]):
+            yield dict(zip(header, self.analysis_row(name, book, note_types_list, note_flags_list)))
+
+    def analysis_header(self, note_types, note_flags):
+        row = ['name']
+        note_types_list = sorted(list(note_types))
+        note_flags_list = sorted(list(note_flags))
+        row.extend(note_types_list)
+        # prepend 'flag_' to note_flags
+        row.extend([f'flag_{x}' for x in note_flags_list])
+        return (row, note_types_list, note_flags_list)
+
+    def analysis_row(self, name, book, note_types_list, note_flags_list):
+        type_counts = book.type_counts()
+        flag_counts = book.flag_counts()
+        row = [name]
+        row.extend(type_counts[note_type] for note_type in note_types_list)
+        row.extend(flag_counts[note_flag] for note_flag in note_flags_list)
+        return row
 
 
     def csv_output(self, name, notes):
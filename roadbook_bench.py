@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import argparse
+import codecs
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from roadbook import Roadbook, Roadbooks
+
+# rough mix of a Luppis stage: mostly corners, then details and the extended ids
+NOTE_TYPES = [
+    (list(range(0, 12)), 60),
+    (list(range(12, 33)), 20),
+    ([102, 112, 200, 221, 232, 268], 5),
+    ([2002, 2006, 2013, 2016, 2024, 2030, 2055, 2061, 2516], 12),
+    ([4089, 4093], 2),
+    ([1649545214, 53493760], 1),
+]
+NOTE_FLAGS = [(0, 70), (1, 5), (2, 3), (4, 6), (32, 4), (64, 4), (128, 2), (1024, 4), (8192, 2), (66000, 1)]
+
+
+def parse_weights(text):
+    # "0-11:60,102 112:5" -> [([0, ..., 11], 60), ([102, 112], 5)]
+    weights = []
+    for group in text.split(','):
+        (values, weight) = group.split(':')
+        numbers = []
+        for value in values.split():
+            (first, dash, last) = value.partition('-')
+            numbers.extend(range(int(first), int(last) + 1) if dash else [int(first)])
+        if not numbers or float(weight) < 0:
+            raise ValueError(f'Invalid weights: {group}')
+        weights.append((numbers, float(weight)))
+    return weights
+
+
+def flag_weights(text):
+    # "1:5,64:4" -> [(1, 5), (64, 4)]
+    return [(flag, weight) for flags, weight in parse_weights(text) for flag in flags]
+
+
+def choose_flag(rng, note_flags, flag_density):
+    # without a density the weights include the notes without a flag
+    if flag_density is None:
+        (flag,) = rng.choices([flag for flag, weight in note_flags], [weight for flag, weight in note_flags])
+        return flag
+    if rng.random() >= flag_density:
+        return 0
+    flagged = [(flag, weight) for flag, weight in note_flags if flag]
+    (flag,) = rng.choices([flag for flag, weight in flagged], [weight for flag, weight in flagged])
+    return flag
+
+
+def generate_stage(rng, notes, bom=False, crlf=False, note_types=NOTE_TYPES, note_flags=NOTE_FLAGS, flag_density=None):
+    lines = ['[PACENOTES]', f'count = {notes}', '']
+    distance = 0.0
+    for i in range(notes):
+        (types,) = rng.choices([types for types, weight in note_types], [weight for types, weight in note_types])
+        flag = choose_flag(rng, note_flags, flag_density)
+        distance += rng.expovariate(1 / 30)
+        lines.append(f'[P{i}]')
+        lines.append(f'type = {rng.choice(types)}')
+        lines.append(f'distance = {distance:.5f}')
+        lines.append(f'flag = {flag}')
+        lines.append('')
+    # the packs carry non ascii names in cp1252
+    lines += ['[STAGE]', 'name = Sälzer Höhe', '; generated by roadbook_bench.py']
+    text = ('\r\n' if crlf else '\n').join(lines)
+    if bom:
+        return codecs.BOM_UTF8 + text.encode('utf-8')
+    return text.encode('cp1252')
+
+
+def generate(directory, stages, notes, seed=0, bom_ratio=0.1, crlf_ratio=0.5,
+             note_types=NOTE_TYPES, note_flags=NOTE_FLAGS, flag_density=None):
+    # writes `stages` synthetic stage ini files with about `notes` notes each
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for stage in range(stages):
+        count = max(1, int(rng.gauss(notes, notes / 4)))
+        data = generate_stage(rng, count, bom=rng.random() < bom_ratio, crlf=rng.random() < crlf_ratio,
+                              note_types=note_types, note_flags=note_flags, flag_density=flag_density)
+        with open(os.path.join(directory, f'Stage {stage:05d}_LuppisV3.ini'), 'wb') as f:
+            f.write(data)
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def count_notes(books):
+    return sum(len(book.ids) for book in books)
+
+
+def read_ini(directory, jobs):
+    filenames = sorted(os.path.join(directory, x) for x in os.listdir(directory) if x.endswith('.ini'))
+    return lambda: count_notes(Roadbook(x) for x in filenames)
+
+
+def read_roadbooks(directory, jobs):
+    def function():
+        roadbooks = Roadbooks(directory)
+        roadbooks.read_roadbooks('/.*/', jobs=jobs)
+        return count_notes(roadbooks.books.values())
+    return function
+
+
+def analyze_books(directory, jobs):
+    # the stages are read before the timing, the peak rss includes them
+    roadbooks = Roadbooks(directory)
+    roadbooks.read_roadbooks('/.*/', jobs=jobs)
+
+    def function():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            roadbooks.analyze_books()
+        return count_notes(roadbooks.books.values())
+    return function
+
+
+# name: setup(directory, jobs), which returns the timed function, that returns the number of notes
+BENCHMARKS = {
+    'Roadbook.read_ini': read_ini,
+    'Roadbooks.read_roadbooks': read_roadbooks,
+    'Roadbooks.analyze_books': analyze_books,
+}
+
+
+def run(directory, benchmark, jobs=1):
+    # one benchmark, meant to run in a fresh process, so the file reads and
+    # the peak rss are its own
+    function = BENCHMARKS[benchmark](directory, jobs)
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    notes = function()
+    seconds = time.perf_counter() - start
+    rss = peak_rss()
+    return {
+        'name': benchmark,
+        'stages': len([x for x in os.listdir(directory) if x.endswith('.ini')]),
+        'notes': notes,
+        'jobs': jobs,
+        'seconds': round(seconds, 6),
+        'notes_per_second': round(notes / seconds) if seconds else None,
+        'peak_rss': rss,
+        # what the peak grew by during the timed part
+        'peak_rss_increase': {x: rss[x] - rss_before[x] for x in rss},
+    }
+
+
+def bench(sizes, notes, jobs=1, seed=0, **generate_args):
+    report = {'python': sys.version.split()[0], 'runs': []}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            generate(directory, size, notes, seed=seed, **generate_args)
+            results = []
+            for benchmark in BENCHMARKS:
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), 'run', directory,
+                                         '--benchmark', benchmark, '--jobs', str(jobs)],
+                                        check=True, capture_output=True, text=True).stdout
+                results.append(json.loads(output))
+            report['runs'].append({
+                'stages': size,
+                'notes': results[0]['notes'],
+                'jobs': jobs,
+                'results': results,
+            })
+            logging.info(f'{size} stages done')
+    return report
+
+
+def generate_args(parser, args):
+    # the note type and flag mix of the generate and bench commands
+    try:
+        note_types = parse_weights(args.note_types) if args.note_types else NOTE_TYPES
+        note_flags = flag_weights(args.flags) if args.flags else NOTE_FLAGS
+    except ValueError as e:
+        parser.error(f'{e}, expected e.g. "0-11:60,102 112:5"')
+    if args.flag_density is not None:
+        if not 0 <= args.flag_density <= 1:
+            parser.error('--flag-density must be between 0 and 1')
+        if args.flag_density and not any(flag and weight for flag, weight in note_flags):
+            parser.error('--flag-density needs a flag other than 0 in --flags')
+    return {'note_types': note_types, 'note_flags': note_flags, 'flag_density': args.flag_density}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Synthetic Roadbook files and benchmarks for roadbook.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='Write synthetic stage ini files')
+    generate_parser.add_argument('directory', help='Output directory')
+    generate_parser.add_argument('--stages', type=int, default=100, help='Number of stages')
+    generate_parser.add_argument('--notes', type=int, default=300, help='Average number of notes per stage')
+    generate_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    generate_parser.add_argument('--bom-ratio', type=float, default=0.1, help='Share of stages written as utf-8 with BOM')
+    generate_parser.add_argument('--crlf-ratio', type=float, default=0.5, help='Share of stages with CRLF line endings')
+
+    bench_parser = subparsers.add_parser('bench', help='Benchmark at increasing library sizes, writes JSON')
+    bench_parser.add_argument('--sizes', default='10,100,1000', help='Comma separated numbers of stages')
+    bench_parser.add_argument('--notes', type=int, default=300, help='Average number of notes per stage')
+    bench_parser.add_argument('--jobs', type=int, default=1, help='Processes for Roadbooks.read_roadbooks, 0 uses all cores')
+    bench_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    for subparser in [generate_parser, bench_parser]:
+        subparser.add_argument('--note-types', help='Note type mix as TYPES:WEIGHT groups, e.g. "0-11:60,12-32:20,2002 2006:12", defaults to NOTE_TYPES')
+        subparser.add_argument('--flags', help='Flag mix as FLAGS:WEIGHT groups, e.g. "0:70,1:5,64:4", defaults to NOTE_FLAGS')
+        subparser.add_argument('--flag-density', type=float, help='Share of notes with a flag, the flags other than 0 in --flags decide which one')
+
+    run_parser = subparsers.add_parser('run', help='Run one benchmark on an existing directory, writes JSON')
+    run_parser.add_argument('directory', help='Directory with stage ini files')
+    run_parser.add_argument('--benchmark', required=True, choices=list(BENCHMARKS), help='The benchmark to run')
+    run_parser.add_argument('--jobs', type=int, default=1, help='Processes for Roadbooks.read_roadbooks, 0 uses all cores')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.directory, args.stages, args.notes, seed=args.seed,
+                 bom_ratio=args.bom_ratio, crlf_ratio=args.crlf_ratio, **generate_args(parser, args))
+    elif args.command == 'bench':
+        sizes = [int(x) for x in args.sizes.split(',')]
+        print(json.dumps(bench(sizes, args.notes, jobs=args.jobs, seed=args.seed, **generate_args(parser, args)), indent=2))
+    elif args.command == 'run':
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(run(args.directory, args.benchmark, jobs=args.jobs)))
@@ -0,0 +1,156 @@
+import array
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+from cache import cache_dir
+from roadbook import Roadbook
+
+# bump when the layout of the notes blob or the parser output changes
+CACHE_VERSION = 2
+
+
+class RoadbookCache:
+    # Parsed roadbook stages in a sqlite file.
+    # A stage is keyed by its path and is valid as long as size and mtime match.
+    # If only the mtime changed, the content hash decides.
+    # The cache is bounded by max_size bytes of notes, the least recently
+    # used stages are evicted first.
+    # Next to the notes it keeps a column index (note types and flag bits)
+    # per stage, so the CSV header can be built without decoding any notes.
+
+    def __init__(self, filename='', max_size=64 * 1024 * 1024):
+        if not filename:
+            filename = os.path.join(cache_dir(), 'roadbooks.sqlite')
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filename)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != CACHE_VERSION:
+            logging.debug(f'Roadbook cache version {version} != {CACHE_VERSION}, rebuilding {filename}')
+            self.db.execute('DROP TABLE IF EXISTS stages')
+            self.db.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS stages (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime_ns INTEGER,
+                               digest BLOB,
+                               num_notes INTEGER,
+                               count INTEGER,
+                               notes BLOB,
+                               note_types BLOB,
+                               flag_bits INTEGER,
+                               used REAL)''')
+        self.db.commit()
+
+    def lookup(self, filename, what):
+        # returns the requested columns of a stage if it is still valid
+        path = os.path.abspath(filename)
+        row = self.db.execute(f'SELECT size, mtime_ns, digest, {what} FROM stages WHERE path = ?',
+                              (path,)).fetchone()
+        if not row:
+            return None
+
+        (size, mtime_ns, digest) = row[:3]
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if stat.st_size != size:
+            return None
+
+        if stat.st_mtime_ns != mtime_ns:
+            # touched, but maybe not changed
+            with open(path, 'rb') as f:
+                if hashlib.sha1(f.read()).digest() != digest:
+                    return None
+            self.db.execute('UPDATE stages SET mtime_ns = ? WHERE path = ?', (stat.st_mtime_ns, path))
+
+        return row[3:]
+
+    def contains(self, filename):
+        return self.lookup(filename, 'count') is not None
+
+    def get(self, filename):
+        row = self.lookup(filename, 'num_notes, count, notes')
+        if row is None:
+            return None
+
+        (num_notes, count, notes) = row
+        self.db.execute('UPDATE stages SET used = ? WHERE path = ?', (time.time(), os.path.abspath(filename)))
+        self.hits += 1
+        return self.decode(notes, count, num_notes)
+
+    def columns(self, filename):
+        # (note types, flag bits) of a stage, see Roadbook.note_types and Roadbook.flag_bits
+        row = self.lookup(filename, 'note_types, flag_bits')
+        if row is None:
+            return None
+
+        (note_types, flag_bits) = row
+        note_types = set(array.array('i', note_types))
+        flag_bits = {1 << i for i in range(flag_bits.bit_length()) if flag_bits & (1 << i)}
+        return (note_types, flag_bits)
+
+    def put(self, filename, book: Roadbook):
+        # only parsed stages end up here, so this counts the misses
+        self.misses += 1
+        path = os.path.abspath(filename)
+        note_types = array.array('i', sorted(book.note_types())).tobytes()
+        flag_bits = sum(book.flag_bits())
+        self.db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, book.size, book.mtime_ns, book.digest, book.num_notes,
+                         len(book.ids), self.encode(book), note_types, flag_bits, time.time()))
+
+    def encode(self, book: Roadbook):
+        # the four columns back to back, compressed
+        data = b''.join([array.array('i', book.ids).tobytes(),
+                         array.array('i', book.types).tobytes(),
+                         array.array('i', book.flags).tobytes(),
+                         array.array('d', book.distances).tobytes()])
+        return zlib.compress(data, 1)
+
+    def decode(self, notes, count, num_notes):
+        data = zlib.decompress(notes)
+        columns = []
+        offset = 0
+        for typecode in 'iiid':
+            column = array.array(typecode)
+            end = offset + count * column.itemsize
+            column.frombytes(data[offset:end])
+            columns.append(column)
+            offset = end
+        (ids, types, flags, distances) = columns
+        return Roadbook.from_columns(ids, types, distances, flags, num_notes)
+
+    def commit(self):
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(LENGTH(notes)), 0) FROM stages').fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for path, size in self.db.execute('SELECT path, LENGTH(notes) FROM stages ORDER BY used'):
+            if total <= self.max_size:
+                break
+            evicted.append((path,))
+            total -= size
+        self.db.executemany('DELETE FROM stages WHERE path = ?', evicted)
+        logging.debug(f'Evicted {len(evicted)} stages from {self.filename}')
+
+    def clear(self):
+        self.db.execute('DELETE FROM stages')
+        self.db.commit()
+
+    def close(self):
+        logging.info(f'Roadbook cache: {self.hits} hits, {self.misses} misses')
+        self.commit()
+        self.db.close()
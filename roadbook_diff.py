@@ -0,0 +1,143 @@
+import csv
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from roadbook import Roadbooks
+
+# Ahvenus I_Luppis_20230228.ini, Ahvenus I_LuppisV3.ini, Ahvenus I_default.ini -> ahvenus i
+STAGE_SUFFIX = re.compile(r'[ _-]*(luppis.*|default)$', re.IGNORECASE)
+
+DIFF_HEADER = ['stage', 'change', 'old_distance', 'new_distance', 'old_type', 'new_type', 'old_flag', 'new_flag']
+
+
+def stage_key(name):
+    name = os.path.splitext(name)[0]
+    return STAGE_SUFFIX.sub('', name).strip().lower()
+
+
+def stage_notes(book):
+    # picklable (distance, type, flag) tuples sorted by distance
+    return sorted(zip(book.distances, book.types, book.flags))
+
+
+def diff_notes(old_notes, new_notes, tolerance=1.0):
+    # Merge join of two distance sorted note lists.
+    # Notes within `tolerance` meters of the first note of a cluster are aligned:
+    # identical notes first, then the same type (reflagged), then in order (retyped).
+    # What is left over is removed or added.
+    changes = []
+    i = j = 0
+    while i < len(old_notes) or j < len(new_notes):
+        if j >= len(new_notes) or (i < len(old_notes) and old_notes[i][0] <= new_notes[j][0]):
+            start = old_notes[i][0]
+        else:
+            start = new_notes[j][0]
+        end = start + tolerance
+
+        old_cluster = []
+        while i < len(old_notes) and old_notes[i][0] <= end:
+            old_cluster.append(old_notes[i])
+            i += 1
+        new_cluster = []
+        while j < len(new_notes) and new_notes[j][0] <= end:
+            new_cluster.append(new_notes[j])
+            j += 1
+
+        changes.extend(diff_cluster(old_cluster, new_cluster))
+    return changes
+
+
+def diff_cluster(old_cluster, new_cluster):
+    changes = []
+    # identical type and flag
+    for old_note in list(old_cluster):
+        for new_note in new_cluster:
+            if old_note[1:] == new_note[1:]:
+                old_cluster.remove(old_note)
+                new_cluster.remove(new_note)
+                break
+    # same type, other flag
+    for old_note in list(old_cluster):
+        for new_note in new_cluster:
+            if old_note[1] == new_note[1]:
+                old_cluster.remove(old_note)
+                new_cluster.remove(new_note)
+                changes.append(('reflagged', old_note, new_note))
+                break
+    # the rest in order of distance
+    for old_note, new_note in zip(old_cluster, new_cluster):
+        changes.append(('retyped', old_note, new_note))
+    for old_note in old_cluster[len(new_cluster):]:
+        changes.append(('removed', old_note, None))
+    for new_note in new_cluster[len(old_cluster):]:
+        changes.append(('added', None, new_note))
+    return changes
+
+
+def diff_stage(stage):
+    (name, old_notes, new_notes, tolerance) = stage
+    return (name, diff_notes(old_notes, new_notes, tolerance))
+
+
+class RoadbookDiff:
+    # Diff between two roadbook packs, e.g. roadbooks_v2 and roadbooks_v3.
+    # Stages are matched by stage_key, the stages are diffed in a process pool.
+
+    def __init__(self, old: Roadbooks, new: Roadbooks, tolerance=1.0):
+        self.old = self.stages_by_key(old)
+        self.new = self.stages_by_key(new)
+        self.tolerance = tolerance
+
+    def stages_by_key(self, roadbooks: Roadbooks):
+        stages = {}
+        for name in sorted(roadbooks.books.keys()):
+            key = stage_key(name)
+            if key in stages:
+                logging.error(f'Duplicate stage {key}: {stages[key][0]} and {name}')
+                continue
+            stages[key] = (name, roadbooks.books[name])
+        return stages
+
+    def diff(self, jobs=1):
+        # yields (stage, change, old note, new note) ordered by stage and distance
+        keys = sorted(set(self.old.keys()) | set(self.new.keys()))
+        stages = [(key,
+                   stage_notes(self.old[key][1]),
+                   stage_notes(self.new[key][1]),
+                   self.tolerance)
+                  for key in keys if key in self.old and key in self.new]
+
+        if jobs == 1 or len(stages) < 2:
+            yield from self.changes(keys, map(diff_stage, stages))
+            return
+
+        # jobs = 0 uses all cores
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(stages) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from self.changes(keys, executor.map(diff_stage, stages, chunksize=chunksize))
+
+    def changes(self, keys, results):
+        # results come in the order of the stages in both packs
+        for key in keys:
+            if key not in self.new:
+                yield (self.old[key][0], 'stage_removed', None, None)
+                continue
+            if key not in self.old:
+                yield (self.new[key][0], 'stage_added', None, None)
+                continue
+            (key, changes) = next(results)
+            name = self.new[key][0]
+            for change, old_note, new_note in changes:
+                yield (name, change, old_note, new_note)
+
+    def diff_csv(self, jobs=1):
+        csv_writer = csv.writer(sys.stdout)
+        csv_writer.writerow(DIFF_HEADER)
+        for name, change, old_note, new_note in self.diff(jobs=jobs):
+            (old_distance, old_type, old_flag) = old_note or ('', '', '')
+            (new_distance, new_type, new_flag) = new_note or ('', '', '')
+            csv_writer.writerow([name, change, old_distance, new_distance, old_type, new_type, old_flag, new_flag])
@@ -0,0 +1,108 @@
+import csv
+import logging
+import math
+import re
+import sys
+from bisect import bisect_left, bisect_right
+
+from roadbook import Roadbooks
+
+# type 2061
+# flag 64
+# type 2061 after type 2055 within 50
+# type 2061 before flag 64 within 20.5
+TERM = r'(type|flag)\s+(\d+)'
+QUERY = re.compile(rf'^\s*{TERM}(?:\s+(after|before)\s+{TERM}\s+within\s+(\d+(?:\.\d+)?))?\s*$')
+
+
+def parse_query(query):
+    # (kind, value, direction, other kind, other value, within) of a query,
+    # direction and the rest are None for a single term
+    match = QUERY.match(query)
+    if not match:
+        raise ValueError(f'Invalid query: {query!r}, expected e.g. "type 2061", "flag 64" or "type 2061 after type 2055 within 50"')
+    (kind, value, direction, other_kind, other_value, within) = match.groups()
+    terms = [(kind, int(value))]
+    if direction:
+        terms.append((other_kind, int(other_value)))
+    for term_kind, term_value in terms:
+        # the flag postings are per bit, a combination of bits would match nothing
+        if term_kind == 'flag' and (term_value <= 0 or term_value & (term_value - 1)):
+            raise ValueError(f'Invalid query: {query!r}, flag {term_value} is not a single bit like 1, 2, 4, ... 32768')
+    if not direction:
+        return (kind, int(value), None, None, None, None)
+    return (kind, int(value), direction, other_kind, int(other_value), float(within))
+
+
+class RoadbookIndex:
+    # Inverted index over the notes of Roadbooks.
+    # For every note type and every flag bit it keeps the postings per stage,
+    # as a sorted list of (distance, position of the note in the stage):
+    # {type: {stage: [(distance, position), ...]}}
+
+    def __init__(self, roadbooks: Roadbooks):
+        self.stages = sorted(roadbooks.books.keys())
+        self.types = {}
+        self.flags = {}
+        for stage in self.stages:
+            book = roadbooks.books[stage]
+            notes = sorted(zip(book.distances, book.types, book.flags))
+            for position, (distance, note_type, flag) in enumerate(notes):
+                self.types.setdefault(note_type, {}).setdefault(stage, []).append((distance, position))
+                while flag:
+                    bit = flag & -flag
+                    self.flags.setdefault(bit, {}).setdefault(stage, []).append((distance, position))
+                    flag ^= bit
+        logging.info(f'Indexed {len(self.stages)} stages, {len(self.types)} types, {len(self.flags)} flags')
+
+    def postings(self, kind, value):
+        if kind == 'type':
+            return self.types.get(value, {})
+        if kind == 'flag':
+            return self.flags.get(value, {})
+        raise ValueError(f'Unknown term: {kind}')
+
+    def near(self, postings, other_postings, within, after=True):
+        # the distances in postings that are at most `within` meters after
+        # (or before) a distance in other_postings, per stage
+        result = {}
+        for stage, notes in postings.items():
+            others = other_postings.get(stage)
+            if not others:
+                continue
+            found = []
+            for note in notes:
+                distance = note[0]
+                if after:
+                    low, high = distance - within, distance
+                else:
+                    low, high = distance, distance + within
+                count = bisect_right(others, (high, math.inf)) - bisect_left(others, (low, -1))
+                # a note is not near itself, e.g. for type 2061 before flag 64
+                index = bisect_left(others, note)
+                if index < len(others) and others[index] == note:
+                    count -= 1
+                if count:
+                    found.append(distance)
+            if found:
+                result[stage] = found
+        return result
+
+    def query(self, query):
+        # returns {stage: [distance, ...]} of the notes matching the query, see parse_query
+        (kind, value, direction, other_kind, other_value, within) = parse_query(query)
+        postings = self.postings(kind, value)
+        if not direction:
+            return {stage: [distance for distance, position in notes] for stage, notes in postings.items()}
+        other_postings = self.postings(other_kind, other_value)
+        return self.near(postings, other_postings, within, after=direction == 'after')
+
+    def query_csv(self, query):
+        result = self.query(query)
+        csv_writer = csv.writer(sys.stdout)
+        csv_writer.writerow(['name', 'count', 'distances'])
+        for stage in self.stages:
+            distances = result.get(stage)
+            if distances:
+                csv_writer.writerow([stage, len(distances), ' '.join(f'{x:g}' for x in distances)])
+        logging.info(f'{query}: {sum(len(x) for x in result.values())} notes in {len(result)} stages')
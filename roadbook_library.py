@@ -0,0 +1,136 @@
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from roadbook import Roadbook, Roadbooks, roadbook_name_matcher
+
+# A roadbook library is one file with all stages of a roadbook directory:
+#
+#   header   magic, version, number of stages, number of notes, size of the index
+#   index    per stage: name length, name (utf-8), first note, note count, num_notes
+#   ids      int32 * notes     \
+#   types    int32 * notes      | the columns of all stages back to back,
+#   flags    int32 * notes      | little endian, each section 8 byte aligned
+#   distance float64 * notes   /
+MAGIC = b'RBRBOOKS'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+STAGE = struct.Struct('<QII')
+NAME_LENGTH = struct.Struct('<H')
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def is_roadbook_library(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_roadbooks(path, cache=None):
+    # a roadbook directory or a roadbook library, whatever path is
+    if is_roadbook_library(path):
+        return LibraryRoadbooks(path)
+    return Roadbooks(path, cache=cache)
+
+
+def write_roadbook_library(filename, roadbooks: Roadbooks):
+    books = list(roadbooks.books.items())
+    num_notes = sum(len(book.ids) for name, book in books)
+
+    index = bytearray()
+    offset = 0
+    for name, book in books:
+        encoded_name = name.encode('utf-8')
+        index += NAME_LENGTH.pack(len(encoded_name))
+        index += encoded_name
+        index += STAGE.pack(offset, len(book.ids), book.num_notes)
+        offset += len(book.ids)
+
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(books), num_notes, len(index)))
+        f.write(index)
+        for typecode, column in [('i', 'ids'), ('i', 'types'), ('i', 'flags'), ('d', 'distances')]:
+            f.write(b'\0' * (align(f.tell()) - f.tell()))
+            for name, book in books:
+                data = array.array(typecode, getattr(book, column))
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                f.write(data.tobytes())
+
+    logging.info(f'Wrote {len(books)} stages with {num_notes} notes to {filename}')
+
+
+class RoadbookLibrary:
+    # Memory mapped reader for a roadbook library.
+    # The stages share the mapped columns, nothing is copied on a little endian host.
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+
+        (magic, version, num_stages, num_notes, index_size) = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f'Not a roadbook library: {filename}')
+        if version != VERSION:
+            raise ValueError(f'Unsupported roadbook library version {version}: {filename}')
+
+        # name: (first note, note count, num_notes)
+        self.stages = {}
+        position = HEADER.size
+        for i in range(num_stages):
+            (length,) = NAME_LENGTH.unpack_from(view, position)
+            position += NAME_LENGTH.size
+            name = bytes(view[position:position + length]).decode('utf-8')
+            position += length
+            self.stages[name] = STAGE.unpack_from(view, position)
+            position += STAGE.size
+
+        columns = []
+        for typecode in 'iiid':
+            position = align(position)
+            size = array.array(typecode).itemsize * num_notes
+            column = view[position:position + size].cast(typecode)
+            if sys.byteorder != 'little':
+                column = array.array(typecode, column)
+                column.byteswap()
+            columns.append(column)
+            position += size
+        (self.ids, self.types, self.flags, self.distances) = columns
+
+    def book(self, name):
+        (offset, count, num_notes) = self.stages[name]
+        end = offset + count
+        return Roadbook.from_columns(self.ids[offset:end],
+                                     self.types[offset:end],
+                                     self.distances[offset:end],
+                                     self.flags[offset:end],
+                                     num_notes)
+
+
+class LibraryRoadbooks(Roadbooks):
+    # Roadbooks backed by a roadbook library instead of a directory of ini files.
+    # The library is parsed already, so there is no cache and no process pool.
+
+    def __init__(self, path, cache=None):
+        super().__init__(path)
+        self.library = RoadbookLibrary(path)
+
+    def find_roadbooks(self, name):
+        name_matches = roadbook_name_matcher(name)
+        return [(stage, stage) for stage in self.library.stages if name_matches(stage) and stage.endswith('.ini')]
+
+    def iter_roadbooks(self, filenames, jobs=1):
+        for filename in filenames:
+            yield self.library.book(filename)
+
+    def load_roadbook(self, filename):
+        return self.library.book(filename)
@@ -0,0 +1,85 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class TaskGraph:
+    # A build as a graph of tasks, e.g. convert, compose, place and write the
+    # subtitles of the codriver sounds.
+    # A task is added under a key; adding a key again returns the existing task,
+    # so a prefix sound shared by many notes is converted only once. run executes
+    # the tasks in a pool of threads as soon as their dependencies are done, and
+    # passes the results of the dependencies as arguments. When a task fails,
+    # everything that depends on it fails too. The work is mostly ffmpeg, numpy
+    # and file copies, so threads are enough.
+
+    def __init__(self):
+        self.tasks = {}  # key: (function, dependencies)
+        self.results = {}  # key: result of the function
+        self.errors = {}  # key: exception of the task or of a dependency
+
+    def add(self, key, function, *dependencies):
+        if key not in self.tasks:
+            for dependency in dependencies:
+                if dependency not in self.tasks:
+                    raise KeyError(f'Unknown dependency {dependency} of task {key}')
+            self.tasks[key] = (function, dependencies)
+        return key
+
+    def fail(self, key, error, dependents):
+        self.errors[key] = error
+        todo = list(dependents.get(key, ()))
+        while todo:
+            key = todo.pop()
+            if key not in self.errors:
+                self.errors[key] = error
+                todo.extend(dependents.get(key, ()))
+
+    def run(self, jobs=0):
+        # runs the tasks that are not done yet, returns the errors
+        # jobs = 0 uses all cores
+        jobs = jobs or os.cpu_count() or 1
+        todo = [key for key in self.tasks if key not in self.results and key not in self.errors]
+        waiting = {}  # key: number of dependencies that are not done
+        dependents = {}  # key: the tasks that depend on it
+        for key in todo:
+            dependencies = [x for x in self.tasks[key][1] if x not in self.results]
+            waiting[key] = len(dependencies)
+            for dependency in dependencies:
+                dependents.setdefault(dependency, []).append(key)
+        # failed in an earlier run
+        for key in list(self.errors):
+            self.fail(key, self.errors[key], dependents)
+
+        logging.info(f'Running {len(todo)} tasks with {jobs} jobs')
+        done = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = {}  # future: key
+
+            def submit(key):
+                (function, dependencies) = self.tasks[key]
+                future = executor.submit(function, *[self.results[x] for x in dependencies])
+                running[future] = key
+
+            for key in todo:
+                if not waiting[key] and key not in self.errors:
+                    submit(key)
+            while running:
+                (finished, pending) = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    done += 1
+                    try:
+                        self.results[key] = future.result()
+                    except Exception as e:
+                        logging.error(e)
+                        self.fail(key, e, dependents)
+                        continue
+                    for dependent in dependents.get(key, ()):
+                        waiting[dependent] -= 1
+                        if not waiting[dependent] and dependent not in self.errors:
+                            submit(dependent)
+                    if done % 1000 == 0:
+                        logging.info(f'Done {done}/{len(todo)} tasks, {len(self.errors)} errors')
+        logging.info(f'Done {done}/{len(todo)} tasks, {len(self.errors)} errors')
+        return self.errors
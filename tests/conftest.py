@@ -0,0 +1,48 @@
+import os
+import sys
+import textwrap
+
+import pytest
+
+# the modules live in the top level directory of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FAKE_FFMPEG = '''\
+    import hashlib, math, struct, sys, wave
+    # ffmpeg -nostdin -y -loglevel error -i OGG WAV, a sine wav instead of the ogg
+    (ogg, wav) = (sys.argv[sys.argv.index('-i') + 1], sys.argv[-1])
+    with open(CALLS, 'a') as f:
+        f.write(ogg + '\\n')
+    with open(ogg, 'rb') as f:
+        content = f.read()
+    if content.startswith(b'BAD'):
+        sys.stderr.write(f'{ogg}: Invalid data found when processing input\\n')
+        sys.exit(1)
+    frequency = 200 + int(hashlib.sha1(content).hexdigest(), 16) % 800
+    with wave.open(wav, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(22050)
+        f.writeframes(b''.join(struct.pack('<h', int(8000 * math.sin(2 * math.pi * frequency * i / 22050)))
+                               for i in range(6615)))
+'''
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    # an ffmpeg on the PATH that writes a 0.3 s sine for every ogg and fails for
+    # oggs starting with BAD, returns a function listing the oggs it was called with
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    calls = tmp_path / 'ffmpeg-calls.txt'
+    calls.write_text('')
+    script = directory / 'ffmpeg'
+    script.write_text(f'#!{sys.executable}\nCALLS = {str(calls)!r}\n' + textwrap.dedent(FAKE_FFMPEG))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{directory}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('CC_CODRIVER_CACHE', str(tmp_path / 'cache'))
+
+    def ffmpeg_calls():
+        return calls.read_text().splitlines()
+
+    return ffmpeg_calls
@@ -0,0 +1,238 @@
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+
+# the modules live in the top level directory of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codriver
+import rbr_pacenote_plugin
+from plugin_tree import make_codriver_tree, make_plugin_dirs, stable_hash
+from rbr_pacenote_plugin import RbrPacenote, RbrPacenotePlugin, load_plugins
+
+# The expected outputs of the plugins and codrivers of plugin_tree, in
+# tests/golden. They were written once from the modules as they were before the
+# optimizations. After an intended change of the output run
+#   python tests/golden.py
+# to write them again from the current modules and review the diff.
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+PLUGIN_ARGS = {'additional': {'map_files': {'one_left_0.ogg': 'oneleft.ogg'}, 'additional_sounds_dir': 'additional'}}
+LOOKUP_NAMES = ['', 'one_left', 'tightensbad']
+
+MAP_NOTES = [
+    {'cc_id': 64, 'rbr_name': 'cut'},
+    {'cc_id': 8192, 'rbr_name': 'maybe'},
+    # chains: three_right -> wideout by name, then 216 and 2 by id, 2 -> 3 -> into
+    {'cc_id': 2, 'rbr_id': 3},
+    {'cc_name': 'three_right', 'rbr_name': 'wideout'},
+    {'cc_name': 'wideout', 'rbr_id': 216},
+    {'cc_id': 216, 'rbr_id': 2},
+    {'cc_id': 3, 'rbr_name': 'into'},
+    {'cc_name': 'one_left', 'cc_id': 0, 'rbr_id': 1, 'rbr_name': 'square_left'},
+]
+
+
+def read_golden(name):
+    with open(os.path.join(GOLDEN_DIR, name), encoding='utf-8') as f:
+        if name.endswith('.json'):
+            return json.load(f)
+        return f.read().splitlines()
+
+
+def write_golden(name, data):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(os.path.join(GOLDEN_DIR, name), 'w', encoding='utf-8', newline='\n') as f:
+        if name.endswith('.json'):
+            f.write(json_lines(data) + '\n')
+        else:
+            f.write(''.join(f'{line}\n' for line in data))
+
+
+def json_lines(data, indent=''):
+    # the first two levels one entry per line, the rest compact, for short diffs
+    if len(indent) < 2 and isinstance(data, dict) and data:
+        items = [f'{indent} {json.dumps(key)}: {json_lines(data[key], indent + " ")}' for key in sorted(data)]
+    elif len(indent) < 2 and isinstance(data, list) and data:
+        items = [f'{indent} {json_lines(item, indent + " ")}' for item in data]
+    else:
+        return json.dumps(data, sort_keys=True)
+    (start, end) = '{}' if isinstance(data, dict) else '[]'
+    return start + '\n' + ',\n'.join(items) + '\n' + indent + end
+
+
+def as_json(data):
+    # tuples become lists, like in the golden files
+    return json.loads(json.dumps(data))
+
+
+def plugin_rows(plugin):
+    # every note with its sounds in their order, sorted by all fields
+    rows = []
+    for note in plugin.pacenotes:
+        rows.append([note.id, note.name, note.type, note.category, note.package, note.ini,
+                     list(note.sounds), list(note.sounds_not_found), sorted(note.sounds_mapped.items()),
+                     note.sound_count, note.translation, os.path.relpath(note.sounds_dir, plugin.plugin_dir)])
+    return as_json(sorted(rows, key=repr))
+
+
+def plugin_translations(plugin):
+    # the translations of the names of the notes and a few others, in each
+    # category and ini file of the plugin and one that does not exist
+    names = {note.name for note in plugin.pacenotes} | {'100', '4242', 'not_a_note'}
+    places = {(note.category, note.ini) for note in plugin.pacenotes} | {('Missing', 'missing.ini'), ('', 'Rbr.ini')}
+    translations = {}
+    for category, ini in sorted(places):
+        for name in sorted(names):
+            translation = plugin.translate(name, category, ini)
+            if translation:
+                translations.setdefault(f'{category}/{ini}', {})[name] = translation
+    return translations
+
+
+def note_key(note):
+    return [note.id, note.name, note.translation, note.package, note.category, sorted(note.sounds)]
+
+
+def lookup_key(note):
+    # enough to tell the notes of the trees apart
+    return [note.id, note.name, note.package, note.category]
+
+
+def cc_note_key(cc_note):
+    if cc_note is None:
+        return None
+    return [cc_note.name, cc_note.rushed, cc_note.type and [cc_note.type.name, cc_note.type.id],
+            cc_note_key(cc_note.prefix), sorted(map(note_key, cc_note.notes))]
+
+
+def make_codriver(config, name, package='all', fallback_to_base=False):
+    # the codriver with its base codriver, like codriver.py does. The plugins are
+    # read in this process, in the order of the packages, so the sets of notes
+    # are built in the same order every time.
+    load_plugins([plugin for package_config, plugin in codriver.codriver_packages(name, config, package)] +
+                 [plugin for package_config, plugin in codriver.codriver_packages(config['rbr_base_mod'], config)],
+                 snapshots=False, jobs=1)
+    result = codriver.make_codriver(name, config, package, fallback_to_base=fallback_to_base, plugin_snapshots=False)
+    base = codriver.make_codriver(config['rbr_base_mod'], config, plugin_snapshots=False)
+    result.set_base_codriver(base, config['rbr_base_package'])
+    return result
+
+
+def printed_lines(function, *args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function(*args)
+    return output.getvalue().splitlines()
+
+
+def cc_list_csv(cd):
+    cd.map_notes_from_cc()
+    return printed_lines(cd.cc_list_csv)
+
+
+def rbr_list_csv(cd):
+    return printed_lines(cd.rbr_list_csv)
+
+
+def unmapped_csv(cd):
+    cd.map_notes_from_cc()
+    output = io.StringIO()
+    csv_writer = csv.DictWriter(output, codriver.MappedNote().as_dict().keys())
+    csv_writer.writeheader()
+    for note in cd.unmapped_base_mod_notes():
+        csv_writer.writerow(note.as_dict())
+    return output.getvalue().splitlines()
+
+
+def mapped_cc_notes(cd):
+    cd.map_notes_from_cc()
+    return as_json({name: cc_note_key(cc_note) for name, cc_note in cd.mapped_cc_notes.items()})
+
+
+def cc_types(cd):
+    names = [type.name for type in list(cd.cc_pacenotes_types.values()) + list(cd.cc_pacenotes_modifiers.values())]
+    names += [name.upper() for name in names] + ['250', 'unknown_sound', 'Corner_1_Left']
+    types = {}
+    for name in names:
+        type = cd.get_pacenote_type_for_cc_sound(name)
+        types[name] = type and [type.__class__.__name__, type.name, type.id]
+    return types
+
+
+def rbr_lookups(cd, packages, ids, names):
+    # the notes get_rbr_pacenotes finds, for the lookups that find any
+    lookups = {}
+    for package in packages:
+        for id in sorted(ids):
+            for name in names:
+                notes = cd.get_rbr_pacenotes(id=id, name=name, package=package)
+                if notes:
+                    lookups[f'{package} {id} {name}'] = sorted(map(lookup_key, notes))
+    return lookups
+
+
+def map_rbr_ids_lookups(cd):
+    ids = set(cd.map_rbr_ids['numeric']) | set(cd.cc_pacenotes_types) | set(cd.cc_pacenotes_modifiers)
+    return rbr_lookups(cd, sorted(cd.rbr_pacenote_plugins), ids, LOOKUP_NAMES)
+
+
+def map_notes_lookups(cd):
+    types = list(cd.cc_pacenotes_types.values()) + list(cd.cc_pacenotes_modifiers.values())
+    lookups = [(type.id, type.rbr_name()) for type in types] + [(2, 'x'), (5, 'three_right'), (-1, 'wideout'), (0, 'one_left')]
+    found = {}
+    for id, name in lookups:
+        found[f'{id} {name}'] = sorted(map(lookup_key, cd.get_rbr_pacenotes(id=id, name=name)))
+    return found
+
+
+def codriver_goldens(config):
+    # golden file: function of a new codriver
+    goldens = {}
+    for name in ['cdA', 'cdB']:
+        goldens[f'cc-{name}.csv'] = lambda name=name: cc_list_csv(make_codriver(config, name))
+        goldens[f'cc-{name}-fallback.csv'] = lambda name=name: cc_list_csv(make_codriver(config, name, fallback_to_base=True))
+        for package in ['all', 'numeric']:
+            goldens[f'rbr-{name}-{package}.csv'] = \
+                lambda name=name, package=package: rbr_list_csv(make_codriver(config, name, package=package))
+    goldens['unmapped-cdB.csv'] = lambda: unmapped_csv(make_codriver(config, 'cdB'))
+    goldens['unmapped-cdB-fallback.csv'] = lambda: unmapped_csv(make_codriver(config, 'cdB', fallback_to_base=True))
+    goldens['mapped-cc-notes.json'] = lambda: {name: mapped_cc_notes(make_codriver(config, name)) for name in ['cdA', 'cdB']}
+    goldens['cc-types.json'] = lambda: cc_types(make_codriver(config, 'cdA'))
+    goldens['lookups-map-rbr-ids.json'] = lambda: map_rbr_ids_lookups(make_codriver(config, 'cdB'))
+    map_notes_config = dict(config, map_notes=MAP_NOTES)
+    goldens['lookups-map-notes.json'] = lambda: map_notes_lookups(make_codriver(map_notes_config, 'cdA'))
+    goldens['cc-cdA-map-notes.csv'] = lambda: cc_list_csv(make_codriver(map_notes_config, 'cdA'))
+    return goldens
+
+
+def main():
+    # the trees have broken notes on purpose, their errors are no news here
+    logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['CC_CODRIVER_CACHE'] = os.path.join(directory, 'cache')
+        plugin_dirs = make_plugin_dirs(os.path.join(directory, 'plugins'))
+        plugins = {name: RbrPacenotePlugin(plugin_dir, **PLUGIN_ARGS.get(name, {})) for name, plugin_dir in plugin_dirs.items()}
+        write_golden('plugins.json', {str(name): plugin_rows(plugin) for name, plugin in plugins.items()})
+        write_golden('translations.json', plugin_translations(plugins[0]))
+
+        # the notes of the codrivers hash by their content, see plugin_tree.stable_hash
+        RbrPacenote.__hash__ = stable_hash
+        tree = os.path.join(directory, 'codriver')
+        os.makedirs(tree)
+        config = make_codriver_tree(tree)
+        os.chdir(tree)
+        codriver.base_dir = tree
+        for name, function in codriver_goldens(config).items():
+            rbr_pacenote_plugin.plugin_registry.clear()
+            write_golden(name, function())
+        os.chdir(os.path.dirname(directory))
+
+
+if __name__ == '__main__':
+    main()
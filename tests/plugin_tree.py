@@ -0,0 +1,197 @@
+import csv
+import hashlib
+import json
+import os
+import random
+import shutil
+
+from codriver import PacenoteModifier, PacenoteType
+
+# Builds small but complete Pacenote plugin trees and codriver configs for the
+# tests: notes with and without ids, duplicates by name, missing sounds, wrong
+# sound counts, includes shared by two packages, a missing include, BOMs and
+# translations on every level of the search order. Everything is derived from
+# the seed, so the same tree is built for the tests and the golden files.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGES = ['numeric', 'reversed', 'descriptive']
+MAP_FILES = {'one_left_0.ogg': 'oneleft.ogg', 'hairpin_left_0.ogg': 'hp_left.ogg'}
+
+
+def read_cc_types(filename):
+    lookup = []
+    with open(os.path.join(REPO_DIR, filename)) as f:
+        for line in f:
+            line = line.strip()
+            if '=' in line and not line.startswith('//'):
+                (name, id) = line.split('=')
+                lookup.append((int(id.strip().rstrip(',')), name.strip()))
+    return lookup
+
+
+CC_TYPES = read_cc_types('cc_pacenote_type.txt')
+CC_MODIFIERS = read_cc_types('cc_pacenote_modifier.txt')
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'OggS' + path.encode('utf-8'))
+
+
+def make_plugin(root, seed, additional=False, map_files=None):
+    rng = random.Random(seed)
+    write(f'{root}/PaceNote.ini', '[SETTINGS]\nsounds=default\nlanguage=english\n')
+    sounds_dir = f'{root}/sounds/default'
+    os.makedirs(sounds_dir, exist_ok=True)
+    notes = []
+    for id, name in CC_TYPES + CC_MODIFIERS:
+        if rng.random() < 0.75:
+            type = PacenoteType(name, id) if (id, name) in CC_TYPES else PacenoteModifier(name, id)
+            notes.append((id, type.rbr_name().upper()))
+    # notes without id and notes with the name of another one
+    notes += [(-1, 'EXTRA_NOTE'), (-1, 'ONE_LEFT'), (2061, 'OPEN_HAIRPIN_LEFT'), (2055, 'OPEN_HAIRPIN_RIGHT'), (4083, 'INTO')]
+    rng.shuffle(notes)
+    categories = {'corners': [], 'details': [], 'shared': []}
+    for i, (id, name) in enumerate(notes):
+        if name.lower().startswith(('one', 'two', 'three', 'four', 'five', 'six', 'square', 'flat', 'hairpin')):
+            categories['corners'].append((id, name))
+        else:
+            categories['shared' if i % 5 == 0 else 'details'].append((id, name))
+
+    def section(id, name):
+        num_sounds = rng.choice([1, 1, 1, 2, 3])
+        lines = [f'[PACENOTE::{name}]']
+        if id >= 0:
+            lines.append(f'id={id}')
+        lines.append(f'Sounds={num_sounds if rng.random() > 0.05 else num_sounds + 1}')
+        for i in range(num_sounds):
+            sound = f'{name.lower()}_{i}.ogg'
+            lines.append(f'snd{i}={sound}')
+            target = (map_files or {}).get(sound, sound)
+            if rng.random() > 0.07:
+                touch(f'{sounds_dir}/{target}')
+            if additional and rng.random() < 0.3:
+                (base, ext) = os.path.splitext(target)
+                for variant in range(rng.randint(1, 3)):
+                    touch(f'{sounds_dir}/additional/{base}_{variant}{ext}')
+        return '\n'.join(lines) + '\n\n'
+
+    pacenotes = f'{root}/config/pacenotes'
+    write(f'{pacenotes}/Rbr.ini', '[PACKAGE::Main]\nfile0=packages\\main.ini\n\n[PACENOTE::TOPLEVEL]\nid=3999\nSounds=1\nsnd0=toplevel.ogg\n')
+    touch(f'{sounds_dir}/toplevel.ogg')
+    write(f'{pacenotes}/packages/main.ini', '[CATEGORY::Corners]\nfile0=corners\\corners.ini\n\n[CATEGORY::Details]\nfile0=details\\details.ini\nfile1=shared\\shared.ini\n')
+    write(f'{pacenotes}/Rbr-Enhanced.ini', '[PACKAGE::Enhanced]\nfile0=packages\\enh.ini\n')
+    write(f'{pacenotes}/packages/enh.ini', '[CATEGORY::Shared]\nfile0=shared\\shared.ini\nfile1=missing\\nope.ini\n')
+    for category, category_notes in categories.items():
+        write(f'{pacenotes}/packages/{category}/{category}.ini', ''.join(section(id, name) for id, name in category_notes))
+    write(f'{root}/config/ranges/Rbr.ini', '[RANGE::100]\nSounds=1\nsnd0=range_100.ogg\n\n[RANGE::200]\nSounds=1\nsnd0=range_200.ogg\n')
+    touch(f'{sounds_dir}/range_100.ogg')
+    touch(f'{sounds_dir}/range_200.ogg')
+
+    # translations on every level of the search order, some notes have none
+    language = f'{root}/language/english/pacenotes'
+    levels = {0: {}, 1: {}, 2: {}, 3: {}}
+    for category, category_notes in categories.items():
+        for id, name in category_notes:
+            level = rng.choice([0, 1, 2, 3, 3, None])
+            if level is not None:
+                levels[level].setdefault(category, []).append(f'{name.lower()} = {name.title()} {level}')
+            if rng.random() < 0.1:
+                # a second translation further up, the first file must win
+                levels[3].setdefault(category, []).append(f'{name.lower()} = {name.title()} top')
+    levels[3].setdefault('top', []).append('toplevel = Top Level')
+    for category in categories:
+        write(f'{language}/packages/{category}/{category}.ini', '﻿[STRINGS]\n' + '\n'.join(levels[0].get(category, [])) + '\n')
+        write(f'{language}/packages/{category}/strings.ini', '[STRINGS]\n' + '\n'.join(levels[1].get(category, [])) + '\n')
+    write(f'{language}/packages/strings.ini', '[STRINGS]\n' + '\n'.join(sum(levels[2].values(), [])) + '\n')
+    # later lines of the same file win in configparser, keep the top level unique
+    top = {}
+    for line in sum(levels[3].values(), []):
+        top.setdefault(line.split(' = ')[0], line)
+    write(f'{language}/strings.ini', '[STRINGS]\n' + '\n'.join(top.values()) + '\n')
+
+
+def make_codriver_tree(directory, seed=0):
+    # a working directory like the repository one: cc type files, config.json,
+    # the CC codriver sounds, two codrivers with three plugins each and stats
+    for filename in ['cc_pacenote_type.txt', 'cc_pacenote_modifier.txt', 'terminologies.json']:
+        shutil.copy(os.path.join(REPO_DIR, filename), directory)
+
+    rng = random.Random(seed)
+    ids = sorted({id for id, name in CC_TYPES} | {id for id, name in CC_MODIFIERS})
+    with open(os.path.join(directory, 'stats.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Name'] + ids)
+        for stage in range(3):
+            writer.writerow([f'Stage {stage}.ini'] + [rng.randint(0, 20) for id in ids])
+
+    config = {'cc_sounds': 'codriver', 'rbr_base_mod': 'cdA', 'rbr_base_package': 'numeric',
+              'pacenote_stats': 'stats.csv',
+              'skip_notes': {'we_are_lost': -1, 'corner_open_hairpin_left_rbr': 2061},
+              'map_cc_types': {'_corner_hairpin_right': 'corner_1_right_descriptive', '_detail_widens': 'detail_wideout'},
+              'codrivers': {}}
+    for codriver, codriver_seed in [('cdA', 1), ('cdB', 2)]:
+        packages = []
+        for i, type in enumerate(PACKAGES):
+            root = os.path.join(directory, 'assets', codriver, type, 'Plugins', 'Pacenote')
+            make_plugin(root, seed * 100 + codriver_seed * 10 + i, additional=(codriver == 'cdB'),
+                        map_files=MAP_FILES if codriver == 'cdB' else None)
+            package = {'name': type, 'base_dir': root, 'ini_files': ['Rbr.ini', 'Rbr-Enhanced.ini'], 'type': type}
+            if codriver == 'cdB' and type == 'numeric':
+                package['map_rbr_ids'] = {'_x': 'y', '0': 102, '11': 112, '1': ['descriptive', 1],
+                                          '102': 1, '4089': ['numeric', 'tightensbad'], '2030': 245, '23': 556}
+            packages.append(package)
+        config['codrivers'][codriver] = {'packages': packages}
+    config['codrivers']['cdB']['map_files'] = dict(MAP_FILES)
+    config['codrivers']['cdB']['additional_sounds_dir'] = 'additional'
+    config['codrivers']['cdB']['map_static'] = {
+        'number_1': ['numeric', '../../../x/start1.ogg', 140],
+        'detail_dont_cut_early': ['numeric', ['dont_cut_0.ogg', 'early_0.ogg'], 2016],
+        'cmp_into_corner_hairpin_left': ['descriptive', ['into_0.ogg', 'hp_left.ogg']],
+        'corner_hairpin_left_rushed': ['descriptive', 'hp_left.ogg', 0],
+    }
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=1)
+
+    rng = random.Random(seed + 5)
+    for id, name in CC_TYPES:
+        if rng.random() < 0.6:
+            write(f'{directory}/codriver/{name}/subtitles.csv', f'{name}_1.wav,{name} one\n{name}_2.wav,{name} two\n')
+            touch(f'{directory}/codriver/{name}/{name}_1.wav')
+    for name in ['cmp_into_corner_3_left', 'corner_4_right_rushed', 'cmp_into_corner_hairpin_left', 'number_5',
+                 'we_are_lost', 'corner_hairpin_left_rushed', 'detail_dont_cut_early', 'cmp_corner_2_left', '250']:
+        write(f'{directory}/codriver/{name}/subtitles.csv', f'a.wav,{name}\n')
+    for type in PACKAGES:
+        sounds_dir = os.path.join(directory, 'assets', 'cdB', type, 'Plugins', 'Pacenote', 'sounds', 'default')
+        for sound in ['into_0.ogg', 'hp_left.ogg', 'dont_cut_0.ogg', 'early_0.ogg']:
+            touch(os.path.join(sounds_dir, sound))
+        touch(os.path.normpath(os.path.join(sounds_dir, '..', '..', '..', 'x', 'start1.ogg')))
+    return config
+
+
+def make_plugin_dirs(directory):
+    # the plugins of the plugin tests and the golden files: three plain ones and
+    # one with mapped and additional sounds
+    plugins = {}
+    for seed in range(3):
+        plugins[seed] = os.path.join(directory, f'plain{seed}')
+        make_plugin(plugins[seed], seed)
+    plugins['additional'] = os.path.join(directory, 'additional')
+    make_plugin(plugins['additional'], 3, additional=True, map_files={'one_left_0.ogg': 'oneleft.ogg'})
+    return plugins
+
+
+def stable_hash(note):
+    # The tool takes the first of equal candidates in the order of a set of
+    # notes, and that order follows the string hash of the process. Hashed by
+    # their content instead, the notes come out in the same order in every run,
+    # so the outputs compare to the golden files.
+    key = repr((note.id, note.name, note.translation, sorted(set(note.sounds))))
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'little', signed=True)
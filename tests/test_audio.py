@@ -0,0 +1,220 @@
+import os
+import wave
+
+import pytest
+
+import audio
+from audio import AudioCache, TranscodeError, Transcoder
+
+
+def write_ogg(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def wav_info(filename):
+    with wave.open(filename, 'rb') as f:
+        return (f.getnchannels(), f.getsampwidth(), f.getframerate(), f.getnframes())
+
+
+def test_transcoder_converts_each_sound_once(tmp_path, fake_ffmpeg):
+    one = write_ogg(tmp_path / 'sounds' / 'one.ogg', b'OggS one')
+    two = write_ogg(tmp_path / 'sounds' / 'two.ogg', b'OggS two')
+    # another file with the same content is the same conversion
+    copy = write_ogg(tmp_path / 'other' / 'one.ogg', b'OggS one')
+    transcoder = Transcoder(jobs=2, cache=AudioCache(str(tmp_path / 'audio')))
+    for ogg in [one, two, one, copy]:
+        transcoder.add(ogg)
+    assert len(transcoder.conversions) == 3
+    wavs = [transcoder.convert(ogg) for ogg in [one, two, copy, one]]
+    assert sorted(fake_ffmpeg()) == sorted([one, two])
+    assert wavs[0] == wavs[2] == wavs[3] != wavs[1]
+    for wav in wavs:
+        assert wav.startswith(str(tmp_path / 'audio'))
+        assert wav_info(wav) == (1, 2, 22050, 6615)
+    assert (transcoder.cache.hits, transcoder.cache.misses) == (2, 2)
+
+    # a later build finds the conversions in the cache
+    transcoder = Transcoder(cache=AudioCache(str(tmp_path / 'audio')))
+    assert transcoder.wav(two) == wavs[1]
+    assert len(fake_ffmpeg()) == 2
+
+
+def test_transcoder_converts_changed_sounds_again(tmp_path, fake_ffmpeg):
+    ogg = write_ogg(tmp_path / 'one.ogg', b'OggS one')
+    cache = AudioCache(str(tmp_path / 'audio'))
+    before = Transcoder(cache=cache).wav(ogg)
+    write_ogg(tmp_path / 'one.ogg', b'OggS changed')
+    after = Transcoder(cache=cache).wav(ogg)
+    assert before != after
+    assert fake_ffmpeg() == [ogg, ogg]
+
+
+def test_transcoder_passes_paths_without_a_shell(tmp_path, fake_ffmpeg):
+    ogg = write_ogg(tmp_path / 'it\'s a "sound" $HOME; x.ogg', b'OggS quoted')
+    wav = Transcoder(cache=AudioCache(str(tmp_path / 'audio'))).wav(ogg)
+    assert fake_ffmpeg() == [ogg]
+    assert os.path.exists(wav)
+
+
+def test_transcoder_errors(tmp_path, fake_ffmpeg):
+    bad = write_ogg(tmp_path / 'bad.ogg', b'BAD data')
+    cache = AudioCache(str(tmp_path / 'audio'))
+    transcoder = Transcoder(cache=cache)
+    with pytest.raises(TranscodeError, match='Invalid data found'):
+        transcoder.wav(bad)
+    # nothing half written is left in the cache
+    assert cache.files() == []
+    assert not [name for root, dirs, names in os.walk(cache.directory) for name in names]
+    missing = str(tmp_path / 'missing.ogg')
+    with pytest.raises(FileNotFoundError):
+        transcoder.wav(missing)
+
+
+def write_sine(filename, frequency=440.0, seconds=0.5, framerate=22050, channels=1, sampwidth=2):
+    numpy = pytest.importorskip('numpy')
+    t = numpy.arange(int(seconds * framerate)) / framerate
+    y = numpy.sin(2 * numpy.pi * frequency * t)
+    if sampwidth == 1:
+        samples = numpy.round(y * 100 + 128).astype('u1')
+    else:
+        samples = numpy.round(y * 10000).astype('<i2')
+    samples = numpy.repeat(samples[:, None], channels, axis=1)
+    with wave.open(str(filename), 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(sampwidth)
+        f.setframerate(framerate)
+        f.writeframes(samples.tobytes())
+    return str(filename)
+
+
+def dominant_frequency(filename):
+    numpy = pytest.importorskip('numpy')
+    (params, frames) = audio.read_wav(filename)
+    x = numpy.frombuffer(frames, dtype=audio.SAMPLE_TYPES[params.sampwidth]).reshape(-1, params.nchannels)[:, 0]
+    x = x.astype(numpy.float64) - x.mean()
+    spectrum = numpy.abs(numpy.fft.rfft(x * numpy.hanning(len(x))))
+    return numpy.argmax(spectrum) * params.framerate / len(x)
+
+
+def test_render_concatenates(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio, 'sox', lambda *args: pytest.fail(f'sox {args}'))
+    one = write_sine(tmp_path / 'one.wav', 440, 0.2)
+    two = write_sine(tmp_path / 'two.wav', 660, 0.3)
+    audio.render([one, two], str(tmp_path / 'out.wav'))
+    (params, frames) = audio.read_wav(str(tmp_path / 'out.wav'))
+    assert (params.nchannels, params.sampwidth, params.framerate) == (1, 2, 22050)
+    assert frames == audio.read_wav(one)[1] + audio.read_wav(two)[1]
+
+
+def test_render_uses_sox_for_what_it_cannot_do(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(audio, 'sox', lambda *args: calls.append(args))
+    one = write_sine(tmp_path / 'one.wav', framerate=22050)
+    two = write_sine(tmp_path / 'two.wav', framerate=44100)
+    out = str(tmp_path / 'out.wav')
+    # different formats
+    audio.render([one, two], out)
+    # not a wav module can read
+    (tmp_path / 'float.wav').write_bytes(b'RIFF\0\0\0\0WAVEjunk')
+    audio.render([str(tmp_path / 'float.wav')], out, tempo=1.2)
+    # a tempo change without numpy
+    monkeypatch.setattr(audio, 'numpy', None)
+    audio.render([one], out, tempo=1.3)
+    assert calls == [(one, two, out), (str(tmp_path / 'float.wav'), out, 'tempo', '1.2'), (one, out, 'tempo', '1.3')]
+    assert not os.path.exists(out)
+
+
+@pytest.mark.parametrize('tempo', [1.1, 1.3, 1.5, 0.8])
+@pytest.mark.parametrize('channels, sampwidth', [(1, 2), (2, 2), (1, 1)])
+def test_stretch_keeps_the_pitch(tmp_path, tempo, channels, sampwidth):
+    source = write_sine(tmp_path / 'in.wav', 440, 1.0, channels=channels, sampwidth=sampwidth)
+    out = str(tmp_path / 'out.wav')
+    audio.render([source], out, tempo=tempo)
+    (params, frames) = audio.read_wav(out)
+    (source_params, source_frames) = audio.read_wav(source)
+    assert params == source_params._replace(nframes=params.nframes)
+    assert params.nframes == round(source_params.nframes / tempo)
+    # a resample would move 440 Hz to 440 * tempo
+    assert dominant_frequency(out) == pytest.approx(440, rel=0.03)
+
+
+def test_stretch_of_short_sounds(tmp_path):
+    source = write_sine(tmp_path / 'in.wav', 440, 0.001)
+    out = str(tmp_path / 'out.wav')
+    audio.render([source], out, tempo=1.3)
+    assert audio.read_wav(out)[1] == audio.read_wav(source)[1]
+
+
+def test_audio_cache_keys(tmp_path):
+    cache = AudioCache(str(tmp_path / 'audio'))
+    one = write_ogg(tmp_path / 'one.ogg', b'one')
+    two = write_ogg(tmp_path / 'two.ogg', b'two')
+    same = write_ogg(tmp_path / 'same.ogg', b'one')
+    key = cache.key('render', [one, two], 1.0)
+    assert key == cache.key('render', [same, two], 1.0)
+    assert len({key, cache.key('render', [two, one], 1.0), cache.key('render', [one, two], 1.2),
+                cache.key('ffmpeg', [one, two], 1.0), cache.key('render', [one], 1.0)}) == 5
+    # a changed source is a new key
+    write_ogg(tmp_path / 'one.ogg', b'changed')
+    assert cache.key('render', [one, two], 1.0) != key
+    # the files of the cache are keyed by their name
+    path = cache.create(cache.key('ffmpeg', [two]), lambda filename: open(filename, 'wb').write(b'wav'))
+    assert cache.digest(path) == cache.key('ffmpeg', [two])
+    assert cache.random(one).random() == cache.random(one).random() != cache.random(two).random()
+
+
+def test_audio_cache_get_and_create(tmp_path):
+    cache = AudioCache(str(tmp_path / 'audio'))
+    key = cache.key('ffmpeg', [write_ogg(tmp_path / 'one.ogg', b'one')])
+    assert cache.get(key) is None
+
+    def fail(filename):
+        open(filename, 'wb').write(b'half')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        cache.create(key, fail)
+    assert cache.get(key) is None
+    assert not [name for root, dirs, names in os.walk(cache.directory) for name in names]
+    path = cache.create(key, lambda filename: open(filename, 'wb').write(b'data'))
+    assert cache.get(key) == path == cache.path(key)
+    assert open(path, 'rb').read() == b'data'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_audio_cache_render_is_cached(tmp_path, monkeypatch):
+    cache = AudioCache(str(tmp_path / 'audio'))
+    one = write_sine(tmp_path / 'one.wav', 440, 0.2)
+    two = write_sine(tmp_path / 'two.wav', 660, 0.2)
+    first = cache.render([one, two], tempo=1.2)
+    monkeypatch.setattr(audio, 'render', lambda *args: pytest.fail('rendered again'))
+    assert cache.render([one, two], tempo=1.2) == first
+    with pytest.raises(pytest.fail.Exception):
+        cache.render([one, two], tempo=1.3)
+
+
+def test_audio_cache_prune_and_stats(tmp_path):
+    cache = AudioCache(str(tmp_path / 'audio'), max_size=250)
+    paths = []
+    for i in range(5):
+        key = cache.key('test', [], i)
+        paths.append(cache.create(key, lambda filename: open(filename, 'wb').write(b'x' * 100)))
+        os.utime(paths[-1], (1000 + i, 1000 + i))
+    # a hit makes the oldest file the newest
+    cache.get(cache.key('test', [], 0))
+    # a temporary file of a crashed build, only removed when it is old
+    (fresh, old) = (os.path.join(cache.directory, '.tmp-fresh.wav'), os.path.join(cache.directory, '.tmp-old.wav'))
+    for path in [fresh, old]:
+        open(path, 'wb').write(b'x' * 1000)
+    os.utime(old, (1000, 1000))
+
+    stats = cache.stats()
+    assert (stats['files'], stats['size'], stats['max_size'], stats['hits'], stats['misses']) == (5, 500, 250, 1, 5)
+    assert not os.path.exists(old) and os.path.exists(fresh)
+    assert cache.prune() == 3
+    assert [os.path.exists(path) for path in paths] == [True, False, False, False, True]
+    assert cache.prune(0) == 2
+    assert cache.stats()['files'] == 0
@@ -0,0 +1,252 @@
+import os
+import wave
+
+import pytest
+
+import codriver
+import golden
+import rbr_pacenote_plugin
+from audio import AudioCache, AudioError, Transcoder
+from golden import MAP_NOTES, make_codriver, read_golden
+from plugin_tree import make_codriver_tree, stable_hash
+from rbr_pacenote_plugin import RbrPacenote
+
+
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('codriver')
+    return (str(directory), make_codriver_tree(str(directory)))
+
+
+@pytest.fixture
+def config(tree, tmp_path, monkeypatch):
+    # the working directory of codriver.py, with a registry and a cache of the test
+    (directory, config) = tree
+    monkeypatch.chdir(directory)
+    monkeypatch.setenv('CC_CODRIVER_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setattr(rbr_pacenote_plugin, 'plugin_registry', {})
+    monkeypatch.setattr(codriver, 'base_dir', directory, raising=False)
+    # the notes come out of their sets in the order of the golden files
+    monkeypatch.setattr(RbrPacenote, '__hash__', stable_hash)
+    return config
+
+
+def baseline_targets(package, map_rbr_ids):
+    # the per lookup resolution of the baseline get_rbr_pacenotes for each rule
+    targets = {}
+    for from_id in map_rbr_ids:
+        (target_package, id, name) = (package, from_id, None)
+        for rule_id, to_id in map_rbr_ids.items():
+            if id == rule_id:
+                if isinstance(to_id, int):
+                    id = to_id
+                else:
+                    target_package = to_id[0]
+                    id = to_id[1]
+                if isinstance(id, str):
+                    name = id
+                    id = -1
+                break
+        targets[from_id] = (target_package, id, name)
+    return targets
+
+
+def test_compiled_map_rbr_ids_match_the_lookup(config):
+    cd = make_codriver(config, 'cdB')
+    map_rbr_ids = cd.map_rbr_ids['numeric']
+    # a rule with another package before one without
+    assert list(map_rbr_ids)[list(map_rbr_ids).index(1) + 1] == 102
+    assert cd.rbr_id_targets['numeric'] == baseline_targets('numeric', map_rbr_ids)
+    assert cd.rbr_id_targets['numeric'][102] == ('numeric', 1, None)
+    for package in cd.rbr_pacenote_plugins:
+        assert cd.rbr_id_targets[package] == baseline_targets(package, cd.map_rbr_ids[package])
+    # and every lookup finds the notes of the golden file
+    assert golden.map_rbr_ids_lookups(cd) == read_golden('lookups-map-rbr-ids.json')
+
+
+@pytest.mark.parametrize('fallback_to_base', [False, True])
+@pytest.mark.parametrize('name', ['cdA', 'cdB'])
+def test_cc_list_csv_matches_golden(config, name, fallback_to_base):
+    rows = golden.cc_list_csv(make_codriver(config, name, fallback_to_base=fallback_to_base))
+    assert len(rows) > 200
+    assert any(row.startswith('rbr_base_note,') for row in rows) == fallback_to_base
+    assert rows == read_golden(f'cc-{name}{"-fallback" if fallback_to_base else ""}.csv')
+
+
+def test_mapping_is_computed_once(config, capsys, monkeypatch):
+    cd = make_codriver(config, 'cdB', fallback_to_base=True)
+    rows = golden.cc_list_csv(cd)
+    calls = []
+    map_cc_sounds = codriver.CoDriver.map_cc_sounds
+    monkeypatch.setattr(codriver.CoDriver, 'map_cc_sounds', lambda self: calls.append(self) or map_cc_sounds(self))
+    mapping = cd.mapped_notes()
+    unmapped = cd.unmapped_base_mod_notes()
+    cd.cc_list_csv()
+    assert capsys.readouterr().out.splitlines() == rows
+    assert cd.mapped_notes() is mapping and cd.unmapped_base_mod_notes() is unmapped
+    assert calls == []
+
+    # mapping the cc sounds again, here or in the base codriver, starts over
+    cd.map_notes_from_cc()
+    assert cd.mapped_notes() is not mapping
+    assert calls == [cd]
+    cd.base_codriver.map_notes_from_cc()
+    assert golden.cc_list_csv(cd) == rows
+    assert calls == [cd, cd.base_codriver, cd]
+
+
+@pytest.mark.parametrize('name', ['cdA', 'cdB'])
+def test_mapped_cc_notes_match_golden(config, name):
+    cd = make_codriver(config, name)
+    assert len(golden.mapped_cc_notes(cd)) > 100
+    assert golden.mapped_cc_notes(cd) == read_golden('mapped-cc-notes.json')[name]
+    # every row refers to the mapped note of its cc sound
+    for note in cd.mapped_notes():
+        assert note.cc_note is cd.mapped_cc_notes.get(note.type)
+
+
+@pytest.mark.parametrize('fallback_to_base', [False, True])
+def test_unmapped_base_mod_notes_match_golden(config, fallback_to_base):
+    cd = make_codriver(config, 'cdB', fallback_to_base=fallback_to_base)
+    rows = golden.unmapped_csv(cd)
+    assert len(rows) > 50
+    assert {note.src for note in cd.unmapped_base_mod_notes()} >= \
+        {'rbr_base_note_cc_type', 'rbr_base_note_cc_modifier', 'rbr_base_note_no_cc_type'}
+    assert rows == read_golden(f'unmapped-cdB{"-fallback" if fallback_to_base else ""}.csv')
+
+
+@pytest.mark.parametrize('package', ['all', 'numeric'])
+@pytest.mark.parametrize('name', ['cdA', 'cdB'])
+def test_rbr_list_csv_matches_golden(config, name, package):
+    rows = golden.rbr_list_csv(make_codriver(config, name, package=package))
+    # the numeric plugin of cdA is the base mod itself
+    assert any(row.startswith('base_mod,') for row in rows) == ((name, package) != ('cdA', 'numeric'))
+    assert rows == read_golden(f'rbr-{name}-{package}.csv')
+
+
+def baseline_apply_map_notes(map_notes, id, name):
+    # the loop of the baseline get_rbr_pacenotes
+    for mapping in map_notes:
+        cc_id = mapping.get('cc_id')
+        if id == cc_id:
+            id = mapping.get('rbr_id', id)
+            name = mapping.get('rbr_name', name)
+        cc_name = mapping.get('cc_name')
+        if name == cc_name:
+            id = mapping.get('rbr_id', id)
+            name = mapping.get('rbr_name', name)
+    return (id, name)
+
+
+def test_compiled_map_notes_match_the_lookup(config):
+    config = dict(config, map_notes=MAP_NOTES)
+    cd = make_codriver(config, 'cdA')
+    types = list(cd.cc_pacenotes_types.values()) + list(cd.cc_pacenotes_modifiers.values())
+    lookups = [(type.id, type.rbr_name()) for type in types] + [(2, 'x'), (5, 'three_right'), (-1, 'wideout'), (0, 'one_left')]
+    for id, name in lookups:
+        assert cd.apply_map_notes(id, name) == baseline_apply_map_notes(MAP_NOTES, id, name), (id, name)
+    assert cd.apply_map_notes(5, 'three_right') == (2, 'wideout')
+    assert cd.apply_map_notes(2, 'two') == (3, 'into')
+
+    assert golden.map_notes_lookups(cd) == read_golden('lookups-map-notes.json')
+    assert golden.cc_list_csv(cd) == read_golden('cc-cdA-map-notes.csv')
+
+
+def test_cc_type_lookup_matches_golden(config):
+    assert golden.cc_types(make_codriver(config, 'cdA')) == read_golden('cc-types.json')
+
+
+@pytest.fixture
+def build_sounds(tmp_path):
+    # oggs for the fake ffmpeg, a wav like Go.wav of the game and an original
+    # crew chief directory
+    directory = tmp_path / 'sounds'
+    directory.mkdir()
+    for name in ['one.ogg', 'two.ogg', 'into.ogg']:
+        (directory / name).write_bytes(b'OggS ' + name.encode('ascii'))
+    with wave.open(str(directory / 'Go.wav'), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(22050)
+        f.writeframes(b'\x10\x00' * 2205)
+    original = tmp_path / 'original'
+    original.mkdir()
+    (original / 'subtitles.csv').write_text('original.wav,Original\n')
+    (original / 'original.wav').write_bytes(b'RIFF original')
+    return (str(directory), str(original))
+
+
+def mapped_note(name, sound, sounds_dir, translation='', prefix=None, rushed=False):
+    cc_note = codriver.CrewChiefNote(name)
+    cc_note.rushed = rushed
+    if prefix:
+        cc_note.add_prefix(codriver.CrewChiefNote(prefix.name))
+        cc_note.prefix.add_note(prefix)
+    cc_note.add_note(RbrPacenote(name, sounds=[sound], translation=translation, sounds_dir=sounds_dir))
+    note = codriver.MappedNote()
+    note.cc_note = cc_note
+    note.rbr_note = cc_note.notes[0]
+    note.file = sound
+    return note
+
+
+def test_codriver_build(build_sounds, tmp_path, fake_ffmpeg):
+    (sounds, original) = build_sounds
+    transcoder = Transcoder(jobs=4, cache=AudioCache(str(tmp_path / 'audio')))
+    build = codriver.CodriverBuild(transcoder)
+    into = RbrPacenote('into', sounds=['into.ogg'], translation='Into', sounds_dir=sounds)
+    (first, second) = (str(tmp_path / 'out' / 'first'), str(tmp_path / 'out' / 'second'))
+    notes = [
+        (mapped_note('one', 'one.ogg', sounds, 'One'), first),
+        (mapped_note('go', 'Go.wav', sounds, 'Go'), first),
+        (mapped_note('one', 'one.ogg', sounds, 'One', prefix=into, rushed=True), first),
+        (mapped_note('two', 'two.ogg', sounds, 'Two'), second),
+    ]
+    for note, dst_path in notes:
+        build.add_note(note, dst_path)
+    # the original subtitles replace the rows of the notes added so far
+    for file in sorted(os.listdir(original)):
+        build.add_file(os.path.join(original, file), second)
+    # the same file again, the last note wins
+    build.add_note(mapped_note('go', 'Go.wav', sounds, 'Go again'), second)
+    build.run()
+
+    # every ogg is converted once, the wav is not converted
+    assert sorted(fake_ffmpeg()) == sorted(os.path.join(sounds, x) for x in ['into.ogg', 'one.ogg', 'two.ogg'])
+    assert sorted(os.listdir(first)) == ['Go.wav', 'one.wav', 'rushed_into_one.wav', 'subtitles.csv']
+    assert sorted(os.listdir(second)) == ['Go.wav', 'original.wav', 'subtitles.csv', 'two.wav']
+    with open(os.path.join(sounds, 'Go.wav'), 'rb') as f:
+        go = f.read()
+    for dst_path in [first, second]:
+        with open(os.path.join(dst_path, 'Go.wav'), 'rb') as f:
+            assert f.read() == go
+    with open(os.path.join(second, 'original.wav'), 'rb') as f:
+        assert f.read() == b'RIFF original'
+    with open(os.path.join(first, 'subtitles.csv')) as f:
+        assert f.read() == 'one.wav,One\nGo.wav,Go\nrushed_into_one.wav,One\n'
+    with open(os.path.join(second, 'subtitles.csv')) as f:
+        assert f.read() == 'original.wav,Original\nGo.wav,Go again\n'
+
+    # the same sounds as copying one note after the other
+    for note, dst_path in notes[:3]:
+        cc_note = note.get_cc_note()
+        prefix = cc_note.prefix.notes[0] if cc_note.prefix else None
+        (wave_fullname, wave_filename) = note.get_rbr_note().sound_as_wav(note.file, prefix=prefix, rushed=cc_note.rushed, transcoder=transcoder)
+        with open(wave_fullname, 'rb') as f, open(os.path.join(dst_path, wave_filename), 'rb') as placed:
+            assert f.read() == placed.read()
+
+
+def test_codriver_build_failures(build_sounds, tmp_path, fake_ffmpeg):
+    (sounds, original) = build_sounds
+    with open(os.path.join(sounds, 'bad.ogg'), 'wb') as f:
+        f.write(b'BAD data')
+    build = codriver.CodriverBuild(Transcoder(jobs=2, cache=AudioCache(str(tmp_path / 'audio'))))
+    dst_path = str(tmp_path / 'out')
+    build.add_note(mapped_note('bad', 'bad.ogg', sounds, 'Bad'), dst_path)
+    build.add_note(mapped_note('one', 'one.ogg', sounds, 'One'), dst_path)
+    with pytest.raises(AudioError, match='3 of 5 tasks of the build failed'):
+        build.run()
+    # the conversion, its copy and the subtitles fail, the good sound is placed
+    assert sorted(os.listdir(dst_path)) == ['one.wav']
+    with pytest.raises(FileNotFoundError):
+        build.add_note(mapped_note('missing', 'missing.ogg', sounds), dst_path)
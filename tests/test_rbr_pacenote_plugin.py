@@ -0,0 +1,446 @@
+import os
+import pickle
+import re
+import struct
+import wave
+
+import pytest
+
+import rbr_pacenote_plugin
+from audio import AudioCache, Transcoder
+from golden import PLUGIN_ARGS, plugin_rows, plugin_translations, read_golden
+from plugin_tree import make_plugin, make_plugin_dirs
+from rbr_pacenote_plugin import RbrPacenote, RbrPacenotePlugin, load_plugin, load_plugins
+from task_graph import TaskGraph
+
+
+@pytest.fixture(scope='module')
+def plugin_dirs(tmp_path_factory):
+    return make_plugin_dirs(str(tmp_path_factory.mktemp('plugins')))
+
+
+def note_rows(plugin):
+    rows = []
+    for note in plugin.pacenotes:
+        rows.append((note.id, note.name, note.type, note.category, note.package, note.ini,
+                     tuple(sorted(note.sounds)), tuple(note.sounds_not_found), tuple(sorted(note.sounds_mapped.items())),
+                     note.sound_count, note.translation, note.sounds_dir))
+    return sorted(rows)
+
+
+@pytest.mark.parametrize('name', [0, 1, 2, 'additional'])
+def test_plugin_matches_golden(plugin_dirs, name):
+    plugin = RbrPacenotePlugin(plugin_dirs[name], **PLUGIN_ARGS.get(name, {}))
+    assert len(plugin.pacenotes) > 50
+    # with the sounds of each note in their order, the baseline hash sorted them
+    assert plugin_rows(plugin) == read_golden('plugins.json')[str(name)]
+
+
+def test_translate_matches_golden(plugin_dirs):
+    plugin = RbrPacenotePlugin(plugin_dirs[0])
+    translations = plugin_translations(plugin)
+    assert len(translations) > 3
+    assert sum(map(len, translations.values())) > len(plugin.pacenotes)
+    assert translations == read_golden('translations.json')
+
+
+def test_translate_first_file_wins(tmp_path):
+    root = str(tmp_path)
+    make_plugin(root, 0)
+    language = os.path.join(root, 'language', 'english', 'pacenotes')
+    with open(os.path.join(language, 'packages', 'corners', 'corners.ini'), 'w', encoding='utf-8') as f:
+        f.write('﻿[STRINGS]\nsome_note = Category file\n')
+    with open(os.path.join(language, 'packages', 'corners', 'strings.ini'), 'w', encoding='utf-8') as f:
+        f.write('[STRINGS]\nsome_note = Category strings\nother_note = Category strings\n')
+    with open(os.path.join(language, 'strings.ini'), 'w', encoding='utf-8') as f:
+        f.write('[STRINGS]\nsome_note = Top\nother_note = Top\nlast_note = Top\n')
+    plugin = RbrPacenotePlugin(root)
+    assert plugin.translate('some_note', 'Corners', 'corners.ini') == 'Category file'
+    assert plugin.translate('other_note', 'Corners', 'corners.ini') == 'Category strings'
+    assert plugin.translate('last_note', 'Corners', 'corners.ini') == 'Top'
+    assert plugin.translate('some_note', 'Details', 'details.ini') == 'Top'
+    # numeric names are their own translation, others have none
+    assert plugin.translate('100', 'Corners', 'corners.ini') == '100'
+    assert plugin.translate('nothing', 'Corners', 'corners.ini') == ''
+
+
+def test_language_files_are_read_once(plugin_dirs, monkeypatch):
+    files = []
+    strings = RbrPacenotePlugin.strings
+
+    def counting_strings(self, file):
+        files.append(file)
+        return strings(self, file)
+
+    monkeypatch.setattr(RbrPacenotePlugin, 'strings', counting_strings)
+    plugin = RbrPacenotePlugin(plugin_dirs[1])
+    assert len(files) == len(set(files))
+    assert set(files) == set(plugin.language_strings)
+
+
+def test_sound_exists_matches_os_path_exists(plugin_dirs):
+    plugin = RbrPacenotePlugin(plugin_dirs['additional'], **PLUGIN_ARGS['additional'])
+    sounds = set()
+    for note in plugin.pacenotes:
+        for sound in note.sounds:
+            (base, ext) = os.path.splitext(sound)
+            sounds |= {sound, f'{base}_0{ext}', os.path.join('additional', f'{base}_1{ext}'), sound.upper()}
+    sounds |= {'../../../PaceNote.ini', '../default/toplevel.ogg', 'nope/none.ogg'}
+    assert len(sounds) > 100
+    for sound in sorted(sounds):
+        assert plugin.sound_exists(sound) == os.path.exists(plugin.sound_file(sound)), sound
+
+
+def test_sound_exists_ignores_case_like_windows(tmp_path, monkeypatch):
+    # normcase lower cases on Windows, where the file system does not care either
+    monkeypatch.setattr(os.path, 'normcase', str.lower)
+    root = str(tmp_path)
+    make_plugin(root, 0)
+    with open(os.path.join(root, 'sounds', 'default', 'Mixed_Case.OGG'), 'wb') as f:
+        f.write(b'OggS')
+    plugin = RbrPacenotePlugin(root)
+    assert plugin.sound_exists('mixed_case.ogg')
+    assert plugin.sound_exists('MIXED_CASE.ogg')
+    assert plugin.sound_exists('../DEFAULT/Mixed_Case.OGG')
+    assert not plugin.sound_exists('mixed_case.wav')
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='needs symlinks')
+def test_scan_does_not_follow_directory_links(tmp_path):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 0)
+    sounds_dir = os.path.join(root, 'sounds', 'default')
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'linked.ogg').write_bytes(b'OggS')
+    try:
+        # a loop back to the sounds directory and a link to another directory
+        os.symlink(sounds_dir, os.path.join(sounds_dir, 'loop'), target_is_directory=True)
+        os.symlink(str(other), os.path.join(sounds_dir, 'other'), target_is_directory=True)
+        os.symlink(os.path.join(sounds_dir, 'toplevel.ogg'), os.path.join(sounds_dir, 'file_link.ogg'))
+    except OSError:
+        pytest.skip('cannot create symlinks')
+    plugin = RbrPacenotePlugin(root)
+    assert not any('loop' in x for x in plugin.sound_files)
+    for sound in ['loop/toplevel.ogg', 'loop/loop/toplevel.ogg', 'other/linked.ogg', 'other/missing.ogg',
+                  'file_link.ogg', 'toplevel.ogg']:
+        assert plugin.sound_exists(sound) == os.path.exists(plugin.sound_file(sound)), sound
+
+
+@pytest.mark.parametrize('name', [0, 'additional'])
+def test_id_and_name_index_match_scans(plugin_dirs, name):
+    plugin = RbrPacenotePlugin(plugin_dirs[name], **PLUGIN_ARGS.get(name, {}))
+    ids = {note.id for note in plugin.pacenotes} | {-2, 99999}
+    names = {note.name for note in plugin.pacenotes} | {'ONE_LEFT', 'One_Left', 'no_such_note'}
+    assert any(len(plugin.pacenotes_with_id(id)) > 1 for id in ids)
+    assert any(len(plugin.pacenotes_with_name(name)) > 1 for name in names)
+    for id in ids:
+        # the scans of the baseline CoDriver.get_rbr_pacenotes_by_id
+        expected = [note for note in plugin.pacenotes if note.id == id]
+        assert sorted(plugin.pacenotes_with_id(id), key=repr) == sorted(expected, key=repr)
+    for name in names:
+        expected = [note for note in plugin.pacenotes if note.name.lower() == name.lower()]
+        assert sorted(plugin.pacenotes_with_name(name), key=repr) == sorted(expected, key=repr)
+
+
+def test_index_follows_add_pacenote(plugin_dirs):
+    plugin = RbrPacenotePlugin(plugin_dirs[0])
+    note = next(iter(plugin.pacenotes_with_name('toplevel')))
+    count = len(plugin.pacenotes)
+    # an equal note is not added twice, the lists handed out are copies
+    plugin.add_pacenote(RbrPacenote(note.name, id=note.id, sounds=reversed(note.sounds), translation=note.translation,
+                                    package='Other'))
+    assert len(plugin.pacenotes) == count
+    assert plugin.pacenotes_with_id(note.id) == [note]
+    plugin.pacenotes_with_id(note.id).clear()
+    assert plugin.pacenotes_with_name('TopLevel') == [note]
+    new_note = RbrPacenote('NewNote', id=note.id, sounds=['new.ogg'])
+    plugin.add_pacenote(new_note)
+    assert plugin.pacenotes_with_id(note.id) == [note, new_note]
+    assert plugin.pacenotes_with_name('newnote') == [new_note]
+
+
+def test_note_hash_agrees_with_eq():
+    note = RbrPacenote('one_left', id=3, sounds=['b.ogg', 'a.ogg'], translation='One left', package='Main')
+    same = RbrPacenote('one_left', id=3, sounds=('a.ogg', 'b.ogg'), translation='One left', package='Other',
+                       category='Corners', ini='x.ini')
+    assert note == same and hash(note) == hash(same)
+    assert len({note, same}) == 1
+    for other in [RbrPacenote('one_left', id=4, sounds=['a.ogg', 'b.ogg'], translation='One left'),
+                  RbrPacenote('one_right', id=3, sounds=['a.ogg', 'b.ogg'], translation='One left'),
+                  RbrPacenote('one_left', id=3, sounds=['a.ogg'], translation='One left'),
+                  RbrPacenote('one_left', id=3, sounds=['a.ogg', 'b.ogg'], translation='One Left')]:
+        assert note != other
+        assert len({note, other}) == 2
+    assert note != 'one_left'
+
+
+def test_note_is_immutable_and_pickles():
+    note = RbrPacenote('one_left', id=3, sounds=['a.ogg'], sounds_mapped={'x.ogg': 'a.ogg'}, translation='One left')
+    with pytest.raises(AttributeError):
+        note.translation = 'Other'
+    with pytest.raises(AttributeError):
+        del note.name
+    with pytest.raises(AttributeError):
+        note.extra = 1
+    assert isinstance(note.sounds, tuple)
+    copy = pickle.loads(pickle.dumps(note))
+    assert copy == note and hash(copy) == hash(note)
+    assert (copy.sounds, copy.sounds_mapped, copy.translation) == (note.sounds, note.sounds_mapped, note.translation)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    # an empty plugin registry and a cache directory of the test
+    monkeypatch.setenv('CC_CODRIVER_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setattr(rbr_pacenote_plugin, 'plugin_registry', {})
+    return rbr_pacenote_plugin.plugin_registry
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # the plugin directories read by RbrPacenotePlugin, in order
+    reads = []
+    init = RbrPacenotePlugin.__init__
+
+    def recording_init(self, plugin_dir, *args, **kwargs):
+        reads.append(plugin_dir)
+        init(self, plugin_dir, *args, **kwargs)
+
+    monkeypatch.setattr(RbrPacenotePlugin, '__init__', recording_init)
+    return reads
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_load_plugins_reads_each_plugin_once_in_order(plugin_dirs, registry, reads, jobs):
+    ini_files = ['Rbr.ini', 'Rbr-Enhanced.ini']
+    plugins = [(plugin_dirs[2], ini_files, {}, ''),
+               (plugin_dirs[0], ini_files, {}, ''),
+               (plugin_dirs[2], ini_files, {}, ''),
+               (plugin_dirs[0], ini_files, {'one_left_0.ogg': 'oneleft.ogg'}, '')]
+    loaded = load_plugins(plugins, snapshots=False, jobs=jobs)
+    # with a pool the plugins are read in the worker processes
+    assert reads == ([plugin_dirs[2], plugin_dirs[0], plugin_dirs[0]] if jobs == 1 else [])
+    assert len(registry) == 3
+    assert loaded[0] is loaded[2]
+    assert loaded[1] is not loaded[3]
+    for args, plugin in zip(plugins, loaded):
+        assert plugin.plugin_dir == args[0]
+        assert note_rows(plugin) == note_rows(RbrPacenotePlugin(args[0], ini_files=args[1], map_files=args[2]))
+
+    # a second codriver with the same plugins reads nothing
+    reads.clear()
+    assert load_plugins(plugins[:2], snapshots=False, jobs=jobs) == loaded[:2]
+    assert reads == []
+
+
+def load_fresh(plugin_dir, **kwargs):
+    # load_plugin as in a new process, with the snapshots of earlier ones
+    rbr_pacenote_plugin.plugin_registry.clear()
+    return load_plugin(plugin_dir, **kwargs)
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def touch_ini(root):
+    bump_mtime(os.path.join(root, 'config', 'pacenotes', 'packages', 'shared', 'shared.ini'))
+
+
+def touch_language_file(root):
+    bump_mtime(os.path.join(root, 'language', 'english', 'pacenotes', 'strings.ini'))
+
+
+def remove_sound(root):
+    os.remove(os.path.join(root, 'sounds', 'default', 'toplevel.ogg'))
+
+
+def add_missing_include(root):
+    # packages/enh.ini includes missing/nope.ini
+    directory = os.path.join(root, 'config', 'pacenotes', 'packages', 'missing')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'nope.ini'), 'w') as f:
+        f.write('[PACENOTE::NEW_NOTE]\nid=4242\nSounds=1\nsnd0=toplevel.ogg\n')
+
+
+@pytest.mark.parametrize('change', [touch_ini, touch_language_file, remove_sound, add_missing_include])
+def test_snapshot_is_invalidated_by_changes(tmp_path, registry, reads, change):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 5)
+    plugin = load_fresh(root)
+    snapshot = load_fresh(root)
+    assert reads == [root]
+    assert snapshot is not plugin
+    assert note_rows(snapshot) == note_rows(plugin)
+
+    change(root)
+    changed = load_fresh(root)
+    assert reads == [root, root]
+    assert note_rows(changed) == note_rows(RbrPacenotePlugin(root))
+    # and the new snapshot is used again
+    reads.clear()
+    assert note_rows(load_fresh(root)) == note_rows(changed)
+    assert reads == []
+
+
+def test_snapshot_key_version_and_corruption(tmp_path, registry, monkeypatch):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 6)
+    plugin = load_fresh(root)
+    key = rbr_pacenote_plugin.plugin_key(root, ['Rbr.ini', 'Rbr-Enhanced.ini'], {}, '')
+    assert note_rows(rbr_pacenote_plugin.read_snapshot(key)) == note_rows(plugin)
+    # other arguments, other snapshot
+    assert rbr_pacenote_plugin.read_snapshot(rbr_pacenote_plugin.plugin_key(root, ['Rbr.ini'], {}, '')) is None
+
+    with monkeypatch.context() as patch:
+        patch.setattr(rbr_pacenote_plugin, 'PLUGIN_SNAPSHOT_VERSION', rbr_pacenote_plugin.PLUGIN_SNAPSHOT_VERSION + 1)
+        assert rbr_pacenote_plugin.read_snapshot(key) is None
+
+    with open(rbr_pacenote_plugin.snapshot_filename(key), 'wb') as f:
+        f.write(b'not a pickle')
+    assert rbr_pacenote_plugin.read_snapshot(key) is None
+    assert note_rows(load_plugin(root, snapshots=False)) == note_rows(plugin)
+
+
+def test_no_snapshots_written_without_snapshots(tmp_path, registry):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 7)
+    load_fresh(root, snapshots=False)
+    assert not os.path.exists(tmp_path / 'cache' / 'plugins') or not os.listdir(tmp_path / 'cache' / 'plugins')
+
+
+def include_graph(plugin):
+    # the include graph without the parse times and with / as separator
+    return [re.sub(r'\d+\.\d\d ms$', 'ms', line).replace(os.sep, '/') for line in plugin.include_graph()]
+
+
+INCLUDE_GRAPH = [
+    'config/pacenotes/Rbr.ini [/] ms',
+    '  config/pacenotes/packages/main.ini [Main/] ms',
+    '    config/pacenotes/packages/corners/corners.ini [Main/Corners] ms',
+    '    config/pacenotes/packages/details/details.ini [Main/Details] ms',
+    '    config/pacenotes/packages/shared/shared.ini [Main/Details] ms',
+    'config/pacenotes/Rbr-Enhanced.ini [/] ms',
+    '  config/pacenotes/packages/enh.ini [Enhanced/] ms',
+    '    config/pacenotes/packages/shared/shared.ini [Enhanced/Shared] parsed before',
+    '    config/pacenotes/packages/missing/nope.ini [Enhanced/Shared] not found',
+    'config/ranges/Rbr.ini [/] ms',
+]
+
+
+def test_include_graph(plugin_dirs):
+    plugin = RbrPacenotePlugin(plugin_dirs[0])
+    assert include_graph(plugin) == INCLUDE_GRAPH
+    # only needed while reading
+    assert plugin.parsed_ini == {}
+
+
+def test_include_graph_of_a_snapshot_has_no_parse_times(tmp_path, registry):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 0)
+    assert any(line.endswith(' ms') for line in load_fresh(root).include_graph())
+    graph = load_fresh(root).include_graph()
+    assert not any(line.endswith(' ms') for line in graph)
+    assert [line.replace('from snapshot', 'ms') for line in graph] == include_graph(RbrPacenotePlugin(root))
+
+
+def test_include_cycles_are_skipped(tmp_path):
+    root = str(tmp_path / 'plugin')
+    make_plugin(root, 0)
+    packages = os.path.join(root, 'config', 'pacenotes', 'packages')
+    # main.ini includes itself through loop.ini, loop.ini includes itself
+    with open(os.path.join(packages, 'main.ini'), 'a') as f:
+        f.write('\n[CATEGORY::Loop]\nfile0=loop.ini\n')
+    with open(os.path.join(packages, 'loop.ini'), 'w') as f:
+        f.write('[CATEGORY::Loop]\nfile0=main.ini\nfile1=loop.ini\n\n[PACENOTE::LOOP_NOTE]\nid=4343\nSounds=1\nsnd0=toplevel.ogg\n')
+    plugin = RbrPacenotePlugin(root)
+    graph = include_graph(plugin)
+    loop = graph.index('    config/pacenotes/packages/loop.ini [Main/Loop] ms')
+    assert graph[loop + 1:loop + 3] == [
+        '      config/pacenotes/packages/main.ini [Main/Loop] cycle',
+        '      config/pacenotes/packages/loop.ini [Main/Loop] cycle',
+    ]
+    assert [note.category for note in plugin.pacenotes_with_name('loop_note')] == ['Loop']
+    # the rest of the plugin is read as without the loop
+    make_plugin(str(tmp_path / 'expected'), 0)
+    expected = RbrPacenotePlugin(str(tmp_path / 'expected'))
+    assert {note.name for note in plugin.pacenotes} == {note.name for note in expected.pacenotes} | {'loop_note'}
+    assert len(plugin.pacenotes) == len(expected.pacenotes) + 1
+
+
+def write_wav(path, frames=2205, value=1000):
+    # a wav sound like the static ones of the game, in the format of the fake ffmpeg
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(22050)
+        f.writeframes(struct.pack('<h', value) * frames)
+    return path
+
+
+@pytest.fixture
+def sounds(tmp_path):
+    directory = str(tmp_path / 'sounds')
+    for name in ['one.ogg', 'into.ogg']:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(b'OggS ' + name.encode('ascii'))
+    write_wav(os.path.join(directory, 'static', 'Go.wav'))
+    return directory
+
+
+def test_sound_as_wav(sounds, tmp_path, fake_ffmpeg):
+    transcoder = Transcoder(cache=AudioCache(str(tmp_path / 'audio')))
+    one = RbrPacenote('one', sounds=['one.ogg'], sounds_dir=sounds)
+    (wave_fullname, wave_filename) = one.sound_as_wav('one.ogg', transcoder=transcoder)
+    assert wave_filename == 'one.wav'
+    assert wave_fullname == transcoder.wav(os.path.join(sounds, 'one.ogg'))
+    assert fake_ffmpeg() == [os.path.join(sounds, 'one.ogg')]
+
+    into = RbrPacenote('into', sounds=['into.ogg'], sounds_dir=sounds)
+    (wave_fullname, wave_filename) = one.sound_as_wav('one.ogg', prefix=into, rushed=True, transcoder=transcoder)
+    assert wave_filename == 'rushed_into_one.wav'
+    assert wave_fullname.startswith(str(tmp_path / 'audio'))
+    with pytest.raises(FileNotFoundError):
+        one.sound_as_wav('missing.ogg', transcoder=transcoder)
+
+
+def test_wav_sounds_are_not_converted(sounds, tmp_path, fake_ffmpeg):
+    transcoder = Transcoder(cache=AudioCache(str(tmp_path / 'audio')))
+    go = RbrPacenote('static/Go.wav', sounds=['static/Go.wav'], sounds_dir=sounds)
+    source = os.path.join(sounds, 'static', 'Go.wav')
+    assert go.sound_as_wav('static/Go.wav', transcoder=transcoder) == (source, 'static/Go.wav')
+
+    graph = TaskGraph()
+    (task, wave_filename) = go.add_wav_task(graph, transcoder, 'static/Go.wav')
+    assert wave_filename == 'static/Go.wav'
+    assert graph.run(jobs=1) == {}
+    assert graph.results[task] == source
+    # composed with an ogg, only the ogg is converted
+    into = RbrPacenote('into', sounds=['into.ogg'], sounds_dir=sounds)
+    (wave_fullname, wave_filename) = go.sound_as_wav('static/Go.wav', prefix=into, transcoder=transcoder)
+    assert wave_filename == 'into_static-Go.wav'
+    assert fake_ffmpeg() == [os.path.join(sounds, 'into.ogg')]
+    with wave.open(wave_fullname, 'rb') as f:
+        assert f.getnframes() == 6615 + 2205
+    assert transcoder.conversions.keys() == {os.path.join(sounds, 'into.ogg')}
+
+
+def test_add_wav_task_matches_sound_as_wav(sounds, tmp_path, fake_ffmpeg):
+    transcoder = Transcoder(cache=AudioCache(str(tmp_path / 'audio')))
+    one = RbrPacenote('one', sounds=['one.ogg'], sounds_dir=sounds)
+    into = RbrPacenote('into', sounds=['into.ogg'], sounds_dir=sounds)
+    graph = TaskGraph()
+    tasks = {}
+    for prefix in [None, into]:
+        for rushed in [False, True]:
+            tasks[(prefix, rushed)] = one.add_wav_task(graph, transcoder, 'one.ogg', prefix=prefix, rushed=rushed)
+    # one conversion per ogg, shared by the tasks
+    assert len([key for key in graph.tasks if key[0] == 'ffmpeg']) == 2
+    assert graph.run(jobs=2) == {}
+    for (prefix, rushed), (task, wave_filename) in tasks.items():
+        assert one.sound_as_wav('one.ogg', prefix=prefix, rushed=rushed, transcoder=transcoder) == (graph.results[task], wave_filename)
+    assert sorted(fake_ffmpeg()) == sorted(os.path.join(sounds, x) for x in ['into.ogg', 'one.ogg'])
@@ -0,0 +1,230 @@
+import codecs
+import csv
+import io
+import configparser
+import logging
+import random
+
+import pytest
+
+from roadbook import Note, Roadbook, Roadbooks, parse_pacenotes
+from roadbook_bench import generate_stage
+from roadbook_cache import RoadbookCache
+
+
+def configparser_notes(data):
+    # the notes the way Roadbook.read_ini read them with configparser
+    for bom, encoding in [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]:
+        if data.startswith(bom):
+            break
+    else:
+        encoding = 'cp1252'
+    config = configparser.ConfigParser(strict=False)
+    config.read_string(data.decode(encoding))
+
+    num_notes = 0
+    notes = {}
+    for section in config.sections():
+        if section == 'PACENOTES':
+            num_notes = config.getint(section, 'count')
+            continue
+        if section.startswith('P') and section[1:].isdigit():
+            note_type = config.getint(section, 'type')
+            distance = config.getfloat(section, 'distance')
+            flag = config.getint(section, 'flag')
+            if note_type > 6_000_000:
+                continue
+            if flag > 65_000:
+                flag = 0
+            notes[int(section[1:])] = (note_type, distance, flag)
+    return num_notes, notes
+
+
+def tokenizer_notes(tmp_path, data):
+    filename = tmp_path / 'stage.ini'
+    filename.write_bytes(data)
+    book = Roadbook(str(filename))
+    notes = {note_id: (note_type, distance, flag)
+             for note_id, note_type, distance, flag in zip(book.ids, book.types, book.distances, book.flags)}
+    return book.num_notes, notes
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_notes_as_configparser(tmp_path, seed):
+    rng = random.Random(seed)
+    data = generate_stage(rng, rng.randint(1, 300), bom=seed % 4 == 0, crlf=seed % 2 == 0)
+    assert tokenizer_notes(tmp_path, data) == configparser_notes(data)
+
+
+def test_quirks_like_configparser(tmp_path):
+    data = '\r\n'.join([
+        '; comment',
+        '[PACENOTES]',
+        'count: 4',
+        '[P0]',
+        'TYPE = 7000000',
+        'distance = 1',
+        'flag = 0',
+        '[P1]',
+        'type=12',
+        'distance =2.5',
+        'flag = 70000',
+        '# comment',
+        '[P2]',
+        'type = 3',
+        'distance = 4',
+        'flag = 1',
+        '[P1]',
+        'type = 13',
+        '[STAGE]',
+        'name = Sälzer Höhe',
+    ]).encode('cp1252')
+    assert tokenizer_notes(tmp_path, data) == configparser_notes(data)
+    assert tokenizer_notes(tmp_path, codecs.BOM_UTF8 + data.decode('cp1252').encode('utf-8')) == configparser_notes(data)
+    assert tokenizer_notes(tmp_path, codecs.BOM_UTF16_LE + data.decode('cp1252').encode('utf-16-le')) == configparser_notes(data)
+
+
+def test_default_section(tmp_path):
+    data = b'\n'.join([
+        b'[DEFAULT]',
+        b'flag = 2',
+        b'count = 3',
+        b'[PACENOTES]',
+        b'[P0]',
+        b'type = 1',
+        b'distance = 10',
+        b'[P1]',
+        b'type = 2',
+        b'distance = 20',
+        b'flag = 4',
+    ])
+    assert tokenizer_notes(tmp_path, data) == configparser_notes(data)
+    assert tokenizer_notes(tmp_path, data) == (3, {0: (1, 10.0, 2), 1: (2, 20.0, 4)})
+
+
+def test_continuation_lines_are_rejected(tmp_path, caplog):
+    data = b'\n'.join([
+        b'[PACENOTES]',
+        b'count = 2',
+        b'[P0]',
+        b'type = 1',
+        b'  5',
+        b'distance = 10',
+        b'flag = 0',
+        b'[P1]',
+        b'type = 2',
+        b'distance = 20',
+        b'flag = 0',
+        b'    ',
+    ])
+    # configparser reads the continued value 1\n5, which is no number
+    config = configparser.ConfigParser()
+    config.read_string(data.decode('cp1252'))
+    assert config.get('P0', 'type') == '1\n5'
+
+    with caplog.at_level(logging.ERROR):
+        assert tokenizer_notes(tmp_path, data) == (2, {1: (2, 20.0, 0)})
+    assert 'Invalid pacenote P0' in caplog.text
+
+
+def test_parse_pacenotes_keeps_section_order():
+    count, notes = parse_pacenotes(b'[P5]\ntype=1\ndistance=1\nflag=0\n[P2]\ntype=2\ndistance=2\nflag=0\n')
+    assert count == 0
+    assert [note[0] for note in notes] == [5, 2]
+
+
+def write_stages(directory, stages=5, seed=0):
+    rng = random.Random(seed)
+    for stage in range(stages):
+        (directory / f'Stage {stage}_LuppisV3.ini').write_bytes(generate_stage(rng, rng.randint(1, 200)))
+
+
+def brute_force_rows(books):
+    # analyze_books the way it counted before the columns: one scan of the notes per column
+    note_types = set()
+    note_bits = set()
+    for book in books.values():
+        for note in book.notes.values():
+            note_types.add(note.type)
+            note_bits |= {1 << i for i in range(note.flag.bit_length()) if note.flag & (1 << i)}
+    header = ['name'] + sorted(note_types) + [f'flag_{x}' for x in sorted(note_bits)]
+    rows = [header]
+    for name, book in sorted(books.items()):
+        row = [name]
+        row += [len([x for x in book.notes.values() if x.type == note_type]) for note_type in sorted(note_types)]
+        row += [len([x for x in book.notes.values() if x.flag == bit]) for bit in sorted(note_bits)]
+        rows.append(row)
+    return rows
+
+
+def test_analyze_books_counts(tmp_path, capsys):
+    write_stages(tmp_path)
+    roadbooks = Roadbooks(str(tmp_path))
+    roadbooks.read_roadbooks('/.*/')
+    roadbooks.analyze_books()
+    rows = list(csv.reader(io.StringIO(capsys.readouterr().out)))
+    assert rows == [[str(x) for x in row] for row in brute_force_rows(roadbooks.books)]
+
+
+def book_columns(roadbooks):
+    return [(name, list(book.ids), list(book.types), list(book.distances), list(book.flags))
+            for name, book in roadbooks.books.items()]
+
+
+@pytest.mark.parametrize('name', ['/.*/', '/Stage [13]_/', 'Stage 2_LuppisV3.ini'])
+def test_read_roadbooks_in_a_process_pool(tmp_path, name):
+    write_stages(tmp_path, stages=6)
+    serial = Roadbooks(str(tmp_path))
+    serial.read_roadbooks(name)
+    parallel = Roadbooks(str(tmp_path))
+    parallel.read_roadbooks(name, jobs=2)
+    assert book_columns(parallel) == book_columns(serial)
+    assert serial.books
+
+
+def test_flag_tables_decode_like_the_flag_loop():
+    rng = random.Random(0)
+    flags = list(range(0x10000)) + [rng.getrandbits(32) for i in range(1000)]
+    for flag in flags:
+        assert Note.parse_flag(flag) == {name for name, value in Note.flag_values.items() if flag & value}
+
+
+def test_flag_values_are_distinct_bits():
+    values = [value for value in Note.flag_values.values() if value]
+    assert len(values) == len(set(values))
+    assert all(value & (value - 1) == 0 for value in values)
+    assert Note.flag_values['x3'] != Note.flag_values['x4']
+
+
+def test_note_is_slotted():
+    note = Note(1, 2.0, 0x41)
+    assert not hasattr(note, '__dict__')
+    assert note.flags == {'Narrows', 'Cut'}
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_stream_books_writes_the_analysis(tmp_path, capsys, caplog, jobs):
+    # stage names in both directories, the last one read wins
+    for directory, stages, seed in [('a', 4, 1), ('b', 6, 2)]:
+        (tmp_path / directory).mkdir()
+        write_stages(tmp_path / directory, stages=stages, seed=seed)
+    roadbooks = Roadbooks(str(tmp_path))
+    roadbooks.read_roadbooks('/.*/')
+    roadbooks.analyze_books()
+    expected = capsys.readouterr().out
+
+    caplog.clear()
+    Roadbooks(str(tmp_path)).stream_books('/.*/', jobs=jobs)
+    assert capsys.readouterr().out == expected
+    # without a cache the first pass is a full parse, that is not done quietly
+    assert f'Parsing {len(roadbooks.books)} stages twice without the parse cache' in caplog.text
+
+    # the header from the column index of the cache
+    caplog.clear()
+    cache = RoadbookCache(str(tmp_path / 'cache.sqlite'))
+    Roadbooks(str(tmp_path), cache=cache).stream_books('/.*/', jobs=jobs)
+    assert capsys.readouterr().out == expected
+    assert 'twice' not in caplog.text
+    Roadbooks(str(tmp_path), cache=cache).stream_books('/.*/', jobs=jobs)
+    assert capsys.readouterr().out == expected
+    assert cache.misses == len(roadbooks.books)
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from roadbook import Roadbooks
+from roadbook_bench import BENCHMARKS, flag_weights, generate, parse_weights, run
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_parse_weights():
+    assert parse_weights('0-3:60,102 112:5') == [([0, 1, 2, 3], 60.0), ([102, 112], 5.0)]
+    assert flag_weights('0:70,1 64:4') == [(0, 70.0), (1, 4.0), (64, 4.0)]
+    for text in ['', '1', '1:x', 'a:1', ':1', '1:-1']:
+        with pytest.raises(ValueError):
+            parse_weights(text)
+
+
+def read(directory):
+    roadbooks = Roadbooks(str(directory))
+    roadbooks.read_roadbooks('/.*/')
+    return roadbooks
+
+
+def test_generated_stages_follow_the_mix(tmp_path):
+    generate(str(tmp_path), 20, 200, seed=3, bom_ratio=0.5,
+             note_types=parse_weights('7:1,2061:1'), note_flags=flag_weights('1:1,64:3'), flag_density=0.25)
+    roadbooks = read(tmp_path)
+    assert len(roadbooks.books) == 20
+    types = [x for book in roadbooks.books.values() for x in book.types]
+    flags = [x for book in roadbooks.books.values() for x in book.flags]
+    assert set(types) == {7, 2061}
+    assert set(flags) == {0, 1, 64}
+    assert 0.2 < sum(1 for x in flags if x) / len(flags) < 0.3
+    assert all(book.num_notes == len(book.ids) for book in roadbooks.books.values())
+
+
+def test_generate_is_reproducible(tmp_path):
+    generate(str(tmp_path / 'a'), 5, 100, seed=1)
+    generate(str(tmp_path / 'b'), 5, 100, seed=1)
+    for name in os.listdir(tmp_path / 'a'):
+        assert (tmp_path / 'a' / name).read_bytes() == (tmp_path / 'b' / name).read_bytes()
+
+
+@pytest.mark.parametrize('benchmark', list(BENCHMARKS))
+def test_run_counts_the_notes(tmp_path, benchmark):
+    generate(str(tmp_path), 4, 50)
+    notes = sum(len(book.ids) for book in read(tmp_path).books.values())
+    result = run(str(tmp_path), benchmark)
+    assert (result['name'], result['stages'], result['notes']) == (benchmark, 4, notes)
+    assert result['peak_rss']['self'] > 0
+
+
+def test_bench_runs_every_benchmark_in_its_own_process(tmp_path):
+    result = subprocess.run([sys.executable, 'roadbook_bench.py', 'bench', '--sizes', '2', '--notes', '20',
+                             '--note-types', '0-11:1', '--flag-density', '0.1'],
+                            cwd=REPOSITORY, capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout)
+    (bench_run,) = report['runs']
+    assert [x['name'] for x in bench_run['results']] == list(BENCHMARKS)
+    assert len({x['notes'] for x in bench_run['results']}) == 1
+
+
+def test_invalid_mix_is_a_usage_error(tmp_path):
+    result = subprocess.run([sys.executable, 'roadbook_bench.py', 'generate', str(tmp_path), '--flags', '0:1',
+                             '--flag-density', '0.5'], cwd=REPOSITORY, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert 'Traceback' not in result.stderr
@@ -0,0 +1,77 @@
+import os
+import random
+
+from roadbook import Roadbook, Roadbooks
+from roadbook_bench import generate_stage
+from roadbook_cache import RoadbookCache
+
+
+def columns(book):
+    return (book.num_notes, list(book.ids), list(book.types), list(book.distances), list(book.flags))
+
+
+def write_stage(filename, seed, notes=100):
+    filename.write_bytes(generate_stage(random.Random(seed), notes))
+
+
+def test_cached_stage_is_the_parsed_stage(tmp_path):
+    stage = tmp_path / 'stage.ini'
+    write_stage(stage, 0)
+    cache = RoadbookCache(str(tmp_path / 'cache.sqlite'))
+    cache.put(str(stage), Roadbook(str(stage)))
+    cache.commit()
+
+    assert columns(cache.get(str(stage))) == columns(Roadbook(str(stage)))
+    book = Roadbook(str(stage))
+    assert cache.columns(str(stage)) == (book.note_types(), book.flag_bits())
+
+
+def test_changed_stage_is_parsed_again(tmp_path):
+    stage = tmp_path / 'stage.ini'
+    write_stage(stage, 0)
+    cache = RoadbookCache(str(tmp_path / 'cache.sqlite'))
+    roadbooks = Roadbooks(str(tmp_path), cache=cache)
+    roadbooks.read_roadbook('stage', str(stage))
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    roadbooks.read_roadbook('stage', str(stage))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # touched, same content: still a hit
+    os.utime(stage, ns=(0, 12345))
+    roadbooks.read_roadbook('stage', str(stage))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    write_stage(stage, 1, notes=120)
+    roadbooks.read_roadbook('stage', str(stage))
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert columns(roadbooks.books['stage']) == columns(Roadbook(str(stage)))
+
+
+def test_least_recently_used_stages_are_evicted(tmp_path):
+    cache = RoadbookCache(str(tmp_path / 'cache.sqlite'))
+    stages = []
+    for seed in range(4):
+        stage = tmp_path / f'stage{seed}.ini'
+        write_stage(stage, seed, notes=300)
+        cache.put(str(stage), Roadbook(str(stage)))
+        stages.append(str(stage))
+    cache.commit()
+    for stage in stages[:3]:
+        cache.get(stage)
+    sizes = dict(cache.db.execute('SELECT path, LENGTH(notes) FROM stages'))
+
+    # room for three stages, the unused one goes first
+    cache.max_size = sum(sizes.values()) - sizes[os.path.abspath(stages[3])]
+    cache.commit()
+    assert not cache.contains(stages[3])
+    assert all(cache.contains(x) for x in stages[:3])
+
+
+def test_clear(tmp_path):
+    stage = tmp_path / 'stage.ini'
+    write_stage(stage, 0)
+    cache = RoadbookCache(str(tmp_path / 'cache.sqlite'))
+    cache.put(str(stage), Roadbook(str(stage)))
+    cache.clear()
+    assert not cache.contains(str(stage))
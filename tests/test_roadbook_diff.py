@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from roadbook import Roadbook, Roadbooks
+from roadbook_diff import RoadbookDiff, diff_notes, stage_key
+
+
+def random_notes(rng, count):
+    # notes at least 10 meters apart, so every note is its own cluster
+    distance = 0.0
+    notes = []
+    for i in range(count):
+        distance += 10 + rng.random() * 50
+        notes.append((round(distance, 3), rng.randint(0, 40), rng.choice([0, 1, 2, 4, 64, 1024])))
+    return notes
+
+
+def test_identical_notes_have_no_changes():
+    notes = random_notes(random.Random(0), 500)
+    assert diff_notes(notes, list(notes)) == []
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_changes_are_found(seed):
+    rng = random.Random(seed)
+    old_notes = random_notes(rng, 300)
+    new_notes = []
+    expected = []
+    for note in old_notes:
+        (distance, note_type, flag) = note
+        change = rng.choice(['same'] * 6 + ['moved', 'removed', 'retyped', 'reflagged', 'added'])
+        if change == 'same':
+            new_notes.append(note)
+        elif change == 'moved':
+            # moved within the tolerance
+            new_notes.append((distance + 0.5, note_type, flag))
+        elif change == 'removed':
+            expected.append(('removed', note, None))
+        elif change == 'retyped':
+            new_note = (distance, note_type + 100, flag)
+            new_notes.append(new_note)
+            expected.append(('retyped', note, new_note))
+        elif change == 'reflagged':
+            new_note = (distance, note_type, flag ^ 8)
+            new_notes.append(new_note)
+            expected.append(('reflagged', note, new_note))
+        elif change == 'added':
+            new_notes.append(note)
+            new_note = (distance + 5, 99, 0)
+            new_notes.append(new_note)
+            expected.append(('added', None, new_note))
+    assert diff_notes(old_notes, new_notes) == expected
+
+
+def test_cluster_prefers_identical_then_same_type():
+    old_notes = [(10.0, 1, 0), (10.2, 2, 0), (10.4, 3, 0)]
+    new_notes = [(10.1, 3, 0), (10.3, 2, 4), (10.5, 7, 0)]
+    assert diff_notes(old_notes, new_notes) == [
+        ('reflagged', (10.2, 2, 0), (10.3, 2, 4)),
+        ('retyped', (10.0, 1, 0), (10.5, 7, 0)),
+    ]
+
+
+def test_stage_key():
+    assert stage_key('Ahvenus I_Luppis_20230228.ini') == 'ahvenus i'
+    assert stage_key('Ahvenus I_LuppisV3.ini') == 'ahvenus i'
+    assert stage_key('Ahvenus I_default.ini') == 'ahvenus i'
+
+
+def roadbooks_of(stages):
+    roadbooks = Roadbooks('')
+    for name, notes in stages.items():
+        (distances, types, flags) = zip(*notes) if notes else ([], [], [])
+        roadbooks.books[name] = Roadbook.from_columns(list(range(len(notes))), list(types), list(distances), list(flags))
+    return roadbooks
+
+
+def test_parallel_diff_is_the_serial_diff():
+    rng = random.Random(1)
+    old_stages = {}
+    new_stages = {}
+    for stage in range(12):
+        notes = random_notes(rng, rng.randint(0, 100))
+        old_stages[f'Stage {stage}_LuppisV2.ini'] = notes
+        new_stages[f'Stage {stage}_LuppisV3.ini'] = [(d, t if rng.random() < 0.9 else t + 1, f) for d, t, f in notes]
+    old_stages['Gone_LuppisV2.ini'] = random_notes(rng, 3)
+    new_stages['New_LuppisV3.ini'] = random_notes(rng, 3)
+
+    roadbook_diff = RoadbookDiff(roadbooks_of(old_stages), roadbooks_of(new_stages))
+    serial = list(roadbook_diff.diff(jobs=1))
+    assert list(roadbook_diff.diff(jobs=2)) == serial
+    assert ('Gone_LuppisV2.ini', 'stage_removed', None, None) in serial
+    assert ('New_LuppisV3.ini', 'stage_added', None, None) in serial
+    assert {change for name, change, old_note, new_note in serial} == {'retyped', 'stage_removed', 'stage_added'}
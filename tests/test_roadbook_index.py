@@ -0,0 +1,77 @@
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from roadbook import Roadbooks
+from roadbook_bench import generate_stage
+from roadbook_index import RoadbookIndex, parse_query
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def roadbooks(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('stages')
+    rng = random.Random(0)
+    for stage in range(8):
+        (directory / f'Stage {stage}_LuppisV3.ini').write_bytes(generate_stage(rng, rng.randint(50, 300)))
+    roadbooks = Roadbooks(str(directory))
+    roadbooks.read_roadbooks('/.*/')
+    return roadbooks
+
+
+def matches(note, kind, value):
+    (distance, note_type, flag) = note
+    return note_type == value if kind == 'type' else bool(flag & value)
+
+
+def brute_force(roadbooks, query):
+    # every note against every other note of the stage
+    (kind, value, direction, other_kind, other_value, within) = parse_query(query)
+    result = {}
+    for stage, book in roadbooks.books.items():
+        notes = list(zip(book.distances, book.types, book.flags))
+        found = []
+        for i, note in enumerate(notes):
+            if not matches(note, kind, value):
+                continue
+            if direction:
+                low, high = (note[0] - within, note[0]) if direction == 'after' else (note[0], note[0] + within)
+                if not any(j != i and matches(other, other_kind, other_value) and low <= other[0] <= high
+                           for j, other in enumerate(notes)):
+                    continue
+            found.append(note[0])
+        if found:
+            result[stage] = sorted(found)
+    return result
+
+
+@pytest.mark.parametrize('query', [
+    'type 2061',
+    'flag 64',
+    'flag 1024',
+    'type 3 after type 2 within 50',
+    'type 2061 before flag 64 within 20.5',
+    'flag 4 after flag 4 within 100',
+    'type 5 after type 5 within 30',
+])
+def test_query_is_the_brute_force_answer(roadbooks, query):
+    assert RoadbookIndex(roadbooks).query(query) == brute_force(roadbooks, query)
+
+
+@pytest.mark.parametrize('query', ['', 'type', 'type x', 'types 1', 'type 1 after type 2', 'flag 3', 'flag 0',
+                                   'type 1 after flag 6 within 10'])
+def test_invalid_queries(query):
+    with pytest.raises(ValueError):
+        parse_query(query)
+
+
+def test_invalid_query_is_a_usage_error():
+    result = subprocess.run([sys.executable, 'codriver.py', '--roadbooks', 'roadbooks_v3', '--roadbook-query', 'flag 3'],
+                            cwd=REPOSITORY, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert 'not a single bit' in result.stderr
+    assert 'Traceback' not in result.stderr
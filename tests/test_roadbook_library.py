@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from roadbook import Roadbooks
+from roadbook_bench import generate_stage
+from roadbook_library import is_roadbook_library, open_roadbooks, write_roadbook_library
+
+
+@pytest.fixture
+def stages(tmp_path):
+    directory = tmp_path / 'stages'
+    directory.mkdir()
+    rng = random.Random(0)
+    for stage in range(5):
+        (directory / f'Stage {stage}_LuppisV3.ini').write_bytes(generate_stage(rng, rng.randint(1, 200)))
+    # a stage without notes
+    (directory / 'Empty_LuppisV3.ini').write_bytes(b'[PACENOTES]\ncount = 0\n')
+    return directory
+
+
+def columns(roadbooks):
+    return {name: (book.num_notes, list(book.ids), list(book.types), list(book.distances), list(book.flags))
+            for name, book in roadbooks.books.items()}
+
+
+def test_library_has_the_stages_of_the_directory(tmp_path, stages):
+    roadbooks = Roadbooks(str(stages))
+    roadbooks.read_roadbooks('/.*/')
+    library = tmp_path / 'stages.rbl'
+    write_roadbook_library(str(library), roadbooks)
+
+    assert is_roadbook_library(str(library))
+    assert not is_roadbook_library(str(stages))
+    library_roadbooks = open_roadbooks(str(library))
+    library_roadbooks.read_roadbooks('/.*/')
+    assert columns(library_roadbooks) == columns(roadbooks)
+
+
+def test_library_analysis_is_the_directory_analysis(tmp_path, stages, capsys):
+    roadbooks = Roadbooks(str(stages))
+    roadbooks.read_roadbooks('/Stage [0-3]/')
+    roadbooks.analyze_books()
+    expected = capsys.readouterr().out
+
+    everything = Roadbooks(str(stages))
+    everything.read_roadbooks('/.*/')
+    write_roadbook_library(str(tmp_path / 'stages.rbl'), everything)
+    library_roadbooks = open_roadbooks(str(tmp_path / 'stages.rbl'))
+    library_roadbooks.read_roadbooks('/Stage [0-3]/')
+    library_roadbooks.analyze_books()
+    assert capsys.readouterr().out == expected
+
+    open_roadbooks(str(tmp_path / 'stages.rbl')).stream_books('/Stage [0-3]/')
+    assert capsys.readouterr().out == expected
+
+
+def test_not_a_library(tmp_path):
+    (tmp_path / 'x.rbl').write_bytes(b'RBRBOOKX')
+    assert not is_roadbook_library(str(tmp_path / 'x.rbl'))
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from task_graph import TaskGraph
+
+
+def test_results_are_passed_to_the_dependents():
+    graph = TaskGraph()
+    graph.add('a', lambda: 2)
+    graph.add('b', lambda: 3)
+    graph.add('sum', lambda a, b: (a, b, a + b), 'a', 'b')
+    graph.add('twice', lambda x: x[2] * 2, 'sum')
+    assert graph.run(jobs=4) == {}
+    assert graph.results == {'a': 2, 'b': 3, 'sum': (2, 3, 5), 'twice': 10}
+
+
+def test_a_key_is_added_once():
+    graph = TaskGraph()
+    calls = []
+    lock = threading.Lock()
+
+    def task(name):
+        def run(*args):
+            with lock:
+                calls.append(name)
+            return name
+        return run
+
+    assert graph.add('shared', task('first')) == 'shared'
+    assert graph.add('shared', task('second')) == 'shared'
+    graph.add('one', task('one'), 'shared')
+    graph.add('two', task('two'), 'shared')
+    graph.run(jobs=4)
+    assert sorted(calls) == ['first', 'one', 'two']
+    assert graph.results['shared'] == 'first'
+
+
+def test_unknown_dependency():
+    graph = TaskGraph()
+    graph.add('a', lambda: 1)
+    with pytest.raises(KeyError, match='Unknown dependency b of task c'):
+        graph.add('c', lambda a, b: a, 'a', 'b')
+    assert 'c' not in graph.tasks
+
+
+def test_a_failure_fails_the_dependents():
+    graph = TaskGraph()
+    called = []
+    error = ValueError('broken')
+
+    def fail():
+        raise error
+
+    graph.add('bad', fail)
+    graph.add('good', lambda: 1)
+    graph.add('child', lambda x: called.append('child'), 'bad')
+    graph.add('grandchild', lambda x: called.append('grandchild'), 'child')
+    graph.add('both', lambda x, y: called.append('both'), 'good', 'bad')
+    graph.add('fine', lambda x: x + 1, 'good')
+    errors = graph.run(jobs=2)
+    assert called == []
+    assert errors == {'bad': error, 'child': error, 'grandchild': error, 'both': error}
+    assert graph.results == {'good': 1, 'fine': 2}
+
+
+def test_a_later_run_only_runs_the_new_tasks():
+    graph = TaskGraph()
+    calls = []
+
+    def fail():
+        raise ValueError('broken')
+
+    graph.add('a', lambda: calls.append('a') or 1)
+    graph.add('bad', fail)
+    graph.run(jobs=1)
+    graph.add('b', lambda a: calls.append('b') or a + 1, 'a')
+    graph.add('after bad', lambda x: calls.append('after bad'), 'bad')
+    errors = graph.run(jobs=1)
+    assert calls == ['a', 'b']
+    assert graph.results == {'a': 1, 'b': 2}
+    assert set(errors) == {'bad', 'after bad'}